@@ -14,11 +14,14 @@ S = np.array([
     [0.89728, 0.06816, 0.09401]   # Red LED
 ])
 
-# Calculate the inverse of the RGB matrix
-S_inv = np.linalg.inv(S)
+# Compute the transformation matrix: the rows of S and T are the LEDs, so S · Cᵀ = T
+# and C = (S⁻¹ · T)ᵀ maps an RGB column vector to its XYZ column vector
+C = np.linalg.solve(S, T).T
 
-# Compute the transformation matrix
-C = np.dot(T, S_inv)
+# Every LED has to map back to its own XYZ values
+round_trip_error = np.max(np.abs(S @ C.T - T))
+if round_trip_error > 1e-9:
+    raise ValueError(f"RGB to XYZ matrix doesn't reproduce the LEDs' XYZ values (error {round_trip_error:.3g})")
 
 # Display the transformation matrix
 print("Transformation matrix (C):")
@@ -0,0 +1,282 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+repository_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repository_dir)
+
+from tcs34725 import calibration, converter, lut, settings  # noqa: E402
+from tcs34725.cie import default_cmf_file  # noqa: E402
+from tcs34725.curve_features import curve_features  # noqa: E402
+from tcs34725.integration import SpectralIntegrator  # noqa: E402
+from tcs34725.light_sources import gaussian_leds  # noqa: E402
+from tcs34725.responsivity import interpolate_responsivity, read_responsivity_csv, wavelength_grid  # noqa: E402
+from tcs34725.xyz_fit import estimate_cct_duv, planckian_locus_table  # noqa: E402
+
+default_history_file = os.path.join(repository_dir, 'benchmarks', 'history.jsonl')
+
+# Sizes of the full and the quick run
+reading_counts = {'full': [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7], 'quick': [10 ** 3, 10 ** 5]}
+spectrum_counts = {'full': [10 ** 2, 10 ** 3, 10 ** 4, 10 ** 5], 'quick': [10 ** 2, 10 ** 3]}
+grid_steps = [1.0, 0.1]  # nm
+
+# Cases needing more memory than this for their input are generated and integrated in chunks
+# of chunk_bytes, the timing then includes generating the spectra
+memory_budget = 2 * 1024 ** 3  # bytes
+chunk_bytes = 256 * 1024 ** 2
+
+# Benchmark cases register themselves here with their name and parameter sets
+benchmarks = []
+
+
+def benchmark(name):
+    def register(function):
+        benchmarks.append((name, function))
+        return function
+    return register
+
+
+# Time a function: repeat until min_time has passed, report the best and median of the repeats
+def measure(function, repeats=5, min_time=0.2):
+    function()  # warm up
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time / repeats or number >= 1 << 20:
+            break
+        number *= 2
+
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        timings.append((time.perf_counter() - start) / number)
+    return {'best': min(timings), 'median': float(np.median(timings)), 'number': number, 'repeats': repeats}
+
+
+def sensor_grid(step):
+    wavelengths_sensor, responsivity = read_responsivity_csv()
+    return wavelength_grid(np.ceil(wavelengths_sensor.min()), np.floor(wavelengths_sensor.max()), step)
+
+
+def random_readings(count, seed=0):
+    rng = np.random.default_rng(seed)
+    counts = rng.integers(0, 65535, (4, count)).astype(np.float64)
+    return counts, rng.integers(0, 4, count), rng.integers(0, 256, count)
+
+
+def random_spectra(wavelengths, count, seed=0):
+    rng = np.random.default_rng(seed)
+    return gaussian_leds(wavelengths, rng.uniform(400, 700, count), rng.uniform(10, 60, count))
+
+
+@benchmark('pchip_resampling')
+def pchip_resampling(size):
+    wavelengths_sensor, responsivity = read_responsivity_csv()
+    for step in grid_steps:
+        wavelengths = sensor_grid(step)
+        yield {'grid_step': step, 'grid_size': len(wavelengths)}, \
+            lambda: interpolate_responsivity(wavelengths_sensor, responsivity, wavelengths), 1
+
+
+@benchmark('fwhm_search')
+def fwhm_search(size):
+    wavelengths_sensor, responsivity = read_responsivity_csv()
+    for step in grid_steps:
+        wavelengths = sensor_grid(step)
+        responses = interpolate_responsivity(wavelengths_sensor, responsivity, wavelengths)
+        yield {'grid_step': step, 'grid_size': len(wavelengths)}, \
+            lambda: [calibration.calculate_fwhm(wavelengths, response) for response in responses], len(responses)
+
+
+@benchmark('analytic_fwhm')
+def analytic_fwhm(size):
+    wavelengths_sensor, responsivity = read_responsivity_csv()
+    # Many devices' curves at once, the sampled search above needs one resampled grid per curve
+    for count in [4, 4 * spectrum_counts[size][1]]:
+        rng = np.random.default_rng(0)
+        responses = np.tile(responsivity, (count // 4, 1)) * rng.uniform(0.5, 2, (count, 1))
+        yield {'curves': count}, lambda: curve_features(wavelengths_sensor, responses), count
+
+
+@benchmark('trapezoid_loop')
+def trapezoid_loop(size):
+    wavelengths_sensor, responsivity = read_responsivity_csv()
+    for step in grid_steps:
+        wavelengths = sensor_grid(step)
+        responses = interpolate_responsivity(wavelengths_sensor, responsivity, wavelengths)
+        # The per-spectrum loop of the scripts is only timed on the smallest batch
+        count = spectrum_counts[size][0]
+        spectra = random_spectra(wavelengths, count)
+        yield {'grid_step': step, 'spectra': count}, \
+            lambda: [[np.trapezoid(spectrum * response, wavelengths) for response in responses]
+                     for spectrum in spectra], count
+
+
+@benchmark('spectral_integrator')
+def spectral_integrator(size):
+    wavelengths_sensor, responsivity = read_responsivity_csv()
+    for step in grid_steps:
+        wavelengths = sensor_grid(step)
+        integrator = SpectralIntegrator(wavelengths, interpolate_responsivity(wavelengths_sensor, responsivity,
+                                                                              wavelengths))
+        for count in spectrum_counts[size]:
+            if count * len(wavelengths) * 8 > memory_budget:
+                chunk = max(1, chunk_bytes // (len(wavelengths) * 8))
+                yield {'grid_step': step, 'spectra': count, 'chunk': chunk}, \
+                    lambda: [integrator.unitless_avg_responses(random_spectra(wavelengths, min(chunk, count - start),
+                                                                              seed=start))
+                             for start in range(0, count, chunk)], count
+                continue
+            spectra = random_spectra(wavelengths, count)
+            yield {'grid_step': step, 'spectra': count}, lambda: integrator.unitless_avg_responses(spectra), count
+
+
+@benchmark('convert_counts')
+def convert_counts(size):
+    for count in reading_counts[size]:
+        (red, green, blue, clear), again, atime = random_readings(count)
+        gain = settings.gains[again]
+        integration_time = settings.integration_time_table[atime]
+        yield {'readings': count}, lambda: converter.convert_counts(red, green, blue, clear, gain,
+                                                                    integration_time), count
+
+
+@benchmark('convert_register_counts')
+def convert_register_counts(size):
+    for count in reading_counts[size]:
+        (red, green, blue, clear), again, atime = random_readings(count)
+        yield {'readings': count}, lambda: converter.convert_register_counts(red, green, blue, clear,
+                                                                             again, atime), count
+
+
+# CCT and Duv need the Planckian locus, so these cases are skipped without the CIE data
+def locus_table():
+    if not os.path.exists(default_cmf_file):
+        return None
+    return planckian_locus_table(default_cmf_file)
+
+
+@benchmark('evaluate_lut')
+def evaluate_lut(size):
+    cct_table = locus_table()
+    table = lut.build_lut(cct_table) if cct_table is not None else None
+    for count in reading_counts[size]:
+        if table is None:
+            yield {'readings': count}, None, 'no CIE color-matching functions'
+            continue
+        (red, green, blue, _), again, atime = random_readings(count)
+        gain = settings.gains[again]
+        integration_time = settings.integration_time_table[atime]
+        yield {'readings': count}, lambda: lut.evaluate_lut(table, red, green, blue, gain, integration_time), count
+
+
+# The exact path evaluate_lut replaces: convert_counts plus the k-d tree CCT estimate
+@benchmark('convert_counts_cct')
+def convert_counts_cct(size):
+    cct_table = locus_table()
+    for count in reading_counts[size][:-1]:  # 1e7 readings take minutes
+        if cct_table is None:
+            yield {'readings': count}, None, 'no CIE color-matching functions'
+            continue
+        (red, green, blue, clear), again, atime = random_readings(count)
+        gain = settings.gains[again]
+        integration_time = settings.integration_time_table[atime]
+
+        def run():
+            converted = converter.convert_counts(red, green, blue, clear, gain, integration_time)
+            estimate_cct_duv(converted['X'], converted['Y'], converted['Z'], cct_table)
+        yield {'readings': count}, run, count
+
+
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=repository_dir, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Latest recorded result of every (benchmark, parameters) pair
+def read_history(history_file):
+    latest = {}
+    if not os.path.exists(history_file):
+        return latest
+    with open(history_file) as f:
+        for line in f:
+            record = json.loads(line)
+            latest[(record['benchmark'], json.dumps(record['parameters'], sort_keys=True))] = record
+    return latest
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the calibration and conversion hot paths.')
+    parser.add_argument('--quick', action='store_true', help='only run the small sizes')
+    parser.add_argument('-k', '--filter', help='only run benchmarks whose name contains this')
+    parser.add_argument('--history', default=default_history_file, help='JSON lines file the results are added to')
+    parser.add_argument('--no-record', action='store_true', help="don't add the results to the history")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='report a regression when slower than the last run by this fraction')
+    args = parser.parse_args()
+
+    size = 'quick' if args.quick else 'full'
+    previous = read_history(args.history)
+    run = {
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'commit': current_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'processor': platform.processor() or platform.machine(),
+        'size': size
+    }
+
+    records = []
+    regressions = []
+    for name, cases in benchmarks:
+        if args.filter and args.filter not in name:
+            continue
+        for parameters, function, items in cases(size):
+            label = f"{name} {' '.join(f'{k}={v}' for k, v in parameters.items())}"
+            if function is None:
+                print(f"{label}: skipped, {items}")
+                continue
+            timing = measure(function)
+            record = {**run, 'benchmark': name, 'parameters': parameters, **timing,
+                      'items_per_second': items / timing['best']}
+            records.append(record)
+
+            comparison = ''
+            last = previous.get((name, json.dumps(parameters, sort_keys=True)))
+            if last is not None:
+                change = timing['best'] / last['best'] - 1
+                comparison = f" ({change:+.1%} vs {last['commit'] or 'last run'})"
+                if change > args.threshold:
+                    regressions.append(label)
+            print(f"{label}: {timing['best'] * 1e3:.3f} ms, {record['items_per_second']:.3g} items/s{comparison}")
+
+    if not args.no_record:
+        with open(args.history, 'a') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+
+    if regressions:
+        print(f"Regressions over {args.threshold:.0%}:")
+        for label in regressions:
+            print(f"  {label}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
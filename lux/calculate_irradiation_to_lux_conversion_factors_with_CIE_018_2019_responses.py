@@ -59,19 +59,6 @@ blue_interp = interpolate_response(wavelengths_sensor, blue_response_norm, wavel
 # Interpolate the CIE photopic luminous efficiency function
 V_lambda_interp = interpolate_response(wavelengths_cie, V_lambda, wavelengths_interp)
 
-# Plot the normalized spectral responses and V(λ)
-plt.figure(figsize=(10, 6))
-plt.plot(wavelengths_interp, red_interp, label='Normalized Red Response')
-plt.plot(wavelengths_interp, green_interp, label='Normalized Green Response')
-plt.plot(wavelengths_interp, blue_interp, label='Normalized Blue Response')
-plt.plot(wavelengths_interp, V_lambda_interp / np.max(V_lambda_interp), label='Normalized V(λ)')
-plt.xlabel('Wavelength (nm)')
-plt.ylabel('Normalized Response')
-plt.title('Normalized Spectral Responses and CIE Photopic Curve')
-plt.legend()
-plt.grid(True)
-plt.show()
-
 # Determine the FWHM for each channel
 def calculate_fwhm(wavelengths, response):
     half_max = np.max(response) / 2.0
@@ -147,3 +134,16 @@ print("Conversion factors (K_channel) in lux per μW/cm²:")
 print(f"Red channel:   K_red = {K_red:.15f} lux per μW/cm²")
 print(f"Green channel: K_green = {K_green:.15f} lux per μW/cm²")
 print(f"Blue channel:  K_blue = {K_blue:.15f} lux per μW/cm²")
+
+# Plot the normalized spectral responses and V(λ)
+plt.figure(figsize=(10, 6))
+plt.plot(wavelengths_interp, red_interp, label='Normalized Red Response')
+plt.plot(wavelengths_interp, green_interp, label='Normalized Green Response')
+plt.plot(wavelengths_interp, blue_interp, label='Normalized Blue Response')
+plt.plot(wavelengths_interp, V_lambda_interp / np.max(V_lambda_interp), label='Normalized V(λ)')
+plt.xlabel('Wavelength (nm)')
+plt.ylabel('Normalized Response')
+plt.title('Normalized Spectral Responses and CIE Photopic Curve')
+plt.legend()
+plt.grid(True)
+plt.show()
@@ -0,0 +1,55 @@
+from .converter import calculate_chromaticity, convert_counts, convert_register_counts
+
+# Public API, the name and the module it lives in. Everything except the converter is imported on
+# first access (module __getattr__), so `import tcs34725` only costs NumPy and the converter tables.
+_lazy_attributes = {
+    # Light sources
+    'gaussian': 'light_sources',
+    'gaussian_leds': 'light_sources',
+    'phosphor_white_leds': 'light_sources',
+    'planckian': 'light_sources',
+    'scenario_spectra': 'light_sources',
+    # Responsivity and CIE data
+    'channels': 'responsivity',
+    'read_responsivity': 'responsivity',
+    'load_responsivity_grid': 'responsivity',
+    'load_cie_cmfs': 'cie',
+    'load_photopic': 'cie',
+    # Calibration chain
+    'calculate_unitless_avg_response': 'calibration',
+    'calculate_fwhm': 'calibration',
+    'interpolate_response': 'calibration',
+    'normalize_rgb': 'calibration',
+    'calculate_graph_conversion_factor': 'calibration',
+    'calculate_channel_conversion_factors': 'calibration',
+    'calculate_lux_factors': 'calibration',
+    'calculate_rgb_to_xyz_matrix': 'calibration',
+    'run_pipeline': 'pipeline',
+    # Analysis
+    'integrate_spectra': 'integration',
+    'SpectralIntegrator': 'integration',
+    'curve_features': 'curve_features',
+    'channel_gamuts': 'gamut',
+    'gamut_coverage': 'gamut',
+    'fit_xyz_matrix': 'xyz_fit',
+    'fit_lux_weights': 'lux_fit',
+    # Calibration artifacts
+    'load_artifacts': 'artifact',
+    'convert_device_register_counts': 'artifact',
+}
+
+__all__ = ['calculate_chromaticity', 'convert_counts', 'convert_register_counts'] + list(_lazy_attributes)
+
+
+def __getattr__(name):
+    if name not in _lazy_attributes:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    import importlib
+
+    value = getattr(importlib.import_module(f'.{_lazy_attributes[name]}', __name__), name)
+    globals()[name] = value  # later accesses skip __getattr__
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy_attributes))
@@ -0,0 +1,211 @@
+import argparse
+import asyncio
+import math
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from .calibration import counts_per_uW_cm2
+from .converter import convert_register_counts
+from .light_sources import scenario_spectra
+from .responsivity import channels, default_responsivity_file, load_responsivity_grid
+from .settings import atime_to_integration_time, integration_time_to_atime, max_count_table, scale_table
+
+# A sensor on a bus: the address selects it on the bus backend (with the fixed TCS34725 address
+# 0x29 that is usually the channel of an I²C multiplexer), again and atime are its register values
+Sensor = namedtuple('Sensor', ['sensor_id', 'bus', 'address', 'again', 'atime'])
+
+# Fields of a raw reading, batched into one array per field
+reading_fields = ['sensor', 'timestamp', 'clear', 'red', 'green', 'blue', 'again', 'atime']
+
+
+# Raw register counts of lights with the given per-µW/cm² counts and irradiance at the register settings
+#
+# noise is the relative standard deviation of the counts, the result is rounded and clipped to
+# the largest count of the ATIME setting like the sensor's registers.
+def simulate_raw_counts(counts_per_uW, irradiance, again, atime, noise=0.0, rng=None):
+    again = np.asarray(again, dtype=np.intp)
+    atime = np.asarray(atime, dtype=np.intp)
+    counts = np.asarray(counts_per_uW, dtype=np.float64) * \
+        (np.asarray(irradiance, dtype=np.float64) * scale_table[again, atime])[..., np.newaxis]
+    if noise:
+        rng = rng if rng is not None else np.random.default_rng()
+        counts = counts * (1 + noise * rng.standard_normal(counts.shape))
+    return np.clip(np.rint(counts), 0, max_count_table[atime][..., np.newaxis]).astype(np.int64)
+
+
+# Bus backend that synthesizes the counts of every address from the responsivity and a light spectrum
+#
+# spectra holds one spectrum with a radiant power of 1 per address (sampled at wavelengths),
+# irradiance is in µW/cm² and can be changed while acquiring with set_irradiance. Every
+# transaction occupies the bus for transfer_time seconds. A hardware backend implements the
+# same two coroutines, blocking drivers (e.g. smbus2) through asyncio.to_thread.
+class SimulatedBus:
+    def __init__(self, spectra, wavelengths, irradiance=10.0, responsivity_file=default_responsivity_file,
+                 transfer_time=0.0003, noise=0.01, seed=None):
+        _, responsivity = load_responsivity_grid(wavelengths, responsivity_file)
+        self.counts_per_uW = dict(zip(spectra, counts_per_uW_cm2(np.array(list(spectra.values())), wavelengths,
+                                                                 responsivity)))
+        self.irradiance = {address: irradiance for address in spectra}
+        self.settings = {}
+        self.transfer_time = transfer_time
+        self.noise = noise
+        self.rng = np.random.default_rng(seed)
+
+    def set_irradiance(self, address, irradiance):
+        self.irradiance[address] = irradiance
+
+    async def configure(self, address, again, atime):
+        await asyncio.sleep(self.transfer_time)
+        self.settings[address] = (again, atime)
+
+    # Clear, red, green and blue counts of the last integration cycle
+    async def read_counts(self, address):
+        await asyncio.sleep(self.transfer_time)
+        again, atime = self.settings[address]
+        counts = simulate_raw_counts(self.counts_per_uW[address], self.irradiance[address], again, atime,
+                                     self.noise, self.rng)
+        return tuple(int(counts[channels.index(ch)]) for ch in ['Clear', 'Red', 'Green', 'Blue'])
+
+
+# Read one sensor every integration cycle until samples readings are taken or the loop time reaches stop
+#
+# Reads are scheduled on the cycle grid of the sensor's ATIME, waiting never blocks the other
+# sensors and transactions on one bus are serialized by its lock. A reading that is late by
+# more than a cycle skips the cycles it missed (the sensor overwrote them).
+async def _poll_sensor(index, sensor, bus, lock, queue, samples, stop):
+    loop = asyncio.get_running_loop()
+    async with lock:
+        await bus.configure(sensor.address, sensor.again, sensor.atime)
+    cycle = float(atime_to_integration_time(sensor.atime)) / 1000
+    next_read = loop.time() + cycle
+    taken = 0
+    try:
+        while (samples is None or taken < samples) and (stop is None or next_read <= stop):
+            await asyncio.sleep(max(0.0, next_read - loop.time()))
+            async with lock:
+                clear, red, green, blue = await bus.read_counts(sensor.address)
+            timestamp = loop.time()
+            queue.put_nowait((index, timestamp, clear, red, green, blue, sensor.again, sensor.atime))
+            taken += 1
+            next_read += cycle
+            if next_read < timestamp:
+                next_read += math.ceil((timestamp - next_read) / cycle) * cycle
+    finally:
+        queue.put_nowait(None)
+
+
+# Convert a list of raw reading tuples into one batch, a dict of arrays with reading_fields plus
+# the outputs of convert_register_counts
+def convert_readings(readings):
+    columns = dict(zip(reading_fields, zip(*readings)))
+    batch = {field: np.array(columns[field], dtype=np.float64 if field == 'timestamp' else np.int64)
+             for field in reading_fields}
+    batch.update(convert_register_counts(batch['red'], batch['green'], batch['blue'], batch['clear'],
+                                         batch['again'], batch['atime']))
+    return batch
+
+
+# Acquire from many sensors on many buses concurrently and yield converted batches
+#
+# buses maps the bus names of the sensors to backends (SimulatedBus or a hardware backend).
+# Readings are collected until batch_size readings or batch_timeout seconds after the first one
+# and converted together. Stops after samples readings per sensor or duration seconds, either
+# can be None (run until the consumer stops iterating).
+async def acquire_batches(sensors, buses, samples=None, duration=None, batch_size=256, batch_timeout=0.05):
+    loop = asyncio.get_running_loop()
+    stop = None if duration is None else loop.time() + duration
+    queue = asyncio.Queue()
+    locks = {name: asyncio.Lock() for name in {sensor.bus for sensor in sensors}}
+    tasks = [asyncio.create_task(_poll_sensor(index, sensor, buses[sensor.bus], locks[sensor.bus], queue,
+                                              samples, stop))
+             for index, sensor in enumerate(sensors)]
+    running = len(tasks)
+    try:
+        while running:
+            readings = []
+            deadline = None
+            while running and len(readings) < batch_size:
+                try:
+                    if deadline is None:
+                        reading = await queue.get()
+                    else:
+                        reading = queue.get_nowait() if not queue.empty() else \
+                            await asyncio.wait_for(queue.get(), max(0.0, deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    break
+                if reading is None:
+                    running -= 1
+                    continue
+                readings.append(reading)
+                if deadline is None:
+                    deadline = loop.time() + batch_timeout
+            if readings:
+                yield convert_readings(readings)
+        for task in tasks:
+            task.result()  # raise errors of the backends
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+# Simulated fleet for load tests: sensors spread over buses, each under one of the scenario lights
+def simulated_fleet(sensor_count, bus_count, integration_time=24.0, again=2, wavelengths=None, seed=0,
+                    **bus_options):
+    if wavelengths is None:
+        wavelengths = np.arange(380.0, 1001.0)
+    spectra, _ = scenario_spectra(wavelengths, seed)
+    rng = np.random.default_rng(seed)
+    atime = int(integration_time_to_atime(integration_time))
+    sensors = [Sensor(f'sensor{i}', f'bus{i % bus_count}', i // bus_count, again, atime) for i in range(sensor_count)]
+    buses = {}
+    for b in range(bus_count):
+        addresses = [sensor.address for sensor in sensors if sensor.bus == f'bus{b}']
+        chosen = rng.choice(len(spectra), size=len(addresses))
+        bus = SimulatedBus(dict(zip(addresses, spectra[chosen])), wavelengths, seed=seed + b, **bus_options)
+        for address in addresses:
+            bus.set_irradiance(address, float(np.exp(rng.uniform(np.log(1), np.log(100)))))
+        buses[f'bus{b}'] = bus
+    return sensors, buses
+
+
+async def _load_test(sensors, buses, duration, batch_size):
+    readings = 0
+    batches = 0
+    lux = []
+    async for batch in acquire_batches(sensors, buses, duration=duration, batch_size=batch_size):
+        readings += len(batch['sensor'])
+        batches += 1
+        lux.append(batch['lux'])
+    return readings, batches, np.concatenate(lux) if lux else np.empty(0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the asyncio acquisition on simulated I²C buses.')
+    parser.add_argument('--sensors', type=int, default=48, help='number of sensors')
+    parser.add_argument('--buses', type=int, default=4, help='number of buses')
+    parser.add_argument('--integration-time', type=float, default=24.0, help='integration time in ms')
+    parser.add_argument('--gain', type=int, default=2, help='AGAIN register value (0-3)')
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds to acquire')
+    parser.add_argument('--batch-size', type=int, default=256, help='readings per conversion batch')
+    parser.add_argument('--transfer-time', type=float, default=0.0003, help='seconds per bus transaction')
+    args = parser.parse_args()
+
+    sensors, buses = simulated_fleet(args.sensors, args.buses, args.integration_time, args.gain,
+                                     transfer_time=args.transfer_time)
+    start = time.perf_counter()
+    readings, batches, lux = asyncio.run(_load_test(sensors, buses, args.duration, args.batch_size))
+    elapsed = time.perf_counter() - start
+
+    cycle = float(atime_to_integration_time(sensors[0].atime)) / 1000
+    expected = len(sensors) * int(args.duration / cycle)
+    print(f'{readings} readings in {batches} batches in {elapsed:.2f} s ({readings / elapsed:.0f} readings/s), '
+          f'{readings / max(expected, 1):.1%} of the {expected} integration cycles')
+    if len(lux):
+        print(f'lux: median {np.median(lux):.1f}, min {lux.min():.1f}, max {lux.max():.1f}')
+
+
+if __name__ == '__main__':
+    main()
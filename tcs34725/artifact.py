@@ -0,0 +1,207 @@
+import argparse
+import os
+from collections import namedtuple
+
+import numpy as np
+
+from .binary_format import hash_file, map_arrays, write_arrays
+from .cie import default_cmf_file, default_photopic_file, interpolate_cmfs, load_cie_cmfs
+from .converter import calculate_chromaticity
+from .fleet import calibrate_fleet, coefficient_columns, read_manifest, scan_device_directories
+from .responsivity import channels, default_responsivity_file, load_responsivity_grid, wavelength_grid
+from .settings import inverse_scale_table, saturated, scale_table
+
+artifact_magic = b'TCS34725CAL\0'
+artifact_version = 3  # 2: RGB to XYZ matrix as (S⁻¹ · T)ᵀ, 3: fitted counts to XYZ matrix in the coefficients
+
+# Common wavelength grid of all artifacts, so the responsivities of a fleet stack into one array
+artifact_grid = wavelength_grid(300, 1100)
+
+# Calibration of a set of devices, every per-device array has one row per device
+#
+# wavelengths, cmfs (x_bar, y_bar, z_bar at the wavelengths) and inverse_scale (gain x ATIME) are
+# shared. responsivity is (device x channel x wavelength), coefficients (device x
+# coefficient_columns), counts_per_uW_cm2 (device x gain x ATIME x channel) and RGB_to_XYZ_matrix
+# (device x 3 x 3). index maps the device ids to their rows, provenance holds the SHA-256 of the
+# source files of every device.
+CalibrationArtifacts = namedtuple('CalibrationArtifacts', [
+    'device_ids', 'index', 'provenance', 'wavelengths', 'cmfs', 'inverse_scale', 'responsivity',
+    'coefficients', 'counts_per_uW_cm2', 'RGB_to_XYZ_matrix'])
+
+_shared_arrays = ['wavelengths', 'cmfs', 'inverse_scale']
+_device_arrays = ['responsivity', 'coefficients', 'counts_per_uW_cm2', 'RGB_to_XYZ_matrix']
+
+
+# Build the artifacts of devices given like fleet.read_manifest
+#
+# table is the coefficient table of the devices from fleet.calibrate_fleet, it is computed
+# (on max_workers processes) when None. Devices that failed to calibrate raise a ValueError.
+def build_artifacts(devices, table=None, cmf_file=default_cmf_file, photopic_file=default_photopic_file,
+                    wavelengths=artifact_grid, max_workers=None):
+    if table is None:
+        table, errors = calibrate_fleet(devices, cmf_file, photopic_file, max_workers=max_workers)
+        if errors:
+            raise ValueError('Calibration failed for ' + ', '.join(f'{device_id} ({error})'
+                                                                 for device_id, error in errors.items()))
+    coefficients = np.column_stack([table[column] for column in coefficient_columns]).astype(np.float64)
+    if np.isnan(coefficients).any():
+        raise ValueError('The coefficient table has failed devices')
+
+    wavelengths = np.asarray(wavelengths, dtype=np.float64)
+    wavelengths_cie, cmfs = load_cie_cmfs(cmf_file)
+    cmf_hash, photopic_hash = hash_file(cmf_file), hash_file(photopic_file)
+
+    responsivity = np.empty((len(devices), len(channels), len(wavelengths)))
+    provenance = []
+    for i, device in enumerate(devices):
+        responsivity_file = device.get('responsivity_file') or default_responsivity_file
+        _, responsivity[i] = load_responsivity_grid(wavelengths, responsivity_file, extrapolate=False)
+        leds_file = device.get('leds_file')
+        provenance.append({'responsivity': hash_file(responsivity_file),
+                           'leds': hash_file(leds_file) if leds_file is not None else None,
+                           'cmf': cmf_hash, 'photopic': photopic_hash})
+
+    # The channel factors refer to 1x gain and 2.4 ms, the table holds them for every setting
+    channel_factors = coefficients[:, [coefficient_columns.index(f'C_{ch.lower()}') for ch in channels]]
+    counts_per_uW_cm2 = scale_table[np.newaxis, :, :, np.newaxis] * channel_factors[:, np.newaxis, np.newaxis, :]
+    matrix = coefficients[:, [coefficient_columns.index(f'M_{i}{j}') for i in range(3) for j in range(3)]]
+
+    device_ids = [str(device_id) for device_id in table['device_id']]
+    return CalibrationArtifacts(device_ids, {device_id: i for i, device_id in enumerate(device_ids)}, provenance,
+                                wavelengths, interpolate_cmfs(wavelengths_cie, cmfs, wavelengths),
+                                inverse_scale_table, responsivity, coefficients, counts_per_uW_cm2,
+                                matrix.reshape(-1, 3, 3))
+
+
+# Write artifacts as one indexed binary file (see binary_format.write_arrays), little-endian float64
+def write_artifacts(artifacts, artifact_file):
+    if len(set(artifacts.device_ids)) != len(artifacts.device_ids):
+        raise ValueError('Duplicate device ids')
+    header = {'version': artifact_version, 'channels': channels, 'coefficient_columns': coefficient_columns,
+              'device_ids': list(artifacts.device_ids), 'provenance': list(artifacts.provenance)}
+    arrays = {name: np.asarray(getattr(artifacts, name)).astype('<f8') for name in _shared_arrays + _device_arrays}
+    write_arrays(artifact_file, artifact_magic, header, arrays)
+
+
+# Load an artifact file, the arrays are read-only views into one memory map of the file
+def load_artifacts(artifact_file):
+    header, arrays = map_arrays(artifact_file, artifact_magic, 'TCS34725 calibration artifact')
+    if header['version'] != artifact_version:
+        raise ValueError(f"Unsupported calibration artifact version {header['version']}")
+    if header['channels'] != channels or header['coefficient_columns'] != coefficient_columns:
+        raise ValueError(f'{artifact_file} has a different channel or coefficient layout')
+    device_ids = header['device_ids']
+    return CalibrationArtifacts(device_ids, {device_id: i for i, device_id in enumerate(device_ids)},
+                                header['provenance'], *[arrays[name] for name in _shared_arrays + _device_arrays])
+
+
+# Pack artifact files (of one or many devices each) into one file, in the given order
+def pack_artifacts(artifact_files, output_file):
+    parts = [load_artifacts(artifact_file) for artifact_file in artifact_files]
+    for artifact_file, part in zip(artifact_files[1:], parts[1:]):
+        for name in _shared_arrays:
+            if not np.array_equal(getattr(part, name), getattr(parts[0], name)):
+                raise ValueError(f'{artifact_file} has a different {name} than {artifact_files[0]}')
+    device_ids = [device_id for part in parts for device_id in part.device_ids]
+    packed = CalibrationArtifacts(device_ids, None, [entry for part in parts for entry in part.provenance],
+                                  *[getattr(parts[0], name) for name in _shared_arrays],
+                                  *[np.concatenate([getattr(part, name) for part in parts]) for name in _device_arrays])
+    write_artifacts(packed, output_file)
+
+
+# Rows of device ids, a single id or an array of them
+def device_rows(artifacts, device_ids):
+    if isinstance(device_ids, str):
+        return artifacts.index[device_ids]
+    return np.array([artifacts.index[device_id] for device_id in np.ravel(device_ids)],
+                    dtype=np.intp).reshape(np.shape(device_ids))
+
+
+# Conversion of raw counts with the AGAIN (0-3) and ATIME (0-255) register values of every reading
+# and the coefficients of the device rows (see device_rows), the same outputs as convert_register_counts
+def convert_device_register_counts(artifacts, rows, red, green, blue, clear, again, atime):
+    red = np.asarray(red, dtype=np.float64)
+    green = np.asarray(green, dtype=np.float64)
+    blue = np.asarray(blue, dtype=np.float64)
+    clear = np.asarray(clear, dtype=np.float64)
+    rows = np.asarray(rows, dtype=np.intp)
+    again = np.asarray(again, dtype=np.intp)
+    atime = np.asarray(atime, dtype=np.intp)
+
+    factors = artifacts.counts_per_uW_cm2[rows, again, atime]  # (... x channel)
+    irradiance_clear = clear / factors[..., channels.index('Clear')]
+    irradiance_red = red / factors[..., channels.index('Red')]
+    irradiance_green = green / factors[..., channels.index('Green')]
+    irradiance_blue = blue / factors[..., channels.index('Blue')]
+
+    K = artifacts.coefficients[:, [coefficient_columns.index(f'K_{ch}') for ch in ['red', 'green', 'blue']]][rows]
+    lux = K[..., 0] * irradiance_red + K[..., 1] * irradiance_green + K[..., 2] * irradiance_blue
+
+    # As in convert_scaled_counts the RGB counts are divided by the Clear factor
+    rgb = np.stack(np.broadcast_arrays(red, green, blue), axis=-1) / factors[..., channels.index('Clear'), np.newaxis]
+    XYZ = np.einsum('...ij,...j->...i', artifacts.RGB_to_XYZ_matrix[rows], rgb)
+    X, Y, Z = XYZ[..., 0], XYZ[..., 1], XYZ[..., 2]
+    x, y = calculate_chromaticity(X, Y, Z)
+
+    return {
+        'irradiance_red': irradiance_red,
+        'irradiance_green': irradiance_green,
+        'irradiance_blue': irradiance_blue,
+        'irradiance_clear': irradiance_clear,
+        'lux': lux,
+        'X': X,
+        'Y': Y,
+        'Z': Z,
+        'x': x,
+        'y': y,
+        'saturated': saturated(atime, red, green, blue, clear)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build, pack and inspect binary calibration artifacts.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    build = commands.add_parser('build', help='calibrate devices into one artifact file')
+    source = build.add_mutually_exclusive_group()
+    source.add_argument('--manifest', help='CSV with device_id, responsivity_file and leds_file columns')
+    source.add_argument('--devices-dir', help='directory with one sub directory per device')
+    build.add_argument('--responsivity', help='responsivity CSV or .dig file of a single device')
+    build.add_argument('--device-id', help='id of the single device (default: the responsivity file name)')
+    build.add_argument('--cmf', default=default_cmf_file, help='CIE 1931 2° color-matching functions CSV')
+    build.add_argument('--photopic', default=default_photopic_file, help='CIE photopic V(λ) CSV')
+    build.add_argument('-j', '--workers', type=int, default=None, help='number of worker processes')
+    build.add_argument('-o', '--output', default='tcs34725.cal', help='artifact file')
+
+    pack = commands.add_parser('pack', help='pack artifact files into one indexed file')
+    pack.add_argument('artifact_files', nargs='+')
+    pack.add_argument('-o', '--output', default='fleet.cal', help='artifact file')
+
+    show = commands.add_parser('show', help='print the devices and coefficients of an artifact file')
+    show.add_argument('artifact_file')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        if args.manifest:
+            devices = read_manifest(args.manifest)
+        elif args.devices_dir:
+            devices = scan_device_directories(args.devices_dir)
+        else:
+            responsivity_file = args.responsivity or default_responsivity_file
+            device_id = args.device_id or os.path.splitext(os.path.basename(responsivity_file))[0]
+            devices = [{'device_id': device_id, 'responsivity_file': responsivity_file, 'leds_file': None}]
+        write_artifacts(build_artifacts(devices, cmf_file=args.cmf, photopic_file=args.photopic,
+                                        max_workers=args.workers), args.output)
+        print(f'Written {len(devices)} devices to {args.output}')
+    elif args.command == 'pack':
+        pack_artifacts(args.artifact_files, args.output)
+        print(f'Written {args.output}')
+    else:
+        artifacts = load_artifacts(args.artifact_file)
+        print('device_id,' + ','.join(coefficient_columns) + ',responsivity_sha256')
+        for device_id, row, provenance in zip(artifacts.device_ids, artifacts.coefficients, artifacts.provenance):
+            print(','.join([device_id] + [repr(float(value)) for value in row] + [provenance['responsivity']]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+import argparse
+from collections import namedtuple
+
+import numpy as np
+
+from .acquisition import simulate_raw_counts
+from .calibration import counts_per_uW_cm2
+from .light_sources import scenario_spectra
+from .responsivity import default_responsivity_file, load_responsivity_grid
+from .settings import (atimes, gains, integration_time_table, min_clear_count, saturated, saturation_count_table,
+                       scale_table, under_range)
+
+# Band of the largest channel, as fractions of the saturation count, the predictive controller
+# aims at: enough counts for a low noise reading and headroom for the light to get brighter
+default_low_fraction = 0.1
+default_high_fraction = 0.8
+
+# A saturated reading only gives a lower bound of the signal, it is assumed to be this many
+# times the saturation count
+saturation_backoff = 16
+
+# Result of simulate_traces for every trace: the fraction of valid readings, the latency after
+# every light step in seconds (NaN if it never converged) and the readings per second
+TraceReport = namedtuple('TraceReport', ['valid_fraction', 'latencies', 'readings_per_second', 'readings'])
+
+
+# Predicts the AGAIN/ATIME of the next reading in one step from the current reading
+#
+# The counts of the current reading are scaled back to 1x gain and 2.4 ms and the largest channel
+# is predicted for every candidate setting. Of the settings that put it inside the band of
+# low_fraction to high_fraction of their saturation count the one with the shortest integration
+# time (then the highest gain) wins, which keeps the sample rate up. Without one in the band the
+# largest scale below high_fraction is taken, and when even the smallest scale saturates the
+# smallest scale. Readings are evaluated in blocks against all candidates at once.
+class PredictiveAutoRange:
+    def __init__(self, low_fraction=default_low_fraction, high_fraction=default_high_fraction,
+                 max_integration_time=153.6, min_integration_time=2.4, block_size=4096):
+        again, atime = np.meshgrid(np.arange(len(gains)), atimes, indexing='ij')
+        again, atime = again.ravel(), atime.ravel()
+        integration_time = integration_time_table[atime]
+        allowed = (integration_time <= max_integration_time + 1e-9) & (integration_time >= min_integration_time - 1e-9)
+        self.again, self.atime = again[allowed], atime[allowed]
+
+        self.scale = scale_table[self.again, self.atime]
+        self.low = low_fraction * saturation_count_table[self.atime]
+        self.high = high_fraction * saturation_count_table[self.atime]
+        # Preference inside the band: fewer cycles first, then the larger scale
+        self.band_preference = -(256 - self.atime) * 1e5 + self.scale
+        self.block_size = block_size
+
+    # AGAIN and ATIME of the next reading for a batch of readings and their current settings
+    def next_settings(self, clear, red, green, blue, again, atime, min_clear=min_clear_count):
+        clear, red, green, blue, again, atime = np.broadcast_arrays(clear, red, green, blue, again, atime)
+        counts = np.max(np.stack([clear, red, green, blue]), axis=0).astype(np.float64)
+        again = again.astype(np.intp)
+        atime = atime.astype(np.intp)
+        limit = saturation_count_table[atime]
+        counts = np.where(counts >= limit, limit * saturation_backoff, counts)
+        counts = np.where(under_range(clear, min_clear), np.maximum(counts, 1), counts)
+        counts_1x = (counts / scale_table[again, atime]).ravel()
+
+        choice = np.empty(len(counts_1x), dtype=np.intp)
+        for start in range(0, len(counts_1x), self.block_size):
+            predicted = counts_1x[start:start + self.block_size, np.newaxis] * self.scale
+            fits = predicted <= self.high
+            in_band = fits & (predicted >= self.low)
+            score = np.where(in_band, 2e10 + self.band_preference, np.where(fits, 1e10 + self.scale, -self.scale))
+            choice[start:start + self.block_size] = np.argmax(score, axis=1)
+        choice = choice.reshape(counts.shape)
+        return self.again[choice], self.atime[choice]
+
+
+# The usual reactive controller: one gain step down when saturated, one step up when too dark,
+# the integration time only changes (halved/doubled) at the ends of the gain range
+class SteppingAutoRange:
+    def __init__(self, low_fraction=default_low_fraction, max_integration_time=153.6, min_integration_time=2.4):
+        self.low_fraction = low_fraction
+        self.max_cycles = int(round(max_integration_time / 2.4))
+        self.min_cycles = int(round(min_integration_time / 2.4))
+
+    def next_settings(self, clear, red, green, blue, again, atime, min_clear=min_clear_count):
+        counts = np.max(np.stack(np.broadcast_arrays(clear, red, green, blue)), axis=0)
+        again = np.asarray(again, dtype=np.intp)
+        atime = np.asarray(atime, dtype=np.intp)
+        limit = saturation_count_table[atime]
+        cycles = 256 - atime
+
+        down = counts >= limit
+        up = ~down & ((counts < self.low_fraction * limit) | under_range(clear, min_clear))
+        next_again = np.where(down, again - 1, np.where(up, again + 1, again))
+        next_cycles = np.where(down & (next_again < 0), np.maximum(cycles // 2, self.min_cycles),
+                               np.where(up & (next_again >= len(gains)), np.minimum(cycles * 2, self.max_cycles),
+                                        cycles))
+        return np.clip(next_again, 0, len(gains) - 1), 256 - next_cycles
+
+
+# Replay light traces through a controller, all traces in lockstep one reading at a time
+#
+# timestamps (s) are shared by all traces, irradiance is (trace x sample) in µW/cm² and
+# counts_per_uW the (trace x channel) counts at 1x/2.4 ms per µW/cm² of each trace's light
+# (acquisition.counts_per_uW_cm2). Every reading takes the irradiance at the middle of its
+# integration window. A reading is valid when it is neither saturated nor under-range; the
+# latency of a light step (irradiance changing by more than step_ratio between samples) is
+# the time until the end of the first valid reading whose integration started after the step.
+def simulate_traces(controller, timestamps, irradiance, counts_per_uW, again=0, atime=246, noise=0.01,
+                    step_ratio=2.0, seed=0):
+    rng = np.random.default_rng(seed)
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    irradiance = np.atleast_2d(np.asarray(irradiance, dtype=np.float64))
+    counts_per_uW = np.atleast_2d(np.asarray(counts_per_uW, dtype=np.float64))
+    traces = len(irradiance)
+    rows = np.arange(traces)
+
+    again = np.broadcast_to(np.asarray(again, dtype=np.intp), (traces,)).copy()
+    atime = np.broadcast_to(np.asarray(atime, dtype=np.intp), (traces,)).copy()
+    start = np.full(traces, timestamps[0])
+    starts, ends, valids = [], [], []
+    active = start < timestamps[-1]
+    while np.any(active):
+        duration = integration_time_table[atime] / 1000
+        middle = np.minimum(start + duration / 2, timestamps[-1])
+        sample = np.clip(np.searchsorted(timestamps, middle, side='right') - 1, 0, len(timestamps) - 1)
+        counts = simulate_raw_counts(counts_per_uW, irradiance[rows, sample], again, atime, noise, rng)
+        clear, red, green, blue = counts.T  # channels ordered like responsivity.channels
+
+        valid = ~(saturated(atime, clear, red, green, blue) | under_range(clear))
+        starts.append(np.where(active, start, np.nan))
+        ends.append(start + duration)
+        valids.append(valid & active)
+
+        again, atime = controller.next_settings(clear, red, green, blue, again, atime)
+        start = start + duration
+        active = start < timestamps[-1]
+
+    starts = np.array(starts).T  # (trace x reading)
+    ends = np.array(ends).T
+    valids = np.array(valids).T
+    readings = np.sum(~np.isnan(starts), axis=1)
+
+    reports = []
+    for trace in range(traces):
+        ratio = irradiance[trace, 1:] / np.maximum(irradiance[trace, :-1], 1e-30)
+        steps = timestamps[1:][(ratio > step_ratio) | (ratio < 1 / step_ratio)]
+        latencies = np.full(len(steps), np.nan)
+        valid_starts = starts[trace][valids[trace]]
+        valid_ends = ends[trace][valids[trace]]
+        for i, step in enumerate(steps):
+            after = np.searchsorted(valid_starts, step)
+            if after < len(valid_starts):
+                latencies[i] = valid_ends[after] - step
+        duration = timestamps[-1] - timestamps[0]
+        reports.append(TraceReport(valids[trace].sum() / readings[trace], latencies, readings[trace] / duration,
+                                   readings[trace]))
+    return reports
+
+
+# Step traces of random light levels, log-uniform between low and high µW/cm², each level held
+# for hold seconds, sampled every sample_time seconds
+def step_traces(traces, duration, hold=0.5, low=0.01, high=1000.0, sample_time=0.001, seed=0):
+    rng = np.random.default_rng(seed)
+    timestamps = np.arange(0, duration + sample_time / 2, sample_time)
+    levels = np.exp(rng.uniform(np.log(low), np.log(high), (traces, int(np.ceil(duration / hold)) + 1)))
+    return timestamps, levels[:, (timestamps // hold).astype(np.intp)]
+
+
+# Read a recorded trace CSV with a timestamp column (s) and one irradiance column (µW/cm²) per trace
+def read_traces(trace_file):
+    data = np.genfromtxt(trace_file, delimiter=',', names=True)
+    columns = [name for name in data.dtype.names if name != 'timestamp']
+    return data['timestamp'], np.array([data[name] for name in columns])
+
+
+def _summary(name, reports):
+    latencies = np.concatenate([report.latencies for report in reports])
+    converged = latencies[~np.isnan(latencies)]
+    valid = np.mean([report.valid_fraction for report in reports])
+    rate = np.mean([report.readings_per_second for report in reports])
+    line = f'{name}: {valid:.1%} valid readings, {rate:.0f} readings/s'
+    if len(latencies):
+        line += (f', latency after {len(latencies)} light steps: median {np.median(converged) * 1000:.1f} ms, '
+                 f'p95 {np.percentile(converged, 95) * 1000:.1f} ms, '
+                 f'{np.mean(np.isnan(latencies)):.1%} never converged') if len(converged) else ', never converged'
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay light traces through the predictive and the stepping '
+                                                 'auto-range controller.')
+    parser.add_argument('traces', nargs='?', help='CSV with timestamp (s) and irradiance (µW/cm²) columns, '
+                                                  'random step traces if omitted')
+    parser.add_argument('--count', type=int, default=100, help='number of random traces')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds of every random trace')
+    parser.add_argument('--responsivity', default=default_responsivity_file, help='responsivity CSV or .dig file')
+    parser.add_argument('--max-integration-time', type=float, default=153.6, help='ms')
+    args = parser.parse_args()
+
+    if args.traces:
+        timestamps, irradiance = read_traces(args.traces)
+    else:
+        timestamps, irradiance = step_traces(args.count, args.duration)
+
+    # Every trace gets one of the scenario lights
+    wavelengths, responsivity = load_responsivity_grid(None, args.responsivity)
+    spectra, _ = scenario_spectra(wavelengths)
+    chosen = np.random.default_rng(0).choice(len(spectra), size=len(irradiance))
+    counts_per_uW = counts_per_uW_cm2(spectra[chosen], wavelengths, responsivity)
+
+    for name, controller in [('predictive', PredictiveAutoRange(max_integration_time=args.max_integration_time)),
+                             ('stepping', SteppingAutoRange(max_integration_time=args.max_integration_time))]:
+        _summary(name, simulate_traces(controller, timestamps, irradiance, counts_per_uW))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+# Arrays start on 64 byte boundaries, so every mapped array is aligned for vectorized access
+array_alignment = 64
+
+
+# Write a file atomically: write(f) fills a temporary file in the same directory, which then
+# replaces path, so concurrent jobs never see a partial file. The directory is created if needed.
+def atomic_write(path, write):
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_file = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        # mkstemp creates the file as private, give it the permissions of a regular new file
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_file, 0o666 & ~umask)
+        os.replace(tmp_file, path)
+    except BaseException:
+        os.unlink(tmp_file)
+        raise
+
+
+# Digests of the files hashed by this process, keyed by absolute path, with the modification time
+# and size the file had when it was hashed
+_file_hashes = {}
+
+
+# SHA-256 hex digest of a file's content, read in blocks so large files never sit in memory
+#
+# The digest is reused while the file keeps its modification time and size, so repeated cache
+# lookups of an unchanged file only stat it.
+def hash_file(path, block_size=1 << 20):
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    cached = _file_hashes.get(path)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    _file_hashes[path] = (signature, digest.hexdigest())
+    return digest.hexdigest()
+
+
+def _aligned(size):
+    return -(-size // array_alignment) * array_alignment
+
+
+# Write arrays as a self-describing binary file: magic, header length (little-endian uint32), JSON
+# header, then the aligned arrays
+#
+# The header gets an 'arrays' entry with the dtype, shape and offset (from the end of the header)
+# of every array. Arrays are stored little-endian whatever the byte order of the host, so files
+# can be mapped on any machine. The file is written with atomic_write, so readers never map a partial one.
+def write_arrays(path, magic, header, arrays):
+    arrays = {name: np.ascontiguousarray(array, dtype=np.asarray(array).dtype.newbyteorder('<'))
+              for name, array in arrays.items()}
+    header = dict(header, arrays={})
+    offset = 0
+    for name, array in arrays.items():
+        header['arrays'][name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset += _aligned(array.nbytes)
+
+    header_bytes = json.dumps(header).encode()
+    data_start = _aligned(len(magic) + 4 + len(header_bytes))
+
+    def write(f):
+        f.write(magic)
+        f.write(np.array(len(header_bytes), dtype='<u4').tobytes())
+        f.write(header_bytes)
+        for name, array in arrays.items():
+            f.seek(data_start + header['arrays'][name]['offset'])
+            f.write(array.tobytes())
+        f.truncate(data_start + offset)
+
+    atomic_write(path, write)
+
+
+# Read the header of a file written by write_arrays and map its arrays read-only
+#
+# The whole file is one memory map and the arrays are views into it, so processes mapping the
+# same file share its pages. Returns the header and a dict of name to array.
+def map_arrays(path, magic, kind):
+    with open(path, 'rb') as f:
+        if f.read(len(magic)) != magic:
+            raise ValueError(f'{path} is not a {kind} file')
+        header_length = int(np.frombuffer(f.read(4), dtype='<u4')[0])
+        header = json.loads(f.read(header_length))
+
+    data_start = _aligned(len(magic) + 4 + header_length)
+    arrays = {}
+    if header['arrays']:
+        buffer = np.memmap(path, dtype=np.uint8, mode='r')
+        for name, spec in header['arrays'].items():
+            arrays[name] = np.ndarray(tuple(spec['shape']), dtype=spec['dtype'], buffer=buffer,
+                                      offset=data_start + spec['offset'])
+    return header, arrays
@@ -0,0 +1,267 @@
+import numpy as np
+
+from .converter import calculate_scale, graph_conversion_factor
+from .curve_features import curve_features, pchip_curves, pchip_features, pchip_integrals
+from .integration import adaptive_grid, integrate_spectra, trapezoid_between, trapezoid_weights
+from .light_sources import gaussian, gaussian_leds
+from .responsivity import channels, interpolate_responsivity, load_responsivity_grid, read_responsivity, \
+    wavelength_grid, default_responsivity_file
+
+# Dominant wavelengths and halfwidths of the datasheet LEDs, with the Clear channel counts/µW/cm²
+# used to scale the unitless graph (irradiation/calculate_conversion_factor_for_graph_data_to_µm_per_cm2_response_by_simulation.py)
+graph_reference_leds = {
+    'Blue': {'center': 465, 'halfwidth': 22, 'counts_per_uW_cm2': 13.8},
+    'Green': {'center': 525, 'halfwidth': 35, 'counts_per_uW_cm2': 16.6},
+    'Red': {'center': 615, 'halfwidth': 15, 'counts_per_uW_cm2': 19.5}
+}
+
+# Same LEDs with the Clear channel counts/µW/cm² used for the channel simulation
+# (CIE1931/calculate_counts_µm_cm2_per_color_channel_for_reference_lights_by_simulation.py)
+channel_reference_leds = {
+    'Blue': {'center': 465, 'halfwidth': 22, 'counts_per_uW_cm2': 16.6},
+    'Green': {'center': 525, 'halfwidth': 35, 'counts_per_uW_cm2': 20.0},
+    'Red': {'center': 615, 'halfwidth': 15, 'counts_per_uW_cm2': 23.4}
+}
+
+# The responsivity graph of the datasheet is measured at 16x gain and 24 ms
+graph_gain = 16
+graph_integration_time = 24.0  # ms
+
+# For standard illuminant D65 (average daylight), the conversion is approximately 0.0079 W/m² per lux
+irradiance_per_lux = 0.0079  # W/m² per lux
+
+# FWHM windows of the channel and lux factors: 'analytic' takes the exact edges of the PCHIP
+# interpolant (curve_features), 'sampled' the grid points at or above half max like the scripts
+fwhm_methods = ['analytic', 'sampled']
+
+
+# Counts at 1x gain and 2.4 ms per µW/cm² per unit of the responsivity graph
+def graph_counts_scale(conversion_factor=graph_conversion_factor):
+    return conversion_factor / calculate_scale(graph_gain, graph_integration_time)
+
+
+# Counts at 1x gain and 2.4 ms per µW/cm² of spectra with a radiant power of 1, shape (spectrum x channel)
+def counts_per_uW_cm2(spectra, wavelengths, responsivity, conversion_factor=graph_conversion_factor):
+    return integrate_spectra(spectra, wavelengths, responsivity) * graph_counts_scale(conversion_factor)
+
+
+# Grid refined by integration.adaptive_grid for the responsivity curves and the extra curves
+#
+# extra_curves is an optional function of the wavelengths returning more (curve x wavelength)
+# values to refine for, e.g. LED emission curves times the responses. Half-max crossings end
+# up on 0.1 nm intervals, so FWHM edges are resolved like on a 0.1 nm grid.
+def adaptive_responsivity_grid(responsivity_file, start, stop, extra_curves=None):
+    wavelengths_sensor, responsivity_sensor = read_responsivity(responsivity_file)
+
+    def curves(wavelengths):
+        responses = interpolate_responsivity(wavelengths_sensor, responsivity_sensor, wavelengths, extrapolate=False)
+        if extra_curves is None:
+            return responses
+        return np.vstack([responses, extra_curves(wavelengths, responses)])
+
+    return adaptive_grid(curves, start, stop).wavelengths
+
+
+# Wavelength grid the simulation scripts use: 1 nm steps starting at the first sample
+#
+# A smaller step (e.g. 0.1 nm) covers the same range, FWHM edges then snap to that step. With
+# step='adaptive' the grid is refined for the responses and, with leds, their products with
+# the LED emission curves.
+def simulation_grid(responsivity_file=default_responsivity_file, step=1, leds=None):
+    wavelengths_sensor, _ = read_responsivity(responsivity_file)
+    if step == 'adaptive':
+        def led_responses(wavelengths, responses):
+            emission_curves = led_emission_curves(wavelengths, leds)
+            return (emission_curves[:, np.newaxis, :] * responses).reshape(-1, len(wavelengths))
+
+        return adaptive_responsivity_grid(responsivity_file, wavelengths_sensor.min(), wavelengths_sensor.max(),
+                                          led_responses if leds else None)
+    if step == 1:
+        return np.arange(wavelengths_sensor.min(), wavelengths_sensor.max() + 1, 1)
+    return wavelength_grid(wavelengths_sensor.min(), wavelengths_sensor.max(), step)
+
+
+# Wavelength grid of the counts per µW/cm² script: whole nanometres over the sampled range
+#
+# Other steps (nm) or 'adaptive' cover the same range.
+def integer_grid(responsivity_file=default_responsivity_file, step=1):
+    wavelengths_sensor, _ = read_responsivity(responsivity_file)
+    start, stop = int(wavelengths_sensor.min()), int(wavelengths_sensor.max())
+    if step == 'adaptive':
+        return adaptive_responsivity_grid(responsivity_file, start, stop)
+    if step == 1:
+        return np.arange(start, stop + 1, 1)
+    return wavelength_grid(start, stop, step)
+
+
+# Gaussian emission curves of all LEDs as a (LED x wavelength) matrix
+def led_emission_curves(wavelengths, leds, normalized=False):
+    return gaussian_leds(wavelengths, [led['center'] for led in leds.values()],
+                         [led['halfwidth'] for led in leds.values()], normalized)
+
+
+# Function to calculate unitless average response based on the LED's emission curve
+def calculate_unitless_avg_response(led, wavelengths, channel_response):
+    emission_curve = gaussian(wavelengths, led['center'], led['halfwidth'])
+    weighted_response = emission_curve * channel_response
+    return np.trapezoid(weighted_response, wavelengths) / np.trapezoid(emission_curve, wavelengths)
+
+
+# Function to determine FWHM of a given channel, as the range of wavelengths at or above half max
+def calculate_fwhm(wavelengths, response):
+    half_max = np.max(response) / 2
+    indices = np.where(response >= half_max)[0]
+    if len(indices) > 0:
+        return wavelengths[indices[0]:indices[-1] + 1]
+    else:
+        return np.array([])
+
+
+# Conversion factor of the unitless graph to counts per µW/cm², per LED and the median of them
+def calculate_graph_conversion_factor(wavelengths, clear_response, leds=graph_reference_leds):
+    emission_curves = led_emission_curves(wavelengths, leds)
+    integrals = integrate_spectra(emission_curves, wavelengths, [clear_response, np.ones_like(wavelengths)])
+    unitless_avg_responses = integrals[:, 0] / integrals[:, 1]
+    counts = np.array([led['counts_per_uW_cm2'] for led in leds.values()])
+    led_conversion_factors = dict(zip(leds, (counts / unitless_avg_responses).tolist()))
+    return led_conversion_factors, float(np.median(list(led_conversion_factors.values())))
+
+
+# Counts per µW/cm² per channel from the ratio of each channel's FWHM response to the Clear channel
+#
+# With fwhm='analytic' each response is integrated between the exact FWHM edges with the
+# antiderivative of the PCHIP interpolant of the samples, so the samples are best the measured
+# ones. 'sampled' integrates the samples at or above half max with the trapezoid rule like the
+# counts per µW/cm² script. The result is rescaled from the graph's gain and integration time
+# to the given ones.
+def calculate_channel_conversion_factors(wavelengths, responsivity, conversion_factor,
+                                         gain=1, integration_time=2.4, fwhm='analytic'):
+    if fwhm == 'analytic':
+        pchip = pchip_curves(wavelengths, [responsivity[ch] for ch in channels])
+        features = pchip_features(pchip)
+        total_responses = dict(zip(channels, pchip_integrals(pchip, features.fwhm_start, features.fwhm_end)))
+    elif fwhm == 'sampled':
+        total_responses = {}
+        for ch in channels:
+            fwhm_range = calculate_fwhm(wavelengths, responsivity[ch])
+            mask = (wavelengths >= fwhm_range.min()) & (wavelengths <= fwhm_range.max())
+            total_responses[ch] = np.trapezoid(responsivity[ch][mask], wavelengths[mask])
+    else:
+        raise ValueError(f'Unknown FWHM method {fwhm!r}, use one of {fwhm_methods}')
+
+    scale = (gain / graph_gain) * (integration_time / graph_integration_time)
+    return {ch: float(conversion_factor * total_responses[ch] / total_responses['Clear'] * scale) for ch in channels}
+
+
+# Interpolate a response using PCHIP interpolation, 0 outside of the sampled range
+def interpolate_response(wavelengths, response, wavelengths_interp):
+    from scipy.interpolate import PchipInterpolator
+
+    pchip = PchipInterpolator(wavelengths, response, extrapolate=False)
+    return np.nan_to_num(pchip(wavelengths_interp))
+
+
+# Lux per µW/cm² for the Red, Green and Blue channels
+#
+# The channel responses are scaled relative to each other with the counts per µW/cm² factors,
+# normalized with the global maximum and weighted with V(λ) over each channel's FWHM. The
+# normalized weights distribute the D65 irradiance to lux conversion. step is the grid step
+# (nm) or 'adaptive', see integer_grid. With fwhm='analytic' the windows end at the exact FWHM
+# edges of the measured curves and response × V(λ) is integrated with the trapezoid rule up to
+# them, 'sampled' sums the grid points at or above half max like the lux script.
+def calculate_lux_factors(responsivity_file, channel_conversion_factors, wavelengths_cie, V_lambda,
+                          irradiance_per_lux=irradiance_per_lux, step=1, fwhm='analytic'):
+    if fwhm not in fwhm_methods:
+        raise ValueError(f'Unknown FWHM method {fwhm!r}, use one of {fwhm_methods}')
+    wavelengths_sensor, responsivity_sensor = read_responsivity(responsivity_file)
+    rgb = ['Red', 'Green', 'Blue']
+    scales = np.array([1 / channel_conversion_factors[ch] for ch in rgb])
+
+    # Normalize the scaled spectral responses using the global maximum of the samples
+    rgb_rows = [channels.index(ch) for ch in rgb]
+    global_max = np.max(np.abs(responsivity_sensor[rgb_rows] * scales[:, np.newaxis]))
+
+    wavelength_min = max(wavelengths_sensor.min(), wavelengths_cie.min())
+    wavelength_max = min(wavelengths_sensor.max(), wavelengths_cie.max())
+    if step == 'adaptive':
+        wavelengths = adaptive_responsivity_grid(responsivity_file, wavelength_min, wavelength_max)
+        # Trapezoid weights on the uneven grid, on uniform grids a plain sum like the lux script
+        # (the step cancels in the normalization)
+        sample_weights = trapezoid_weights(wavelengths)
+    else:
+        wavelengths = np.arange(wavelength_min, wavelength_max + 1, 1) if step == 1 else \
+            wavelength_grid(wavelength_min, wavelength_max, step)
+        sample_weights = np.ones_like(wavelengths)
+
+    # PCHIP is scale invariant, so the cached grid can be scaled after the interpolation
+    _, responsivity = load_responsivity_grid(wavelengths, responsivity_file, extrapolate=False)
+    responses = responsivity[rgb_rows] * (scales / global_max)[:, np.newaxis]
+    V_lambda_interp = interpolate_response(wavelengths_cie, V_lambda, wavelengths)
+
+    if fwhm == 'analytic':
+        features = curve_features(wavelengths_sensor, responsivity_sensor[rgb_rows])
+        factors = dict(zip(rgb, trapezoid_between(wavelengths, responses * V_lambda_interp,
+                                                  features.fwhm_start, features.fwhm_end)))
+    else:
+        factors = {}
+        for ch, response in zip(rgb, responses):
+            fwhm_range = calculate_fwhm(wavelengths, response)
+            if len(fwhm_range) >= 2:
+                idx_start = np.searchsorted(wavelengths, fwhm_range[0])
+                idx_end = np.searchsorted(wavelengths, fwhm_range[-1]) + 1
+                factors[ch] = np.sum(response[idx_start:idx_end] * V_lambda_interp[idx_start:idx_end] *
+                                     sample_weights[idx_start:idx_end])
+            else:
+                factors[ch] = 0.0
+
+    total_factor = sum(factors.values())
+    K_total = 1 / (irradiance_per_lux * 100)  # lux per µW/cm²
+    return {ch: float(K_total * factors[ch] / total_factor) for ch in rgb}
+
+
+# Counts per µW/cm² of every channel for each LED, scaled by the datasheet's Clear counts
+def calculate_led_channel_counts(wavelengths, responsivity, leds=channel_reference_leds):
+    emission_curves = led_emission_curves(wavelengths, leds)
+    responses = np.vstack([[responsivity[ch] for ch in channels], np.ones_like(wavelengths)])
+    integrals = integrate_spectra(emission_curves, wavelengths, responses)
+    unitless_avg_responses = integrals[:, :-1] / integrals[:, -1:]
+
+    counts = np.array([led['counts_per_uW_cm2'] for led in leds.values()])
+    conversion_factors = counts / unitless_avg_responses[:, channels.index('Clear')]
+    channel_counts = unitless_avg_responses * conversion_factors[:, np.newaxis]
+    return {led_name: {ch.lower(): float(value) for ch, value in zip(channels, row)}
+            for led_name, row in zip(leds, channel_counts)}
+
+
+# Function to normalize the RGB values based on the Clear channel
+def normalize_rgb(led_data):
+    normalized_values = {}
+    for led_color, values in led_data.items():
+        clear = values["clear"]
+        normalized_values[led_color] = {
+            "red": values["red"] / clear,
+            "green": values["green"] / clear,
+            "blue": values["blue"] / clear
+        }
+    return normalized_values
+
+
+# XYZ tristimulus values of each LED with an emission curve normalized to an area of 1
+def calculate_led_xyz(wavelengths, cmfs, leds=channel_reference_leds):
+    XYZ = integrate_spectra(led_emission_curves(wavelengths, leds, normalized=True), wavelengths, cmfs)
+    return dict(zip(leds, XYZ.tolist()))
+
+
+# Transformation matrix C = (S⁻¹ · T)ᵀ from the LEDs' XYZ values (T) and normalized RGB values (S)
+#
+# The LEDs are the rows of S and T, so XYZ = C · rgb for column vectors. Raises a ValueError
+# unless every LED maps back to its own XYZ values.
+def calculate_rgb_to_xyz_matrix(led_xyz, normalized_rgb):
+    led_names = list(led_xyz)
+    T = np.array([led_xyz[name] for name in led_names])
+    S = np.array([[normalized_rgb[name][ch] for ch in ['red', 'green', 'blue']] for name in led_names])
+    C = np.linalg.solve(S, T).T
+    round_trip_error = np.max(np.abs(S @ C.T - T))
+    if round_trip_error > 1e-9 * max(np.max(np.abs(T)), 1):
+        raise ValueError(f"RGB to XYZ matrix doesn't reproduce the LEDs' XYZ values (error {round_trip_error:.3g})")
+    return C
@@ -0,0 +1,25 @@
+import os
+
+import numpy as np
+
+# The CIE datasets aren't part of the repository, download them from cie.co.at into calibration_data/
+calibration_data_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'calibration_data')
+default_cmf_file = os.path.join(calibration_data_dir, 'CIE_xyz_1931_2deg.csv')
+default_photopic_file = os.path.join(calibration_data_dir, 'CIE_sle_photopic.csv')
+
+
+# Load CIE 1931 color-matching functions as wavelengths and a (3 x wavelength) matrix of x_bar, y_bar, z_bar
+def load_cie_cmfs(cmf_file=default_cmf_file):
+    cie_data = np.loadtxt(cmf_file, delimiter=',')
+    return cie_data[:, 0], cie_data[:, 1:4].T
+
+
+# Load the CIE photopic luminous efficiency function V(λ)
+def load_photopic(photopic_file=default_photopic_file):
+    cie_data = np.loadtxt(photopic_file, delimiter=',')
+    return cie_data[:, 0], cie_data[:, 1]
+
+
+# Resample the color-matching functions linearly to the wavelengths, 0 outside of the dataset
+def interpolate_cmfs(wavelengths_cie, cmfs, wavelengths):
+    return np.array([np.interp(wavelengths, wavelengths_cie, cmf, left=0, right=0) for cmf in cmfs])
@@ -0,0 +1,225 @@
+import json
+import os
+
+import numpy as np
+
+from .settings import inverse_scale_table, min_clear_count, reference_gain, reference_integration_time, saturated, \
+    scale_table, under_range
+
+# Columns of a coefficient row: the graph conversion factor, the counts per µW/cm² of every channel
+# at 1x gain and 2.4 ms, the lux per µW/cm² of the R, G and B channels, the RGB to XYZ matrix and the
+# fitted counts to XYZ matrix (IR-rejected R, G, B and Clear counts at 1x gain and 2.4 ms), row by row
+coefficient_columns = [
+    'conversion_factor',
+    'C_clear', 'C_red', 'C_green', 'C_blue',
+    'K_red', 'K_green', 'K_blue',
+    'M_00', 'M_01', 'M_02', 'M_10', 'M_11', 'M_12', 'M_20', 'M_21', 'M_22',
+    'F_00', 'F_01', 'F_02', 'F_03', 'F_10', 'F_11', 'F_12', 'F_13', 'F_20', 'F_21', 'F_22', 'F_23'
+]
+
+# Coefficients used when no calibration is loaded, the outputs of the scripts for the datasheet curves
+#
+# The inputs were calibration_data/TCS34725_spectral_responsivity.csv (all scripts), the CIE 018:2019
+# photopic V(λ) CIE_sle_photopic.csv (lux) and the CIE 1931 2° color-matching functions
+# CIE_xyz_1931_2deg.csv (CIE1931). The pipeline with the parameters {"fwhm": "sampled", "grid_step": 1}
+# reproduces conversion_factor and the C_* factors exactly from the responsivity alone. The K_* factors
+# and the matrix depend on the revision of the CIE tables, which aren't shipped: with the current tables
+# the same run gives K = 0.44478, 0.73310, 0.08794, so prefer the outputs of a pipeline run on the tables at hand.
+default_coefficients = {
+    # Clear counts per µW/cm² per unit of the unitless responsivity graph at 16x gain and 24 ms
+    # (irradiation/calculate_conversion_factor_for_graph_data_to_µm_per_cm2_response_by_simulation.py)
+    'conversion_factor': 20.797879440786556,
+    # Counts per µW/cm² at 1x gain and 2.4 ms integration time, the Clear channel is the reference
+    # of the graph, so its ratio is 1.0 (irradiation/calculate_counts_per_µw_per_cm2_from_spectral_responsivity.py)
+    'C_clear': 20.797879440786556 / 16 * (2.4 / 24.0),
+    'C_red': 0.030895152730118627,
+    'C_green': 0.032402966993759885,
+    'C_blue': 0.03695911040578352,
+    # Lux per µW/cm² (lux/calculate_irradiation_to_lux_conversion_factors_with_CIE_018_2019_responses.py)
+    'K_red': 0.444659052013151,
+    'K_green': 0.732527152367359,
+    'K_blue': 0.088636580429616,
+    # Clear-normalized RGB to XYZ (CIE1931/calculate_RGB_to_XYZ_conversion_matrix.py)
+    'M_00': 0.99806043, 'M_01': 0.01611367, 'M_02': 0.27509873,
+    'M_10': 0.43455431, 'M_11': 1.1059612, 'M_12': -0.2435827,
+    'M_20': -0.15985826, 'M_21': -0.53784822, 'M_22': 1.91891665,
+    # Counts to XYZ fitted over simulated lights (fitted_xyz_matrix stage of the pipeline, current CIE tables)
+    'F_00': -1.1432828450225923, 'F_01': -7.0661972194009826, 'F_02': -7.707911814444777, 'F_03': 9.429394482713933,
+    'F_10': 2.2919816716983474, 'F_11': 10.88766011199605, 'F_12': -2.2460490397173922, 'F_13': 0.6125673844571047,
+    'F_20': -0.5248022552888741, 'F_21': -3.6594808741069476, 'F_22': 15.56416037862537, 'F_23': 0.36186624502274156,
+}
+
+# Pipeline state file (python -m tcs34725.pipeline --state ...) to load the coefficients from at import
+calibration_environment_variable = 'TCS34725_CALIBRATION'
+
+
+# Flatten the pipeline results into one coefficient row
+def coefficients_from_results(results):
+    channel_conversion_factors = results['channel_conversion_factors']['channel_conversion_factors']
+    lux_factors = results['lux_factors']['lux_factors']
+    matrix = results['rgb_to_xyz_matrix']['RGB_to_XYZ_matrix']
+    row = {'conversion_factor': results['graph_conversion_factor']['conversion_factor']}
+    for ch in ['Clear', 'Red', 'Green', 'Blue']:
+        row[f'C_{ch.lower()}'] = channel_conversion_factors[ch]
+    for ch in ['Red', 'Green', 'Blue']:
+        row[f'K_{ch.lower()}'] = lux_factors[ch]
+    for i in range(3):
+        for j in range(3):
+            row[f'M_{i}{j}'] = matrix[i][j]
+    fitted_matrix = results['fitted_xyz_matrix']['counts_to_XYZ_matrix']
+    for i in range(3):
+        for j in range(4):
+            row[f'F_{i}{j}'] = fitted_matrix[i][j]
+    return row
+
+
+# Coefficient row recorded in a pipeline state file
+def load_coefficients(state_file):
+    with open(state_file) as f:
+        state = json.load(f)
+    try:
+        return coefficients_from_results({name: recorded['outputs'] for name, recorded in state.items()})
+    except KeyError as error:
+        raise ValueError(f'{state_file} has no outputs of {error}, run the pipeline without --target') from None
+
+
+# Coefficients of the conversion: those of the state file named by TCS34725_CALIBRATION, if set
+calibration_file = os.environ.get(calibration_environment_variable) or None
+coefficients = load_coefficients(calibration_file) if calibration_file else dict(default_coefficients)
+
+# Clear counts per µW/cm² per unit of the unitless responsivity graph at 16x gain and 24 ms
+graph_conversion_factor = coefficients['conversion_factor']
+
+# Counts per µW/cm² at 1x gain and 2.4 ms integration time
+C_clear = coefficients['C_clear']
+C_red = coefficients['C_red']
+C_green = coefficients['C_green']
+C_blue = coefficients['C_blue']
+
+# Conversion factors in lux per µW/cm²
+K_red = coefficients['K_red']
+K_green = coefficients['K_green']
+K_blue = coefficients['K_blue']
+
+# Transformation matrix from Clear-normalized RGB to XYZ, XYZ = M · rgb for column vectors
+RGB_to_XYZ_matrix = np.array([[coefficients[f'M_{i}{j}'] for j in range(3)] for i in range(3)])
+
+# Counts per µW/cm² of the Clear, Red, Green and Blue channel for every setting, indexed as
+# table[again, atime, channel], the generalization of the hard-coded 16x/24 ms to 1x/2.4 ms rescale
+counts_per_uW_cm2_table = scale_table[:, :, np.newaxis] * np.array([C_clear, C_red, C_green, C_blue])
+
+
+# Scale factor of a reading relative to 1x gain and 2.4 ms integration time
+def calculate_scale(gain, integration_time):
+    return (np.asarray(gain, dtype=np.float64) / reference_gain) * \
+           (np.asarray(integration_time, dtype=np.float64) / reference_integration_time)
+
+
+# Normalize and calculate chromaticity coordinates (x, y) for a batch of XYZ values
+def calculate_chromaticity(X, Y, Z):
+    total = X + Y + Z
+    nonzero = total != 0  # Avoid division by zero, those samples get (0, 0)
+    x = np.divide(X, total, out=np.zeros_like(total), where=nonzero)
+    y = np.divide(Y, total, out=np.zeros_like(total), where=nonzero)
+    return x, y
+
+
+# Convert raw channel counts of a whole batch into irradiance (µW/cm²), lux and XYZ/xy
+#
+# All inputs are array-likes broadcast against each other, so gain and integration_time (ms)
+# can either be scalars for the whole batch or one value per reading.
+def convert_counts(red, green, blue, clear, gain=reference_gain, integration_time=reference_integration_time):
+    return convert_scaled_counts(red, green, blue, clear, 1.0 / calculate_scale(gain, integration_time))
+
+
+# Remove the IR component of a batch of raw counts with the Clear channel
+#
+# The R, G and B filters pass IR like the Clear channel, while their visible passbands add up to
+# about the Clear one, so IR ≈ (R + G + B - C) / 2. The estimate is 0 where it would be negative,
+# channels that drop below 0 when it is subtracted are clipped to 0 and flagged in 'clipped'.
+def reject_ir(red, green, blue, clear):
+    red = np.asarray(red, dtype=np.float64)
+    green = np.asarray(green, dtype=np.float64)
+    blue = np.asarray(blue, dtype=np.float64)
+    clear = np.asarray(clear, dtype=np.float64)
+
+    ir = np.maximum((red + green + blue - clear) / 2, 0)
+    result = {'ir': ir}
+    clipped = np.zeros(ir.shape, dtype=bool)
+    for name, counts in [('red', red), ('green', green), ('blue', blue), ('clear', clear)]:
+        counts = counts - ir
+        clipped |= counts < 0
+        result[name] = np.maximum(counts, 0)
+    result['clipped'] = clipped
+    return result
+
+
+# IR rejection and validity masks of a batch of raw counts with their ATIME register values
+#
+# Returns the IR-free counts and IR estimate of reject_ir plus the masks 'saturated' (any raw
+# channel at the saturation count), 'under_range' (raw Clear below min_clear), 'clipped' and
+# 'valid' (none of them).
+def preprocess_counts(red, green, blue, clear, atime, min_clear=min_clear_count):
+    result = reject_ir(red, green, blue, clear)
+    result['saturated'] = saturated(atime, red, green, blue, clear)
+    result['under_range'] = under_range(clear, min_clear)
+    result['valid'] = ~(result['saturated'] | result['under_range'] | result['clipped'])
+    return result
+
+
+# Same as convert_counts, but with the AGAIN (0-3) and ATIME (0-255) register values of every reading
+#
+# The scale of each reading is looked up in the (AGAIN x ATIME) table, so a batch mixing
+# many settings needs no splitting. The result has an additional 'saturated' mask. With
+# ir_rejection the counts go through preprocess_counts first and the result also has its
+# 'ir', 'under_range', 'clipped' and 'valid' arrays.
+def convert_register_counts(red, green, blue, clear, again, atime, inverse_scale=inverse_scale_table,
+                            ir_rejection=False, min_clear=min_clear_count):
+    inv_scale = inverse_scale[np.asarray(again, dtype=np.intp), np.asarray(atime, dtype=np.intp)]
+    if ir_rejection:
+        preprocessed = preprocess_counts(red, green, blue, clear, atime, min_clear)
+        result = convert_scaled_counts(preprocessed['red'], preprocessed['green'], preprocessed['blue'],
+                                       preprocessed['clear'], inv_scale)
+        for name in ['ir', 'saturated', 'under_range', 'clipped', 'valid']:
+            result[name] = preprocessed[name]
+        return result
+    result = convert_scaled_counts(red, green, blue, clear, inv_scale)
+    result['saturated'] = saturated(atime, red, green, blue, clear)
+    return result
+
+
+# Conversion of counts with a known inverse scale (1x/2.4 ms counts per raw count) per reading
+def convert_scaled_counts(red, green, blue, clear, inv_scale):
+    red = np.asarray(red, dtype=np.float64)
+    green = np.asarray(green, dtype=np.float64)
+    blue = np.asarray(blue, dtype=np.float64)
+    clear = np.asarray(clear, dtype=np.float64)
+    inv_scale = np.asarray(inv_scale, dtype=np.float64)
+
+    irradiance_red = red * (inv_scale / C_red)
+    irradiance_green = green * (inv_scale / C_green)
+    irradiance_blue = blue * (inv_scale / C_blue)
+    irradiance_clear = clear * (inv_scale / C_clear)
+
+    lux = K_red * irradiance_red + K_green * irradiance_green + K_blue * irradiance_blue
+
+    # The matrix expects RGB normalized by the Clear response, scaled back up by the
+    # Clear irradiance this equals dividing the RGB counts by the Clear factor
+    rgb_scale = inv_scale / C_clear
+    rgb = np.stack(np.broadcast_arrays(red * rgb_scale, green * rgb_scale, blue * rgb_scale), axis=-1)
+    XYZ = rgb @ RGB_to_XYZ_matrix.T
+    X, Y, Z = XYZ[..., 0], XYZ[..., 1], XYZ[..., 2]
+    x, y = calculate_chromaticity(X, Y, Z)
+
+    return {
+        'irradiance_red': irradiance_red,
+        'irradiance_green': irradiance_green,
+        'irradiance_blue': irradiance_blue,
+        'irradiance_clear': irradiance_clear,
+        'lux': lux,
+        'X': X,
+        'Y': Y,
+        'Z': Z,
+        'x': x,
+        'y': y
+    }
@@ -0,0 +1,123 @@
+from collections import namedtuple
+
+import numpy as np
+
+# Peak, FWHM edges and centroid of every curve, each an array with one value per curve
+CurveFeatures = namedtuple('CurveFeatures', ['peak_wavelength', 'peak', 'fwhm_start', 'fwhm_end', 'fwhm',
+                                             'centroid'])
+
+
+# PCHIP interpolant of a (curve x sample) matrix sampled at the same wavelengths
+def pchip_curves(wavelengths, responses):
+    from scipy.interpolate import PchipInterpolator
+
+    return PchipInterpolator(np.asarray(wavelengths, dtype=np.float64),
+                             np.atleast_2d(np.asarray(responses, dtype=np.float64)), axis=1, extrapolate=False)
+
+
+# Root of monotone cubic pieces c[0] t³ + c[1] t² + c[2] t + c[3] = level in [0, h], one per column
+#
+# PCHIP pieces are monotone, so a root bracketed by the piece ends is unique. All pieces are
+# solved together with Newton steps from the linear interpolation of the ends, steps leaving
+# the bracket fall back to bisection.
+def _solve_monotone_cubic(coefficients, h, level, max_iterations=50):
+    c0, c1, c2, c3 = coefficients
+    c3 = c3 - level
+
+    low = np.zeros_like(h)
+    high = h.copy()
+    value_low = c3
+    value_high = ((c0 * h + c1) * h + c2) * h + c3
+    rising = value_high >= value_low
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.where(value_high != value_low, h * value_low / (value_low - value_high), h / 2)
+    t = np.clip(t, low, high)
+    for _ in range(max_iterations):
+        value = ((c0 * t + c1) * t + c2) * t + c3
+        above = (value >= 0) == rising
+        high = np.where(above, t, high)
+        low = np.where(above, low, t)
+
+        slope = (3 * c0 * t + 2 * c1) * t + c2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            newton = t - value / slope
+        bisect = ~((newton > low) & (newton < high))
+        t_next = np.where(bisect, (low + high) / 2, newton)
+        converged = np.abs(t_next - t) <= 4 * np.spacing(h)
+        t = t_next
+        if np.all(converged):
+            break
+    return t
+
+
+# Peak, FWHM and centroid of every curve of a PCHIP interpolant, without resampling
+#
+# The pieces of a PCHIP interpolant are monotone, so the peak is the largest sample and each
+# half-max crossing lies in the one piece whose ends bracket it, where it is found by root
+# finding on that cubic. Like calculate_fwhm of the scripts the FWHM spans from the first to
+# the last wavelength at or above half the peak. The centroid ∫λ·r(λ)dλ / ∫r(λ)dλ is
+# integrated exactly from the polynomial coefficients.
+def pchip_features(pchip):
+    x = pchip.x
+    c = pchip.c.reshape(4, len(x) - 1, -1)  # (coefficient x piece x curve)
+    h = np.diff(x)
+    samples = np.concatenate([c[3], (((c[0] * h[:, np.newaxis] + c[1]) * h[:, np.newaxis] + c[2])
+                                     * h[:, np.newaxis] + c[3])[-1:]]).T  # (curve x sample)
+    curves = np.arange(samples.shape[0])
+
+    peak_index = np.argmax(samples, axis=1)
+    peak = samples[curves, peak_index]
+    half_max = peak / 2
+
+    # First and last samples at or above half max, the crossings are in the pieces outside of them
+    at_or_above = samples >= half_max[:, np.newaxis]
+    first = np.argmax(at_or_above, axis=1)
+    last = samples.shape[1] - 1 - np.argmax(at_or_above[:, ::-1], axis=1)
+
+    fwhm_start = x[first].copy()
+    rising = first > 0
+    piece = first[rising] - 1
+    fwhm_start[rising] = x[piece] + _solve_monotone_cubic(c[:, piece, curves[rising]], h[piece], half_max[rising])
+
+    fwhm_end = x[last].copy()
+    falling = last < len(x) - 1
+    piece = last[falling]
+    fwhm_end[falling] = x[piece] + _solve_monotone_cubic(c[:, piece, curves[falling]], h[piece], half_max[falling])
+
+    # ∫ r dt and ∫ t·r dt over every piece in its local coordinate t = λ - x_i
+    powers = h[:, np.newaxis] ** np.arange(1, 6)[np.newaxis]  # h¹ to h⁵
+    area = (c[0] * (powers[:, 3] / 4)[:, np.newaxis] + c[1] * (powers[:, 2] / 3)[:, np.newaxis]
+            + c[2] * (powers[:, 1] / 2)[:, np.newaxis] + c[3] * powers[:, 0:1])
+    moment = (c[0] * (powers[:, 4] / 5)[:, np.newaxis] + c[1] * (powers[:, 3] / 4)[:, np.newaxis]
+              + c[2] * (powers[:, 2] / 3)[:, np.newaxis] + c[3] * (powers[:, 1] / 2)[:, np.newaxis])
+    total_area = area.sum(axis=0)
+    centroid = (x[:-1, np.newaxis] * area + moment).sum(axis=0) / total_area
+
+    return CurveFeatures(x[peak_index], peak, fwhm_start, fwhm_end, fwhm_end - fwhm_start, centroid)
+
+
+# Integral of every curve of a PCHIP interpolant from its start to its end wavelength
+#
+# start and end have one value per curve, e.g. the FWHM edges of pchip_features. The
+# antiderivative is evaluated from the polynomial coefficients, so the integrals are exact.
+def pchip_integrals(pchip, start, end):
+    x = pchip.x
+    c = pchip.c.reshape(4, len(x) - 1, -1)  # (coefficient x piece x curve)
+    h = np.diff(x)[:, np.newaxis]
+    area = (((c[0] * h / 4 + c[1] / 3) * h + c[2] / 2) * h + c[3]) * h
+    cumulative = np.concatenate([np.zeros((1, c.shape[2])), np.cumsum(area, axis=0)])
+    curves = np.arange(c.shape[2])
+
+    def antiderivative(points):
+        points = np.asarray(points, dtype=np.float64)
+        piece = np.clip(np.searchsorted(x, points, side='right') - 1, 0, len(x) - 2)
+        t = points - x[piece]
+        c0, c1, c2, c3 = c[:, piece, curves]
+        return cumulative[piece, curves] + (((c0 * t / 4 + c1 / 3) * t + c2 / 2) * t + c3) * t
+
+    return antiderivative(end) - antiderivative(start)
+
+
+# Peak, FWHM and centroid of every curve of a (curve x sample) matrix, see pchip_features
+def curve_features(wavelengths, responses):
+    return pchip_features(pchip_curves(wavelengths, responses))
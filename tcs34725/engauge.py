@@ -0,0 +1,189 @@
+import hashlib
+import os
+from xml.parsers import expat
+
+import numpy as np
+
+from .binary_format import atomic_write, hash_file
+from .responsivity import channels, default_cache_dir
+
+# Engauge document the responsivity CSV was exported from
+default_dig_file = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'calibration_data', 'TCS34725_color_curve.dig')
+
+# Bump this when the layout of the cached files changes
+cache_version = 1
+
+# Parse the file in blocks of this size, the embedded image is never held in memory
+read_block_size = 1 << 16  # bytes
+
+
+# Pull the axis points, the curve points and the axis scales out of an Engauge .dig file
+#
+# The document is parsed as a stream: only the start tags of the coordinate system, the
+# curves and their points are handled, the character data (the base64 image) is dropped
+# by the parser without being collected or decoded. Returns the axis points as a list of
+# (screen, graph) pairs, a dict of curve name to its (point x 2) screen positions ordered
+# by the point ordinals and a dict with the 'x' and 'y' scale ('Linear' or 'Log').
+def read_dig_points(dig_file=default_dig_file):
+    axis_points = []
+    curves = {}
+    scales = {'x': 'Linear', 'y': 'Linear'}
+    state = {'curve': None, 'point': None}
+
+    def start_element(name, attributes):
+        if name == 'Coords':
+            if attributes.get('TypeString', 'Cartesian') != 'Cartesian':
+                raise ValueError(f"{dig_file}: only Cartesian coordinates are supported")
+            scales['x'] = attributes.get('ScaleXThetaString', 'Linear')
+            scales['y'] = attributes.get('ScaleYRadiusString', 'Linear')
+        elif name == 'Curve':
+            state['curve'] = attributes['CurveName']
+        elif name == 'Point':
+            state['point'] = {'ordinal': float(attributes.get('Ordinal', 0)),
+                              'axis': attributes.get('IsAxisPoint') == 'True'}
+        elif name in ('PositionScreen', 'PositionGraph') and state['point'] is not None:
+            state['point'][name] = (float(attributes['X']), float(attributes['Y']))
+
+    def end_element(name):
+        if name == 'Point':
+            point = state['point']
+            state['point'] = None
+            if point['axis']:
+                axis_points.append((point['PositionScreen'], point['PositionGraph']))
+            else:
+                curves.setdefault(state['curve'], []).append((point['ordinal'], point['PositionScreen']))
+        elif name == 'Curve':
+            state['curve'] = None
+
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.buffer_text = False
+    with open(dig_file, 'rb') as f:
+        while True:
+            block = f.read(read_block_size)
+            parser.Parse(block, not block)
+            if not block:
+                break
+
+    curves = {name: np.array([screen for _, screen in sorted(points, key=lambda p: p[0])])
+              for name, points in curves.items()}
+    return axis_points, curves, scales
+
+
+# Affine transform from screen to graph coordinates fitted to the axis points
+#
+# Returns a (2 x 3) matrix A with graph = A @ (screen_x, screen_y, 1). Three axis points
+# determine it exactly, more are fitted by least squares. Log scaled axes are linear in
+# the log10 of the graph coordinate, so the transform is fitted there.
+def axis_transform(axis_points, scales=None):
+    if len(axis_points) < 3:
+        raise ValueError(f"Need at least 3 axis points with both coordinates, got {len(axis_points)}")
+    scales = scales or {}
+    screen = np.array([point[0] for point in axis_points], dtype=np.float64)
+    graph = np.array([point[1] for point in axis_points], dtype=np.float64)
+    for column, axis in enumerate('xy'):
+        if scales.get(axis, 'Linear') == 'Log':
+            graph[:, column] = np.log10(graph[:, column])
+
+    design = np.column_stack([screen, np.ones(len(screen))])
+    transform, _, rank, _ = np.linalg.lstsq(design, graph, rcond=None)
+    if rank < 3:
+        raise ValueError('The axis points are collinear')
+    return transform.T
+
+
+# Map (point x 2) screen positions to graph coordinates
+def screen_to_graph(screen, transform, scales=None):
+    screen = np.asarray(screen, dtype=np.float64)
+    graph = screen @ transform[:, :2].T + transform[:, 2]
+    scales = scales or {}
+    for column, axis in enumerate('xy'):
+        if scales.get(axis, 'Linear') == 'Log':
+            graph[:, column] = 10 ** graph[:, column]
+    return graph
+
+
+# Read every curve of a .dig file as a dict of curve name to its (x, y) arrays in graph coordinates
+def read_dig_curves(dig_file=default_dig_file):
+    axis_points, curves, scales = read_dig_points(dig_file)
+    transform = axis_transform(axis_points, scales)
+    result = {}
+    for name, screen in curves.items():
+        graph = screen_to_graph(screen, transform, scales)
+        graph = graph[np.argsort(graph[:, 0], kind='stable')]
+        result[name] = (graph[:, 0], graph[:, 1])
+    return result
+
+
+# Merge the channel curves onto the union of their wavelengths, like Engauge's
+# "interpolate all curves" export: every curve is interpolated linearly between its
+# points and extrapolated linearly from its two outermost points.
+def merge_curves(curves, names=channels):
+    missing = [name for name in names if name not in curves]
+    if missing:
+        raise ValueError(f"Curves {', '.join(missing)} not found, the file has {', '.join(curves)}")
+    wavelengths = np.unique(np.concatenate([curves[name][0] for name in names]))
+
+    responses = []
+    for name in names:
+        x, y = curves[name]
+        response = np.interp(wavelengths, x, y)
+        if len(x) > 1:
+            below = wavelengths < x[0]
+            above = wavelengths > x[-1]
+            response[below] = y[0] + (wavelengths[below] - x[0]) * (y[1] - y[0]) / (x[1] - x[0])
+            response[above] = y[-1] + (wavelengths[above] - x[-1]) * (y[-1] - y[-2]) / (x[-1] - x[-2])
+        responses.append(response)
+    return wavelengths, np.array(responses)
+
+
+def dig_cache_key(dig_file):
+    return hashlib.sha256(f'{hash_file(dig_file)};version={cache_version}'.encode()).hexdigest()
+
+
+# Read the responsivity curves of a .dig file into the wavelengths and a (channel x sample)
+# matrix, in the form read_responsivity_csv returns for the exported CSV
+#
+# The samples are the digitized points themselves. Between them the export of the GUI uses
+# Engauge's smoothing spline while the curves are merged linearly here, so the values at
+# the points of the other curves differ slightly from the exported CSV.
+#
+# The result is cached as .npy keyed by the hash of the file content, a new revision of the
+# curves is parsed once and every later read of it only loads the small cached arrays.
+def read_responsivity_dig(dig_file=default_dig_file, cache_dir=None):
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    cache_file = os.path.join(cache_dir, f'dig_{dig_cache_key(dig_file)}.npy')
+    if os.path.exists(cache_file):
+        data = np.load(cache_file)
+        return data[0], data[1:]
+
+    wavelengths, responsivity = merge_curves(read_dig_curves(dig_file))
+
+    atomic_write(cache_file, lambda f: np.save(f, np.vstack([wavelengths, responsivity])))
+    return wavelengths, responsivity
+
+
+# Write the responsivity curves of a .dig file as a CSV with the columns of the exported one
+def write_responsivity_csv(dig_file, csv_file):
+    wavelengths, responsivity = read_responsivity_dig(dig_file)
+    order = ['Clear', 'Red', 'Blue', 'Green']  # column order of the Engauge export
+    data = np.column_stack([wavelengths] + [responsivity[channels.index(name)] for name in order])
+    np.savetxt(csv_file, data, delimiter=',', header=','.join(['Wavelength'] + order), comments='', fmt='%g')
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Export the responsivity curves of an Engauge .dig file as CSV.')
+    parser.add_argument('dig_file', nargs='?', default=default_dig_file, help='Engauge document')
+    parser.add_argument('-o', '--output', required=True, help='CSV file to write')
+    args = parser.parse_args()
+
+    write_responsivity_csv(args.dig_file, args.output)
+
+
+if __name__ == '__main__':
+    main()
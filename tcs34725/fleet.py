@@ -0,0 +1,148 @@
+import argparse
+import csv
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .cie import default_cmf_file, default_photopic_file
+from .converter import coefficient_columns, coefficients_from_results
+from .pipeline import run_pipeline
+from .responsivity import default_responsivity_file
+
+# File names looked up in every device directory by scan_device_directories
+device_responsivity_file = 'TCS34725_spectral_responsivity.csv'
+device_dig_file = 'TCS34725_color_curve.dig'  # used when there is no exported CSV
+device_leds_file = 'leds.json'
+
+# Read a manifest CSV with the columns device_id, responsivity_file and leds_file
+#
+# Empty file columns fall back to the datasheet responsivity and reference LEDs.
+# Relative paths are resolved against the manifest's directory.
+def read_manifest(manifest_file):
+    base_dir = os.path.dirname(os.path.abspath(manifest_file))
+    devices = []
+    with open(manifest_file, newline='') as f:
+        for row in csv.DictReader(f):
+            device = {'device_id': row['device_id']}
+            for column in ['responsivity_file', 'leds_file']:
+                path = (row.get(column) or '').strip()
+                device[column] = os.path.join(base_dir, path) if path else None
+            devices.append(device)
+    return devices
+
+
+# One device per sub directory, named after the directory
+def scan_device_directories(devices_dir):
+    devices = []
+    for name in sorted(os.listdir(devices_dir)):
+        device_dir = os.path.join(devices_dir, name)
+        if not os.path.isdir(device_dir):
+            continue
+        device = {'device_id': name}
+        for column, file_name in [('responsivity_file', device_responsivity_file), ('leds_file', device_leds_file)]:
+            path = os.path.join(device_dir, file_name)
+            device[column] = path if os.path.exists(path) else None
+        if device['responsivity_file'] is None and os.path.exists(os.path.join(device_dir, device_dig_file)):
+            device['responsivity_file'] = os.path.join(device_dir, device_dig_file)
+        devices.append(device)
+    return devices
+
+
+# Pipeline stages coefficients_from_results reads, graph_conversion_factor is pulled in as their dependency
+coefficient_stages = ['channel_conversion_factors', 'lux_factors', 'rgb_to_xyz_matrix', 'fitted_xyz_matrix']
+
+
+# Derive the irradiance factors, lux factors and XYZ matrices of one device
+#
+# The optional LED file is a JSON object with 'graph_leds' and/or 'channel_leds',
+# each in the shape of the leds dicts of the simulation scripts.
+def calibrate_device(device, cmf_file=default_cmf_file, photopic_file=default_photopic_file):
+    params = {}
+    if device.get('leds_file'):
+        with open(device['leds_file']) as f:
+            leds = json.load(f)
+        for key in ['graph_leds', 'channel_leds']:
+            if key in leds:
+                params[key] = leds[key]
+
+    files = {
+        'responsivity': device.get('responsivity_file') or default_responsivity_file,
+        'cmf': cmf_file,
+        'photopic': photopic_file
+    }
+    results, _ = run_pipeline(files=files, params=params, targets=coefficient_stages)
+    return coefficients_from_results(results)
+
+
+# Worker entry point, failures are returned instead of raised so one bad device doesn't stop the fleet
+def _calibrate_device_task(task):
+    device, cmf_file, photopic_file = task
+    try:
+        return device['device_id'], calibrate_device(device, cmf_file, photopic_file), None
+    except Exception as e:
+        return device['device_id'], None, f'{type(e).__name__}: {e}'
+
+
+# Calibrate all devices on a process pool
+#
+# Returns a structured array with a device_id field plus one float field per coefficient
+# (NaN for failed devices) and a dict of device_id to error message.
+def calibrate_fleet(devices, cmf_file=default_cmf_file, photopic_file=default_photopic_file,
+                    max_workers=None, chunksize=16):
+    tasks = [(device, cmf_file, photopic_file) for device in devices]
+    id_length = max([len(device['device_id']) for device in devices] + [1])
+    dtype = [('device_id', f'U{id_length}')] + [(column, np.float64) for column in coefficient_columns]
+    table = np.zeros(len(tasks), dtype=dtype)
+    errors = {}
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for i, (device_id, row, error) in enumerate(executor.map(_calibrate_device_task, tasks, chunksize=chunksize)):
+            table[i]['device_id'] = device_id
+            if error is not None:
+                errors[device_id] = error
+                row = {}
+            for column in coefficient_columns:
+                table[i][column] = row.get(column, np.nan)
+
+    return table, errors
+
+
+# Write the coefficient table as .npy (structured array) or CSV, depending on the extension
+def write_coefficient_table(table, output_file):
+    if output_file.endswith('.npy'):
+        np.save(output_file, table)
+        return
+    with open(output_file, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(table.dtype.names)
+        for row in table:
+            writer.writerow([row['device_id']] + [repr(float(row[column])) for column in table.dtype.names[1:]])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Derive the calibration coefficients of many devices in parallel.')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--manifest', help='CSV with device_id, responsivity_file and leds_file columns')
+    source.add_argument('--devices-dir', help=f'directory with one sub directory per device containing '
+                                              f'{device_responsivity_file} (or {device_dig_file}) and/or '
+                                              f'{device_leds_file}')
+    parser.add_argument('-o', '--output', default='fleet_coefficients.csv', help='coefficient table (.csv or .npy)')
+    parser.add_argument('--cmf', default=default_cmf_file, help='CIE 1931 2° color-matching functions CSV')
+    parser.add_argument('--photopic', default=default_photopic_file, help='CIE photopic V(λ) CSV')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='number of worker processes')
+    args = parser.parse_args()
+
+    devices = read_manifest(args.manifest) if args.manifest else scan_device_directories(args.devices_dir)
+    table, errors = calibrate_fleet(devices, args.cmf, args.photopic, max_workers=args.workers)
+    write_coefficient_table(table, args.output)
+
+    print(f"Calibrated {len(devices) - len(errors)} of {len(devices)} devices, written to {args.output}")
+    for device_id, error in errors.items():
+        print(f"  {device_id}: {error}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
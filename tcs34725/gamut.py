@@ -0,0 +1,182 @@
+import argparse
+import sys
+
+import numpy as np
+
+from .cie import default_cmf_file, load_cie_cmfs
+from .converter import calculate_chromaticity
+from .curve_features import curve_features
+from .responsivity import channels, interpolate_responsivity, read_responsivity, wavelength_grid
+
+# Primaries of the reference color spaces (CIE1931/calculate_color_gamut_with_references.py)
+reference_gamuts = {
+    'NTSC': {'R': (0.67, 0.33), 'G': (0.21, 0.71), 'B': (0.14, 0.08)},
+    'sRGB': {'R': (0.64, 0.33), 'G': (0.30, 0.60), 'B': (0.15, 0.06)},
+    'AdobeRGB': {'R': (0.64, 0.33), 'G': (0.21, 0.71), 'B': (0.15, 0.06)},
+    'DCI-P3': {'R': (0.680, 0.320), 'G': (0.265, 0.690), 'B': (0.150, 0.060)},
+    'Rec. 2020': {'R': (0.708, 0.292), 'G': (0.170, 0.797), 'B': (0.131, 0.046)}
+}
+
+# Wavelength window of the gamut scripts
+gamut_grid = wavelength_grid(360, 830)
+
+rgb = ['Red', 'Green', 'Blue']
+
+
+# Triangles of gamuts given like reference_gamuts, as a (gamut x vertex x xy) array in R, G, B order
+def gamut_triangles(gamuts=reference_gamuts):
+    return np.array([[gamut[primary] for primary in 'RGB'] for gamut in gamuts.values()], dtype=np.float64)
+
+
+# xy triangles of the R, G and B channels for many responsivities at once, shape (device x vertex x xy)
+#
+# As in CIE1931/calculate_color_gamut.py every channel's vertex is the chromaticity of a flat
+# spectrum over the channel's FWHM. The FWHM edges come from the PCHIP pieces of the responses
+# (curve_features) and the CMFs are integrated between them with the antiderivative of their
+# PCHIP interpolant, so nothing snaps to a grid. responsivities is a (device x channel x sample)
+# or (channel x sample) array with the rows ordered like `channels`, sampled at wavelengths.
+def channel_gamuts(wavelengths, responsivities, cmf_file=default_cmf_file):
+    from scipy.interpolate import PchipInterpolator
+
+    responsivities = np.asarray(responsivities, dtype=np.float64)
+    single = responsivities.ndim == 2
+    if single:
+        responsivities = responsivities[np.newaxis]
+    rows = [channels.index(ch) for ch in rgb]
+
+    features = curve_features(wavelengths, responsivities[:, rows].reshape(-1, responsivities.shape[-1]))
+    start = features.fwhm_start.reshape(-1, len(rgb))
+    end = features.fwhm_end.reshape(-1, len(rgb))
+
+    wavelengths_cie, cmfs = load_cie_cmfs(cmf_file)
+    cmf_integral = PchipInterpolator(wavelengths_cie, cmfs, axis=1).antiderivative()
+    XYZ = cmf_integral(end) - cmf_integral(start)  # (cmf x device x channel)
+    x, y = calculate_chromaticity(*XYZ)
+    triangles = np.stack([x, y], axis=-1)
+    return triangles[0] if single else triangles
+
+
+# Area of (... x vertex x xy) polygons (shoelace formula), positive for either orientation
+def polygon_areas(polygons):
+    polygons = np.asarray(polygons, dtype=np.float64)
+    x, y = polygons[..., 0], polygons[..., 1]
+    return np.abs(np.sum(x * np.roll(y, -1, axis=-1) - np.roll(x, -1, axis=-1) * y, axis=-1)) / 2
+
+
+# Mask of points inside (or on the edge of) triangles, broadcasting (... x vertex x xy) triangles
+# against (... x xy) points
+def points_in_triangles(points, triangles, tolerance=1e-12):
+    points = np.asarray(points, dtype=np.float64)
+    triangles = np.asarray(triangles, dtype=np.float64)
+    a, b, c = triangles[..., 0, :], triangles[..., 1, :], triangles[..., 2, :]
+
+    def cross(o, p, q):
+        return (p[..., 0] - o[..., 0]) * (q[..., 1] - o[..., 1]) - (p[..., 1] - o[..., 1]) * (q[..., 0] - o[..., 0])
+
+    d1 = cross(a, b, points)
+    d2 = cross(b, c, points)
+    d3 = cross(c, a, points)
+    negative = (d1 < -tolerance) | (d2 < -tolerance) | (d3 < -tolerance)
+    positive = (d1 > tolerance) | (d2 > tolerance) | (d3 > tolerance)
+    return ~(negative & positive)
+
+
+# Point-in-gamut test of many xy points against many gamuts, shape (gamut x point)
+#
+# Points are tested in blocks of block_size, the intermediate arrays stay at a few MB
+# however many points there are.
+def points_in_gamuts(points, triangles, block_size=1 << 16):
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    triangles = np.asarray(triangles, dtype=np.float64).reshape(-1, 3, 2)
+    inside = np.empty((len(triangles), len(points)), dtype=bool)
+    for start in range(0, len(points), block_size):
+        block = points[start:start + block_size]
+        inside[:, start:start + len(block)] = points_in_triangles(block[np.newaxis], triangles[:, np.newaxis])
+    return inside
+
+
+# Intersection area of triangles, broadcasting (... x vertex x xy) arrays a and b
+#
+# The intersection of two triangles is the convex polygon spanned by the vertices of each
+# triangle inside the other plus all edge-edge intersections. Those up to 15 candidates are
+# sorted by angle around their mean and summed up with the shoelace formula; invalid candidates
+# are replaced by the first valid one, which adds zero area.
+def triangle_overlap_areas(a, b):
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    a, b = np.broadcast_arrays(a, b)
+
+    # Edge-edge intersections p + t·r = q + u·s with t, u in [0, 1]
+    p = a[..., :, np.newaxis, :]
+    r = np.roll(a, -1, axis=-2)[..., :, np.newaxis, :] - p
+    q = b[..., np.newaxis, :, :]
+    s = np.roll(b, -1, axis=-2)[..., np.newaxis, :, :] - q
+    denominator = r[..., 0] * s[..., 1] - r[..., 1] * s[..., 0]
+    qp = q - p
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = (qp[..., 0] * s[..., 1] - qp[..., 1] * s[..., 0]) / denominator
+        u = (qp[..., 0] * r[..., 1] - qp[..., 1] * r[..., 0]) / denominator
+    crossing = (denominator != 0) & (t >= 0) & (t <= 1) & (u >= 0) & (u <= 1)
+    intersections = p + np.nan_to_num(t)[..., np.newaxis] * r
+
+    shape = a.shape[:-2]
+    candidates = np.concatenate([a, b, intersections.reshape(shape + (9, 2))], axis=-2)
+    valid = np.concatenate([points_in_triangles(a, b[..., np.newaxis, :, :]),
+                            points_in_triangles(b, a[..., np.newaxis, :, :]),
+                            crossing.reshape(shape + (9,))], axis=-1)
+
+    count = valid.sum(axis=-1, keepdims=True)
+    center = np.sum(candidates * valid[..., np.newaxis], axis=-2) / np.maximum(count, 1)
+    offset = candidates - center[..., np.newaxis, :]
+    angle = np.where(valid, np.arctan2(offset[..., 1], offset[..., 0]), np.inf)
+    order = np.argsort(angle, axis=-1)
+    polygon = np.take_along_axis(candidates, order[..., np.newaxis], axis=-2)
+    polygon_valid = np.take_along_axis(valid, order, axis=-1)
+    polygon = np.where(polygon_valid[..., np.newaxis], polygon, polygon[..., :1, :])
+    return np.where(count[..., 0] >= 3, polygon_areas(polygon), 0.0)
+
+
+# Coverage of reference gamuts by sensor gamuts, shape (sensor x reference)
+#
+# Returns the overlap area and the fraction of each reference triangle covered by each sensor triangle.
+def gamut_coverage(sensor_triangles, reference_triangles=None):
+    if reference_triangles is None:
+        reference_triangles = gamut_triangles()
+    sensor_triangles = np.asarray(sensor_triangles, dtype=np.float64).reshape(-1, 3, 2)
+    reference_triangles = np.asarray(reference_triangles, dtype=np.float64).reshape(-1, 3, 2)
+    overlap = triangle_overlap_areas(sensor_triangles[:, np.newaxis], reference_triangles[np.newaxis])
+    return overlap, overlap / polygon_areas(reference_triangles)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Channel gamut of many sensors and its coverage of reference '
+                                                 'color spaces.')
+    parser.add_argument('responsivity_files', nargs='+', help='responsivity CSV or .dig files, one per sensor')
+    parser.add_argument('--cmf', default=default_cmf_file, help='CIE 1931 2° color-matching functions CSV')
+    parser.add_argument('-o', '--output', default='-', help="CSV file, '-' for stdout")
+    args = parser.parse_args()
+
+    # Every sensor is resampled to the 1 nm grid of the gamut scripts, so all are evaluated at once
+    responsivities = []
+    for responsivity_file in args.responsivity_files:
+        wavelengths_sensor, responsivity = read_responsivity(responsivity_file)
+        responsivities.append(interpolate_responsivity(wavelengths_sensor, responsivity, gamut_grid,
+                                                       extrapolate=False))
+    triangles = channel_gamuts(gamut_grid, np.array(responsivities), args.cmf)
+    overlap, coverage = gamut_coverage(triangles)
+
+    header = ['responsivity_file', 'x_red', 'y_red', 'x_green', 'y_green', 'x_blue', 'y_blue', 'area'] + \
+        [f'coverage_{name}' for name in reference_gamuts]
+    f = sys.stdout if args.output == '-' else open(args.output, 'w')
+    try:
+        f.write(','.join(header) + '\n')
+        for name, triangle, area, row in zip(args.responsivity_files, triangles, polygon_areas(triangles), coverage):
+            values = list(triangle.ravel()) + [area] + list(row)
+            f.write(','.join([name] + [f'{value:.6g}' for value in values]) + '\n')
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
+
+if __name__ == '__main__':
+    main()
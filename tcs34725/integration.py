@@ -0,0 +1,156 @@
+from collections import namedtuple
+
+import numpy as np
+
+from .responsivity import channels, wavelength_grid
+
+# Wavelengths of an adaptively refined grid and the estimated trapezoid error of every curve on it
+AdaptiveGrid = namedtuple('AdaptiveGrid', ['wavelengths', 'error'])
+
+
+# Quadrature weights w with w @ f == np.trapezoid(f, wavelengths) for any f sampled on the grid
+def trapezoid_weights(wavelengths):
+    wavelengths = np.asarray(wavelengths, dtype=np.float64)
+    dx = np.diff(wavelengths)
+    weights = np.zeros_like(wavelengths)
+    weights[:-1] += dx / 2
+    weights[1:] += dx / 2
+    return weights
+
+
+# Weights e with e @ f estimating the trapezoid error of f on the grid (Richardson extrapolation)
+#
+# The integral on the grid is compared with the one on every second point of it, the error of
+# the trapezoid rule shrinks with the square of the step, so it's about a third of the difference.
+def trapezoid_error_weights(wavelengths):
+    wavelengths = np.asarray(wavelengths, dtype=np.float64)
+    coarse = np.arange(0, len(wavelengths), 2)
+    if coarse[-1] != len(wavelengths) - 1:
+        coarse = np.append(coarse, len(wavelengths) - 1)
+    coarse_weights = np.zeros_like(wavelengths)
+    coarse_weights[coarse] = trapezoid_weights(wavelengths[coarse])
+    return (trapezoid_weights(wavelengths) - coarse_weights) / 3
+
+
+# Grid refined where the trapezoid rule is inaccurate and around the peaks and half-max crossings
+#
+# curves is a function returning the (curve x wavelength) values of all curves (e.g. products of
+# spectra and responses) for an array of wavelengths, so every refinement step evaluates all of
+# them at once. Starting from a uniform grid with the given step, intervals are halved while their
+# error estimate exceeds their share of tolerance (relative to the curve's integral), and intervals
+# around a peak or a half-max crossing are halved down to feature_step. No interval gets shorter
+# than min_step. Returns the grid and the estimated integration error of every curve on it.
+def adaptive_grid(curves, start, stop, step=1.0, tolerance=1e-4, feature_step=0.1, min_step=0.01,
+                  max_iterations=20):
+    wavelengths = wavelength_grid(start, stop, step)
+    span = wavelengths[-1] - wavelengths[0]
+    for _ in range(max_iterations):
+        values = np.atleast_2d(curves(wavelengths))
+        midpoints = (wavelengths[:-1] + wavelengths[1:]) / 2
+        mid_values = np.atleast_2d(curves(midpoints))
+        h = np.diff(wavelengths)
+
+        # Trapezoid error of every interval from comparing it to the halved interval
+        interval_error = h / 3 * np.abs(values[:, :-1] + values[:, 1:] - 2 * mid_values)
+        scale = np.abs(values @ trapezoid_weights(wavelengths))[:, np.newaxis]
+        refine = np.any(interval_error > tolerance * scale * h / span, axis=0)
+
+        # Intervals next to a local maximum or with the curve crossing its half maximum
+        half_max = (values.max(axis=1) / 2)[:, np.newaxis]
+        crossing = np.any((values[:, :-1] - half_max) * (values[:, 1:] - half_max) < 0, axis=0)
+        peak = np.zeros(len(wavelengths), dtype=bool)
+        peak[1:-1] = np.any((values[:, 1:-1] >= values[:, :-2]) & (values[:, 1:-1] > values[:, 2:]), axis=0)
+        feature = (crossing | peak[:-1] | peak[1:]) & (h > feature_step * (1 + 1e-9))
+
+        split = (refine | feature) & (h / 2 >= min_step * (1 - 1e-9))
+        if not split.any():
+            return AdaptiveGrid(wavelengths, interval_error.sum(axis=1))
+        wavelengths = np.sort(np.concatenate([wavelengths, midpoints[split]]))
+
+    values = np.atleast_2d(curves(wavelengths))
+    return AdaptiveGrid(wavelengths, np.abs(values @ trapezoid_error_weights(wavelengths)))
+
+
+# Integral of every spectrum (rows) times every response (rows), shape (spectrum x response)
+def integrate_spectra(spectra, wavelengths, responses):
+    weighted = np.atleast_2d(np.asarray(responses, dtype=np.float64)) * trapezoid_weights(wavelengths)
+    return np.asarray(spectra, dtype=np.float64) @ weighted.T
+
+
+# Trapezoid integral of every row of (curve x wavelength) values from its start to its end wavelength
+#
+# The values are taken as linear between the wavelengths, so start and end (one per curve)
+# need not be grid points, e.g. the exact FWHM edges of curve_features.
+def trapezoid_between(wavelengths, values, start, end):
+    wavelengths = np.asarray(wavelengths, dtype=np.float64)
+    values = np.atleast_2d(np.asarray(values, dtype=np.float64))
+    dx = np.diff(wavelengths)
+    cumulative = np.concatenate([np.zeros((len(values), 1)),
+                                 np.cumsum((values[:, 1:] + values[:, :-1]) / 2 * dx, axis=1)], axis=1)
+    rows = np.arange(len(values))
+
+    def antiderivative(points):
+        points = np.asarray(points, dtype=np.float64)
+        i = np.clip(np.searchsorted(wavelengths, points, side='right') - 1, 0, len(wavelengths) - 2)
+        t = points - wavelengths[i]
+        slope = (values[rows, i + 1] - values[rows, i]) / dx[i]
+        return cumulative[rows, i] + (values[rows, i] + slope * t / 2) * t
+
+    return antiderivative(end) - antiderivative(start)
+
+
+# Integrates many spectra against the sensor channels and the CIE color-matching functions at once
+#
+# The quadrature weights are folded into one (wavelength x column) matrix when the integrator is
+# created, so every integration afterwards is a single matrix product of the (spectrum x wavelength)
+# batch with that matrix. Columns are the channels (Clear, Red, Green, Blue), the CMFs (X, Y, Z) if
+# given, and the radiant power of the spectrum itself ('Power').
+class SpectralIntegrator:
+    def __init__(self, wavelengths, responsivity=None, cmfs=None):
+        self.wavelengths = np.asarray(wavelengths, dtype=np.float64)
+        self.weights = trapezoid_weights(self.wavelengths)
+
+        rows = []
+        self.columns = []
+        if responsivity is not None:
+            rows.append(np.asarray(responsivity, dtype=np.float64))
+            self.columns += channels
+        if cmfs is not None:
+            rows.append(np.asarray(cmfs, dtype=np.float64))
+            self.columns += ['X', 'Y', 'Z']
+        rows.append(np.ones((1, len(self.wavelengths))))
+        self.columns.append('Power')
+
+        rows = np.vstack(rows)
+        self.matrix = np.ascontiguousarray((rows * self.weights).T)
+        self.error_matrix = np.ascontiguousarray((rows * trapezoid_error_weights(self.wavelengths)).T)
+
+    # Slice of the result columns belonging to the given names
+    def _column_slice(self, names):
+        start = self.columns.index(names[0])
+        return slice(start, start + len(names))
+
+    # Integral of every spectrum times every column, shape (spectrum x column)
+    def integrate(self, spectra):
+        return np.asarray(spectra, dtype=np.float64) @ self.matrix
+
+    # Estimated trapezoid error of every integral, shape (spectrum x column)
+    #
+    # One more matrix product, callers can use it to decide whether a finer grid is needed.
+    def integration_error(self, spectra):
+        return np.abs(np.asarray(spectra, dtype=np.float64) @ self.error_matrix)
+
+    # Integrated response of every spectrum in the Clear, Red, Green and Blue channels
+    def channel_responses(self, spectra):
+        return np.asarray(spectra, dtype=np.float64) @ self.matrix[:, self._column_slice(channels)]
+
+    # CIE XYZ tristimulus values of every spectrum
+    def xyz(self, spectra):
+        return np.asarray(spectra, dtype=np.float64) @ self.matrix[:, self._column_slice(['X', 'Y', 'Z'])]
+
+    # Channel responses divided by the integral of the spectrum, the batched
+    # equivalent of calculate_unitless_avg_response
+    def unitless_avg_responses(self, spectra):
+        integrals = self.integrate(spectra)
+        responses = integrals[:, self._column_slice(channels)]
+        return responses / integrals[:, -1:]
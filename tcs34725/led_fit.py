@@ -0,0 +1,244 @@
+import argparse
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from . import calibration
+from .integration import trapezoid_weights
+from .responsivity import channels, default_responsivity_file, load_responsivity_grid
+
+# Standard deviations of the fit: the relative error of every datasheet count and the prior
+# uncertainty (nm) of the nominal LED centers and halfwidths
+default_fit_uncertainties = {
+    'counts': 0.05,
+    'led_center': 2.0,
+    'led_halfwidth': 2.0
+}
+
+# Fitted parameters of every lot: one scale factor (counts per µW/cm² per unit of the graph) per
+# count set, the LED centers and halfwidths (nm), the final sum of squared weighted residuals and
+# whether the fit converged
+LEDFit = namedtuple('LEDFit', ['scales', 'centers', 'halfwidths', 'cost', 'converged'])
+
+# Halfwidth to standard deviation of the Gaussian LEDs (light_sources.gaussian)
+_sigma_per_halfwidth = 1 / (2 * np.sqrt(2 * np.log(2)))
+
+
+# Unitless average response of every LED in every channel and its derivatives by center and halfwidth
+#
+# centers and halfwidths are (lot x LED), responsivity is (channel x wavelength) shared by all lots
+# or (lot x channel x wavelength). Returns three (lot x LED x channel) arrays.
+def _average_responses(wavelengths, weights, responsivity, centers, halfwidths):
+    sigma = halfwidths[..., np.newaxis] * _sigma_per_halfwidth
+    u = (wavelengths - centers[..., np.newaxis]) / sigma
+    emission = np.exp(-0.5 * u ** 2) * weights  # quadrature weights folded in
+    d_center = emission * u / sigma
+    d_halfwidth = emission * u ** 2 / halfwidths[..., np.newaxis]
+
+    def project(curves):
+        if responsivity.ndim == 2:
+            return curves @ responsivity.T
+        return np.einsum('nlw,ncw->nlc', curves, responsivity)
+
+    norm = emission.sum(axis=-1)[..., np.newaxis]
+    average = project(emission) / norm
+    average_d_center = (project(d_center) - average * d_center.sum(axis=-1)[..., np.newaxis]) / norm
+    average_d_halfwidth = (project(d_halfwidth) - average * d_halfwidth.sum(axis=-1)[..., np.newaxis]) / norm
+    return average, average_d_center, average_d_halfwidth
+
+
+# Weighted residuals and their Jacobian for a batch of lots
+#
+# params is (lot x parameter) with the scale of every count set, then the LED centers, then the
+# halfwidths. counts is (lot x set x LED x channel), NaN where there is no datasheet value. The
+# residuals are the relative count errors over their uncertainty followed by the deviations of
+# the LED parameters from the nominal ones over theirs, missing counts give zero rows.
+def led_residuals(params, wavelengths, weights, responsivity, counts, nominal_centers, nominal_halfwidths,
+                  uncertainties=default_fit_uncertainties):
+    lots, sets, leds, channel_count = counts.shape
+    scales = params[:, :sets]
+    centers = params[:, sets:sets + leds]
+    halfwidths = params[:, sets + leds:]
+
+    average, average_d_center, average_d_halfwidth = _average_responses(wavelengths, weights, responsivity,
+                                                                        centers, halfwidths)
+    observed = ~np.isnan(counts)
+    inverse_error = np.where(observed, 1 / (uncertainties['counts'] * np.where(observed, counts, 1)), 0)
+    predicted = scales[:, :, np.newaxis, np.newaxis] * average[:, np.newaxis]
+    count_residuals = (predicted - np.nan_to_num(counts)) * inverse_error  # (lot x set x LED x channel)
+
+    # d residual / d scale of its own set, d residual / d center and halfwidth of its own LED
+    jacobian_counts = np.zeros((lots, sets, leds, channel_count, params.shape[1]))
+    set_index, led_index = np.arange(sets), np.arange(leds)
+    jacobian_counts[:, set_index, :, :, set_index] = np.moveaxis(
+        average[:, np.newaxis] * inverse_error, 1, 0)
+    jacobian_counts[:, :, led_index, :, sets + led_index] = np.moveaxis(
+        scales[:, :, np.newaxis, np.newaxis] * average_d_center[:, np.newaxis] * inverse_error, 2, 0)
+    jacobian_counts[:, :, led_index, :, sets + leds + led_index] = np.moveaxis(
+        scales[:, :, np.newaxis, np.newaxis] * average_d_halfwidth[:, np.newaxis] * inverse_error, 2, 0)
+
+    prior_residuals = np.concatenate([(centers - nominal_centers) / uncertainties['led_center'],
+                                      (halfwidths - nominal_halfwidths) / uncertainties['led_halfwidth']], axis=1)
+    jacobian_prior = np.zeros((lots, 2 * leds, params.shape[1]))
+    jacobian_prior[:, np.arange(2 * leds), sets + np.arange(2 * leds)] = np.repeat(
+        [[1 / uncertainties['led_center']] * leds + [1 / uncertainties['led_halfwidth']] * leds], lots, axis=0)
+
+    residuals = np.concatenate([count_residuals.reshape(lots, -1), prior_residuals], axis=1)
+    jacobian = np.concatenate([jacobian_counts.reshape(lots, -1, params.shape[1]), jacobian_prior], axis=1)
+    return residuals, jacobian
+
+
+# Start values: the nominal LEDs and per set the median of the counts over the nominal responses
+def _initial_params(wavelengths, weights, responsivity, counts, centers, halfwidths):
+    average, _, _ = _average_responses(wavelengths, weights, responsivity, centers, halfwidths)
+    scales = np.nanmedian((counts / average[:, np.newaxis]).reshape(counts.shape[0], counts.shape[1], -1), axis=2)
+    return np.concatenate([scales, centers, halfwidths], axis=1)
+
+
+# Fit scale factors and LED parameters of many lots at once with Levenberg-Marquardt
+#
+# Every lot is an independent problem with a handful of parameters, so the normal equations of
+# all lots are formed and solved as one (lot x parameter x parameter) batch per iteration, with
+# a damping factor per lot. responsivity is (channel x wavelength) or (lot x channel x
+# wavelength), counts (lot x set x LED x channel) and the nominal centers and halfwidths (LED)
+# or (lot x LED).
+def fit_lots(wavelengths, responsivity, counts, centers, halfwidths, uncertainties=default_fit_uncertainties,
+             max_iterations=100, tolerance=1e-10):
+    wavelengths = np.asarray(wavelengths, dtype=np.float64)
+    weights = trapezoid_weights(wavelengths)
+    responsivity = np.asarray(responsivity, dtype=np.float64)
+    counts = np.asarray(counts, dtype=np.float64)
+    lots = counts.shape[0]
+    centers = np.broadcast_to(np.asarray(centers, dtype=np.float64), (lots, counts.shape[2]))
+    halfwidths = np.broadcast_to(np.asarray(halfwidths, dtype=np.float64), (lots, counts.shape[2]))
+    uncertainties = {**default_fit_uncertainties, **uncertainties}
+
+    def evaluate(params):
+        return led_residuals(params, wavelengths, weights, responsivity, counts, centers, halfwidths, uncertainties)
+
+    params = _initial_params(wavelengths, weights, responsivity, counts, centers, halfwidths)
+    residuals, jacobian = evaluate(params)
+    cost = np.sum(residuals ** 2, axis=1)
+    damping = np.full(lots, 1e-3)
+    converged = np.zeros(lots, dtype=bool)
+    for _ in range(max_iterations):
+        normal = np.swapaxes(jacobian, 1, 2) @ jacobian
+        gradient = np.einsum('nrp,nr->np', jacobian, residuals)
+        diagonal = np.diagonal(normal, axis1=1, axis2=2)
+        damped = normal + (damping[:, np.newaxis] * diagonal)[..., np.newaxis] * np.eye(normal.shape[1])
+        step = -np.linalg.solve(damped, gradient[..., np.newaxis])[..., 0]
+        candidate = params + np.where(converged[:, np.newaxis], 0, step)
+        candidate_residuals, candidate_jacobian = evaluate(candidate)
+        candidate_cost = np.sum(candidate_residuals ** 2, axis=1)
+
+        better = (candidate_cost <= cost) & ~converged
+        converged |= better & (cost - candidate_cost <= tolerance * np.maximum(cost, 1))
+        params = np.where(better[:, np.newaxis], candidate, params)
+        residuals = np.where(better[:, np.newaxis], candidate_residuals, residuals)
+        jacobian = np.where(better[:, np.newaxis, np.newaxis], candidate_jacobian, jacobian)
+        cost = np.where(better, candidate_cost, cost)
+        damping = np.where(better, damping / 3, damping * 4)
+        converged |= damping > 1e12  # no step lowers the cost any more
+        if converged.all():
+            break
+
+    sets, leds = counts.shape[1], counts.shape[2]
+    return LEDFit(params[:, :sets], params[:, sets:sets + leds], params[:, sets + leds:], cost, converged)
+
+
+# (1 x set x LED x channel) counts of LED tables shaped like calibration.graph_reference_leds
+#
+# Every table is one count set with its own scale. Besides the Clear counts in
+# 'counts_per_uW_cm2' an LED may give counts of other channels in 'channel_counts_per_uW_cm2'.
+def datasheet_counts(led_tables):
+    names = list(led_tables[0])
+    counts = np.full((1, len(led_tables), len(names), len(channels)), np.nan)
+    for s, leds in enumerate(led_tables):
+        for i, name in enumerate(names):
+            counts[0, s, i, channels.index('Clear')] = leds[name]['counts_per_uW_cm2']
+            for ch, value in leds[name].get('channel_counts_per_uW_cm2', {}).items():
+                counts[0, s, i, channels.index(ch)] = value
+    return counts
+
+
+# Fit the datasheet LED tables of one responsivity with scipy's least_squares
+#
+# The graph conversion factor of the scripts is the median of the per-LED factors at the nominal
+# LEDs; here one scale per table and the LED centers and halfwidths are fitted jointly to all
+# counts. Returns an LEDFit of one lot.
+def fit_datasheet(responsivity_file=default_responsivity_file,
+                  led_tables=(calibration.graph_reference_leds, calibration.channel_reference_leds),
+                  uncertainties=default_fit_uncertainties, step=1):
+    from scipy.optimize import least_squares
+
+    wavelengths, responsivity = load_responsivity_grid(calibration.simulation_grid(responsivity_file, step),
+                                                       responsivity_file, extrapolate=False)
+    weights = trapezoid_weights(wavelengths)
+    counts = datasheet_counts(list(led_tables))
+    centers = np.array([[led['center'] for led in led_tables[0].values()]], dtype=np.float64)
+    halfwidths = np.array([[led['halfwidth'] for led in led_tables[0].values()]], dtype=np.float64)
+    uncertainties = {**default_fit_uncertainties, **uncertainties}
+
+    def residuals(x):
+        return led_residuals(x[np.newaxis], wavelengths, weights, responsivity, counts, centers, halfwidths,
+                             uncertainties)[0][0]
+
+    def jacobian(x):
+        return led_residuals(x[np.newaxis], wavelengths, weights, responsivity, counts, centers, halfwidths,
+                             uncertainties)[1][0]
+
+    x0 = _initial_params(wavelengths, weights, responsivity, counts, centers, halfwidths)[0]
+    result = least_squares(residuals, x0, jac=jacobian, method='lm', x_scale='jac')
+    sets, leds = counts.shape[1], counts.shape[2]
+    x = result.x[np.newaxis]
+    return LEDFit(x[:, :sets], x[:, sets:sets + leds], x[:, sets + leds:], np.array([2 * result.cost]),
+                  np.array([result.success]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fit the graph conversion factor and the datasheet LED parameters '
+                                                 'by least squares.')
+    parser.add_argument('--responsivity', default=default_responsivity_file, help='responsivity CSV or .dig file')
+    parser.add_argument('--lots', type=int, default=0,
+                        help='also fit this many simulated lots in one batch and report the recovery')
+    args = parser.parse_args()
+
+    led_tables = [calibration.graph_reference_leds, calibration.channel_reference_leds]
+    fit = fit_datasheet(args.responsivity, led_tables)
+    wavelengths, responsivity = load_responsivity_grid(calibration.simulation_grid(args.responsivity),
+                                                       args.responsivity, extrapolate=False)
+    _, median_factor = calibration.calculate_graph_conversion_factor(
+        wavelengths, responsivity[channels.index('Clear')])
+    print(f'graph conversion factor: {fit.scales[0, 0]:.6g} (median of the nominal LEDs: {median_factor:.6g})')
+    print(f'channel count scale: {fit.scales[0, 1]:.6g}')
+    for name, led, center, halfwidth in zip(led_tables[0], led_tables[0].values(), fit.centers[0],
+                                            fit.halfwidths[0]):
+        print(f"{name}: center {center:.2f} nm (nominal {led['center']}), "
+              f"halfwidth {halfwidth:.2f} nm (nominal {led['halfwidth']})")
+    print(f'cost {fit.cost[0]:.4g}, converged {bool(fit.converged[0])}')
+
+    if args.lots:
+        # Lots with randomly shifted LEDs and scales, their counts simulated with 1 % noise
+        rng = np.random.default_rng(0)
+        counts = datasheet_counts(led_tables)
+        sets, leds = counts.shape[1], counts.shape[2]
+        true = np.concatenate([fit.scales * rng.normal(1, 0.05, (args.lots, sets)),
+                               fit.centers + rng.normal(0, 2, (args.lots, leds)),
+                               fit.halfwidths + rng.normal(0, 2, (args.lots, leds))], axis=1)
+        weights = trapezoid_weights(wavelengths)
+        average, _, _ = _average_responses(wavelengths, weights, responsivity, true[:, sets:sets + leds],
+                                           true[:, sets + leds:])
+        simulated = true[:, :sets, np.newaxis, np.newaxis] * average[:, np.newaxis]
+        simulated = np.where(np.isnan(counts), np.nan, simulated * rng.normal(1, 0.01, simulated.shape))
+
+        start = time.perf_counter()
+        lot_fit = fit_lots(wavelengths, responsivity, simulated, fit.centers[0], fit.halfwidths[0])
+        elapsed = time.perf_counter() - start
+        scale_error = np.abs(lot_fit.scales[:, 0] / true[:, 0] - 1)
+        print(f'{args.lots} lots in {elapsed:.2f} s, {lot_fit.converged.mean():.1%} converged, graph conversion '
+              f'factor error median {np.median(scale_error):.2%}, p95 {np.percentile(scale_error, 95):.2%}')
+
+
+if __name__ == '__main__':
+    main()
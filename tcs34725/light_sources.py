@@ -0,0 +1,131 @@
+import numpy as np
+
+from .integration import trapezoid_weights
+
+# Radiation constants of Planck's law (CODATA 2018)
+c1 = 3.741771852e-16  # W·m²
+c2 = 1.438776877e-2  # m·K
+
+# Spectral power distributions of Planckian radiators are normalized to 1 at 560 nm, like the CIE does
+planckian_normalization_wavelength = 560  # nm
+
+
+# Parameters as a column, so they broadcast against a wavelength row into a (light x wavelength) matrix
+def _column(values):
+    return np.atleast_1d(np.asarray(values, dtype=np.float64))[:, np.newaxis]
+
+
+# Define a Gaussian function to model the LED's emission profile
+def gaussian(wavelength, center, halfwidth):
+    sigma = halfwidth / (2 * np.sqrt(2 * np.log(2)))  # Convert halfwidth to standard deviation
+    return np.exp(-0.5 * ((wavelength - center) / sigma) ** 2)
+
+
+# Same Gaussian, but with the area under the curve normalized to 1
+def gaussian_normalized(wavelength, center, halfwidth):
+    sigma = halfwidth / (2 * np.sqrt(2 * np.log(2)))
+    amplitude = 1 / (sigma * np.sqrt(2 * np.pi))
+    return amplitude * np.exp(-0.5 * ((wavelength - center) / sigma) ** 2)
+
+
+# Gaussian LEDs, one row per (center, halfwidth) pair, peak 1 or area 1 if normalized
+def gaussian_leds(wavelengths, centers, halfwidths, normalized=False):
+    wavelengths = np.asarray(wavelengths, dtype=np.float64)
+    if normalized:
+        return gaussian_normalized(wavelengths, _column(centers), _column(halfwidths))
+    return gaussian(wavelengths, _column(centers), _column(halfwidths))
+
+
+# LEDs with different halfwidths below and above the peak, peak 1
+#
+# Each side is one half of a Gaussian, so the overall FWHM is the mean of both halfwidths.
+def asymmetric_leds(wavelengths, centers, halfwidths_left, halfwidths_right):
+    wavelengths = np.asarray(wavelengths, dtype=np.float64)
+    centers = _column(centers)
+    halfwidths = np.where(wavelengths < centers, _column(halfwidths_left), _column(halfwidths_right))
+    return gaussian(wavelengths, centers, halfwidths)
+
+
+# Phosphor-converted white LEDs: a Gaussian blue pump plus a broad asymmetric phosphor emission
+#
+# phosphor_ratios is the peak of the phosphor relative to the peak of the pump.
+def phosphor_white_leds(wavelengths, pump_centers=450, pump_halfwidths=20, phosphor_centers=560,
+                        phosphor_halfwidths_left=70, phosphor_halfwidths_right=110, phosphor_ratios=0.4):
+    pump = gaussian_leds(wavelengths, pump_centers, pump_halfwidths)
+    phosphor = asymmetric_leds(wavelengths, phosphor_centers, phosphor_halfwidths_left, phosphor_halfwidths_right)
+    return pump + _column(phosphor_ratios) * phosphor
+
+
+# Planckian radiators for an array of correlated color temperatures in K
+def planckian(wavelengths, cct):
+    wavelengths = np.asarray(wavelengths, dtype=np.float64)
+    cct = _column(cct)
+
+    def spectral_exitance(wavelength_nm):
+        wavelength = wavelength_nm * 1e-9
+        return c1 / wavelength ** 5 / np.expm1(c2 / (wavelength * cct))
+
+    return spectral_exitance(wavelengths) / spectral_exitance(planckian_normalization_wavelength)
+
+
+# Load a tabulated illuminant CSV (wavelength, value) like the CIE standard illuminant datasets
+def load_illuminant(illuminant_file):
+    data = np.loadtxt(illuminant_file, delimiter=',')
+    return data[:, 0], data[:, 1]
+
+
+# Resample tabulated spectra (one per row, or a single row) linearly to the grid, 0 outside of the table
+def tabulated_illuminants(wavelengths, wavelengths_table, spectra_table):
+    wavelengths = np.asarray(wavelengths, dtype=np.float64)
+    wavelengths_table = np.asarray(wavelengths_table, dtype=np.float64)
+    spectra_table = np.atleast_2d(np.asarray(spectra_table, dtype=np.float64))
+
+    # The interpolation indices and weights are the same for every row
+    upper = np.clip(np.searchsorted(wavelengths_table, wavelengths), 1, len(wavelengths_table) - 1)
+    lower = upper - 1
+    fraction = (wavelengths - wavelengths_table[lower]) / (wavelengths_table[upper] - wavelengths_table[lower])
+    inside = (wavelengths >= wavelengths_table[0]) & (wavelengths <= wavelengths_table[-1])
+    spectra = spectra_table[:, lower] * (1 - fraction) + spectra_table[:, upper] * fraction
+    return np.where(inside, spectra, 0.0)
+
+
+# A broad set of simulated lighting scenarios for fitting and evaluating conversions
+#
+# Returns the spectra scaled to a radiant power of 1 and the light type of every row
+# ('led', 'white_led', 'planckian' or 'mixed').
+def scenario_spectra(wavelengths, seed=0):
+    wavelengths = np.asarray(wavelengths, dtype=np.float64)
+    rng = np.random.default_rng(seed)
+
+    centers, halfwidths = np.meshgrid(np.arange(400, 705, 5), [10, 15, 20, 25, 30, 40, 50, 60])
+    leds = gaussian_leds(wavelengths, centers.ravel(), halfwidths.ravel())
+
+    pump_centers, phosphor_ratios = np.meshgrid(np.arange(440, 465, 5), np.linspace(0.2, 1.0, 9))
+    white_leds = phosphor_white_leds(wavelengths, pump_centers=pump_centers.ravel(),
+                                     phosphor_ratios=phosphor_ratios.ravel())
+
+    planckians = planckian(wavelengths, np.geomspace(1500, 20000, 100))
+
+    # Random mixtures of two to three of the lights above
+    singles = normalize_power(np.vstack([leds, white_leds, planckians]), wavelengths)
+    weights = np.zeros((500, len(singles)))
+    for row in weights:
+        chosen = rng.choice(len(singles), size=rng.integers(2, 4), replace=False)
+        row[chosen] = rng.dirichlet(np.ones(len(chosen)))
+    mixed = mix_spectra(singles, weights)
+
+    spectra = np.vstack([singles, mixed])
+    light_types = np.array(['led'] * len(leds) + ['white_led'] * len(white_leds) +
+                           ['planckian'] * len(planckians) + ['mixed'] * len(mixed))
+    return normalize_power(spectra, wavelengths), light_types
+
+
+# Mix lights: every row of weights gives the contribution of each spectrum to one mixed light
+def mix_spectra(spectra, weights):
+    return np.atleast_2d(np.asarray(weights, dtype=np.float64)) @ np.asarray(spectra, dtype=np.float64)
+
+
+# Scale every spectrum to a radiant power (trapezoid integral) of 1
+def normalize_power(spectra, wavelengths):
+    spectra = np.asarray(spectra, dtype=np.float64)
+    return spectra / (spectra @ trapezoid_weights(wavelengths))[..., np.newaxis]
@@ -0,0 +1,190 @@
+import argparse
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from .binary_format import map_arrays, write_arrays
+from .cie import default_cmf_file
+from .converter import C_blue, C_clear, C_green, C_red, K_blue, K_green, K_red, RGB_to_XYZ_matrix, \
+    calculate_chromaticity, calculate_scale, convert_counts
+from .settings import gains, integration_time_table
+from .xyz_fit import estimate_cct_duv, planckian_locus_table, uv_to_cct_duv, xyz_to_uv
+
+# Fast conversion of raw counts to lux, XYZ/xy, CCT and Duv
+#
+# Lux and XYZ are linear in the counts, so they stay closed form: weights is (3 x 4) and maps the
+# red, green and blue counts at 1x gain and 2.4 ms to lux, X, Y and Z. Only CCT and Duv, the
+# non-linear outputs, are tabulated: table has the shape (2, u, v) with the reciprocal CCT in
+# mired and Duv on a regular CIE 1960 (u, v) grid with the axes u and v around the Planckian
+# locus. Nodes beyond the CCT range of the locus table or further than the node margin from
+# the locus are NaN, readings further than duv_max from it are out of range.
+LUT = namedtuple('LUT', ['weights', 'u', 'v', 'table', 'duv_max'])
+
+lut_magic = b'TCS34725LUT\0'
+lut_version = 2
+
+# Nodes are tabulated up to this far beyond duv_max, so readings up to duv_max have all four
+# corners of their cell
+node_margin = 0.01
+
+
+# Lux, xy and (with a Planckian table) CCT and Duv of RGB counts, computed the exact way
+def exact_outputs(red, green, blue, gain=1, integration_time=2.4, xyz_matrix=RGB_to_XYZ_matrix, cct_table=None):
+    red, green, blue = np.broadcast_arrays(*[np.asarray(c, dtype=np.float64) for c in (red, green, blue)])
+    converted = convert_counts(red, green, blue, np.zeros_like(red), gain, integration_time)
+    rgb = np.stack([red, green, blue], axis=-1)
+    X, Y, Z = np.moveaxis(rgb @ np.asarray(xyz_matrix).T, -1, 0)
+    x, y = calculate_chromaticity(X, Y, Z)
+    outputs = {'lux': converted['lux'], 'x': x, 'y': y}
+    if cct_table is not None:
+        outputs['cct'], outputs['duv'] = estimate_cct_duv(X, Y, Z, cct_table)
+    return outputs
+
+
+# Lux, X, Y and Z per red, green and blue count at 1x gain and 2.4 ms, shape (3 x 4)
+def conversion_weights(xyz_matrix=RGB_to_XYZ_matrix):
+    lux = np.array([K_red / C_red, K_green / C_green, K_blue / C_blue])
+    return np.column_stack([lux, np.asarray(xyz_matrix, dtype=np.float64).T / C_clear])
+
+
+# Tabulate CCT and Duv of the Planckian table on a (u, v) grid with the given step around the locus
+#
+# The node values come from estimate_cct_duv, CCT is stored as mired since that is close to
+# linear in (u, v) along the locus, which keeps the bilinear interpolation accurate.
+def build_lut(cct_table, step=0.001, duv_max=0.05, xyz_matrix=RGB_to_XYZ_matrix):
+    reach = duv_max + node_margin + step
+    u = np.arange(cct_table.u.min() - reach, cct_table.u.max() + reach + step, step)
+    v = np.arange(cct_table.v.min() - reach, cct_table.v.max() + reach + step, step)
+    cct, duv = uv_to_cct_duv(*np.meshgrid(u, v, indexing='ij'), cct_table)
+    tabulated = (cct >= cct_table.cct[0]) & (cct <= cct_table.cct[-1]) & (np.abs(duv) <= duv_max + node_margin)
+    table = np.where(tabulated, np.stack([1e6 / cct, duv]), np.nan)
+    return LUT(conversion_weights(xyz_matrix), u, v, table.astype(np.float32), duv_max)
+
+
+# Evaluate the LUT for a batch of raw counts at any gain and integration time (ms)
+#
+# Returns lux, X, Y, Z and xy in closed form plus CCT and Duv interpolated bilinearly over
+# (u, v) and the mask 'cct_valid'. CCT and Duv are NaN where it is False: readings further
+# than duv_max from the locus or outside the CCT range of the table.
+def evaluate_lut(lut, red, green, blue, gain=1, integration_time=2.4):
+    inv_scale = 1 / calculate_scale(gain, integration_time)
+    rgb = np.stack(np.broadcast_arrays(*[np.asarray(c, dtype=np.float64) for c in (red, green, blue)]))
+    lux, X, Y, Z = (lut.weights.T @ rgb.reshape(3, -1)).reshape((4,) + rgb.shape[1:]) * inv_scale
+    x, y = calculate_chromaticity(X, Y, Z)
+    u, v = xyz_to_uv(X, Y, Z)
+
+    # Cell of every reading, readings outside the grid use cell (0, 0) and are masked by inside
+    fu = (u - lut.u[0]) * (1 / (lut.u[1] - lut.u[0]))
+    fv = (v - lut.v[0]) * (1 / (lut.v[1] - lut.v[0]))
+    inside = (fu >= 0) & (fu < len(lut.u) - 1) & (fv >= 0) & (fv < len(lut.v) - 1)
+    i = np.where(inside, fu, 0).astype(np.intp)
+    j = np.where(inside, fv, 0).astype(np.intp)
+    a = fu - i
+    b = fv - j
+
+    size_v = len(lut.v)
+    corner = i * size_v + j
+
+    def interpolate(table):
+        values = np.asarray(table).ravel()
+        return (values[corner] * (1 - b) + values[corner + 1] * b) * (1 - a) + \
+            (values[corner + size_v] * (1 - b) + values[corner + size_v + 1] * b) * a
+
+    mired = interpolate(lut.table[0])
+    duv = interpolate(lut.table[1])
+    cct_valid = inside & ~np.isnan(mired) & (np.abs(duv) <= lut.duv_max)
+    return {'lux': lux, 'X': X, 'Y': Y, 'Z': Z, 'x': x, 'y': y,
+            'cct': np.where(cct_valid, 1e6 / mired, np.nan), 'duv': np.where(cct_valid, duv, np.nan),
+            'cct_valid': cct_valid}
+
+
+# Compare the LUT with the exact path on random readings of random settings
+#
+# Lux errors are relative, the others absolute. CCT (relative) and Duv are compared for the
+# readings within duv_max of the locus that the LUT covers, 'coverage' is their share of all
+# readings within duv_max.
+def lut_error(lut, cct_table, samples=100000, xyz_matrix=RGB_to_XYZ_matrix, seed=0):
+    rng = np.random.default_rng(seed)
+    rgb = rng.dirichlet(np.ones(3), samples) * rng.uniform(10, 60000, (samples, 1))
+    gain = rng.choice(gains, samples)
+    integration_time = rng.choice(integration_time_table, samples)
+
+    exact = exact_outputs(*rgb.T, gain, integration_time, xyz_matrix, cct_table)
+    approximated = evaluate_lut(lut, *rgb.T, gain, integration_time)
+    near_locus = (np.abs(exact['duv']) <= lut.duv_max) & (exact['cct'] >= cct_table.cct[0]) & \
+        (exact['cct'] <= cct_table.cct[-1])
+    covered = near_locus & approximated['cct_valid']
+    report = {}
+    for name in ['lux', 'x', 'y', 'cct', 'duv']:
+        error = np.abs(approximated[name] - exact[name])
+        reference = exact[name]
+        if name in ('cct', 'duv'):
+            error, reference = error[covered], reference[covered]
+        if name in ('lux', 'cct'):
+            error = error / np.maximum(np.abs(reference), 1e-12)
+        report[name] = {'mean': float(np.mean(error)), 'p99': float(np.percentile(error, 99)),
+                        'max': float(np.max(error))}
+    report['coverage'] = float(covered.sum() / max(near_locus.sum(), 1))
+    return report
+
+
+# Readings per second of evaluate_lut and of convert_counts plus estimate_cct_duv on the same batch
+def lut_speed(lut, cct_table, samples=1000000, seed=0):
+    rng = np.random.default_rng(seed)
+    red, green, blue = rng.dirichlet(np.ones(3), samples).T * rng.uniform(10, 60000, samples)
+
+    def exact():
+        converted = convert_counts(red, green, blue, np.zeros_like(red))
+        estimate_cct_duv(converted['X'], converted['Y'], converted['Z'], cct_table)
+
+    rates = {}
+    for name, function in [('evaluate_lut', lambda: evaluate_lut(lut, red, green, blue)),
+                           ('convert_counts', lambda: convert_counts(red, green, blue, np.zeros_like(red))),
+                           ('convert_counts + estimate_cct_duv', exact)]:
+        start = time.perf_counter()
+        function()
+        rates[name] = samples / (time.perf_counter() - start)
+    return rates
+
+
+# Write the LUT as a binary file: magic, header length, JSON header, then the 64 byte aligned arrays
+def write_lut(lut, lut_file):
+    arrays = {'weights': lut.weights.astype('<f8'), 'u': lut.u.astype('<f8'), 'v': lut.v.astype('<f8'),
+              'table': lut.table.astype('<f4')}
+    write_arrays(lut_file, lut_magic, {'version': lut_version, 'duv_max': lut.duv_max}, arrays)
+
+
+# Load a LUT file, the arrays are read-only memory maps of the file
+def load_lut(lut_file):
+    header, arrays = map_arrays(lut_file, lut_magic, 'TCS34725 LUT')
+    if header['version'] != lut_version:
+        raise ValueError(f"Unsupported LUT version {header['version']}")
+    return LUT(arrays['weights'], arrays['u'], arrays['v'], arrays['table'], header['duv_max'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export the lux/xy/CCT conversion as a lookup table.')
+    parser.add_argument('-o', '--output', default='tcs34725.lut', help='LUT file')
+    parser.add_argument('--cmf', default=default_cmf_file, help='CIE 1931 2° color-matching functions CSV')
+    parser.add_argument('--step', type=float, default=0.001, help='(u, v) grid step')
+    parser.add_argument('--duv-max', type=float, default=0.05, help='largest distance from the locus with a CCT')
+    args = parser.parse_args()
+
+    cct_table = planckian_locus_table(args.cmf)
+    write_lut(build_lut(cct_table, args.step, args.duv_max), args.output)
+    lut = load_lut(args.output)
+    print(f"Written {args.output}")
+    print("LUT error against the exact conversion (lux and CCT relative, others absolute):")
+    report = lut_error(lut, cct_table)
+    coverage = report.pop('coverage')
+    for name, error in report.items():
+        print(f"  {name}: mean {error['mean']:.3g}, p99 {error['p99']:.3g}, max {error['max']:.3g}")
+    print(f"  {coverage:.2%} of the readings within Duv ±{args.duv_max} have a CCT")
+    print("Readings per second:")
+    for name, rate in lut_speed(lut, cct_table).items():
+        print(f"  {name}: {rate:.3g}")
+
+
+if __name__ == '__main__':
+    main()
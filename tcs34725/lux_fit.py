@@ -0,0 +1,139 @@
+import argparse
+from collections import namedtuple
+
+import numpy as np
+
+from .calibration import counts_per_uW_cm2, interpolate_response
+from .cie import default_photopic_file, load_photopic
+from .converter import C_blue, C_green, C_red, K_blue, K_green, K_red, calculate_scale, graph_conversion_factor, \
+    reject_ir
+from .integration import integrate_spectra
+from .light_sources import scenario_spectra
+from .responsivity import channels, default_responsivity_file, load_responsivity_grid
+from .settings import inverse_scale_table
+from .xyz_fit import fit_channels, fit_inputs
+
+# Luminous efficacy of radiation at 555 nm, lm/W
+max_luminous_efficacy = 683.0
+
+# Result of a fit: lux per count (at 1x gain and 2.4 ms) of every input channel, the channels,
+# whether the IR estimate of reject_ir is removed from the counts first and the relative lux
+# error on the training set per light type
+LuxFit = namedtuple('LuxFit', ['weights', 'channels', 'ir_rejection', 'relative_error'])
+
+
+# Lux of spectra with a radiant power of 1 µW/cm² each (0.01 W/m²)
+def spectra_lux(spectra, wavelengths, V_lambda):
+    return max_luminous_efficacy * 0.01 * integrate_spectra(spectra, wavelengths, [V_lambda])[:, 0]
+
+
+# Weighted least squares fit of lux ≈ inputs · weights
+#
+# counts has one column per entry of `channels`, at 1x gain and 2.4 ms, the inputs are their
+# fit_inputs. The error is relative above lux_floor and absolute below it, weights (one per
+# light, default 1) scale it. ridge penalizes the square of every weight times the weighted sum
+# of squares of its input, a weight carrying the whole lux costs about a relative error of √ridge.
+def fit_counts_to_lux(counts, lux, weights=None, channel_names=fit_channels, lux_floor=0.0, ir_rejection=True,
+                      ridge=0.0):
+    lux = np.asarray(lux, dtype=np.float64)
+    A = fit_inputs(counts, channel_names, ir_rejection)
+    if weights is None:
+        weights = np.ones(len(lux))
+    sqrt_weights = np.sqrt(weights) / np.maximum(lux, lux_floor)
+    A = A * sqrt_weights[:, np.newaxis]
+    penalty = np.sqrt(ridge * np.sum(A ** 2, axis=0))
+    solution, _, _, _ = np.linalg.lstsq(np.vstack([A, np.diag(penalty)]),
+                                        np.concatenate([lux * sqrt_weights, np.zeros(len(penalty))]), rcond=None)
+    return solution
+
+
+# Mean and 95th percentile of the absolute relative error, its max and the mean signed error (bias),
+# over all lights and for every light type
+def relative_lux_error(lux_estimated, lux, light_types):
+    relative = lux_estimated / lux - 1
+    groups = {'all': np.ones(len(lux), dtype=bool)}
+    groups.update({light_type: light_types == light_type for light_type in np.unique(light_types)})
+    return {name: {'mean': float(np.mean(np.abs(relative[mask]))),
+                   'p95': float(np.percentile(np.abs(relative[mask]), 95)),
+                   'max': float(np.max(np.abs(relative[mask]))),
+                   'bias': float(np.mean(relative[mask]))}
+            for name, mask in groups.items()}
+
+
+# Lux of the current factors: Σ K · irradiance with the irradiance of the R, G and B counts
+def fwhm_factor_lux(counts):
+    counts = np.asarray(counts, dtype=np.float64)
+    return sum(K * counts[:, channels.index(ch)] / C
+               for ch, K, C in [('Red', K_red, C_red), ('Green', K_green, C_green), ('Blue', K_blue, C_blue)])
+
+
+# Fit lux weights over simulated lights from the responsivity curves and V(λ)
+#
+# Unlike the lux script, which sums response × V(λ) over each channel's FWHM and splits the
+# D65 constant by those ratios, the weights are fitted so the weighted channel counts match
+# the lux of every training spectrum over the full sensor range. The spectra default to
+# scenario_spectra, without weights every light type weighs the same in total. Returns the
+# fit and the error of the current FWHM factors on the same set.
+def fit_lux_weights(responsivity_file=default_responsivity_file, photopic_file=default_photopic_file,
+                    conversion_factor=graph_conversion_factor, spectra=None, light_types=None, wavelengths=None,
+                    weights=None, channel_names=fit_channels, lux_floor=0.0, ir_rejection=True, ridge=0.0):
+    wavelengths, responsivity = load_responsivity_grid(wavelengths, responsivity_file)
+    wavelengths_cie, V_lambda = load_photopic(photopic_file)
+    V_lambda = interpolate_response(wavelengths_cie, V_lambda, wavelengths)
+    if spectra is None:
+        spectra, light_types = scenario_spectra(wavelengths)
+    if light_types is None:
+        light_types = np.array(['all'] * len(spectra))
+    if weights is None:
+        _, type_index, type_counts = np.unique(light_types, return_inverse=True, return_counts=True)
+        weights = 1 / type_counts[type_index]
+
+    counts = counts_per_uW_cm2(spectra, wavelengths, responsivity, conversion_factor)
+    lux = spectra_lux(spectra, wavelengths, V_lambda)
+    lux_weights = fit_counts_to_lux(counts, lux, weights, channel_names, lux_floor, ir_rejection, ridge)
+    lux_fitted = fit_inputs(counts, channel_names, ir_rejection) @ lux_weights
+    fit = LuxFit(lux_weights, list(channel_names), ir_rejection, relative_lux_error(lux_fitted, lux, light_types))
+    return fit, relative_lux_error(fwhm_factor_lux(counts), lux, light_types)
+
+
+# Apply fitted weights to a batch of raw counts at any gain and integration time (ms)
+def counts_to_lux(fit, red, green, blue, clear, gain=1, integration_time=2.4):
+    readings = {'Red': red, 'Green': green, 'Blue': blue, 'Clear': clear}
+    if fit.ir_rejection:
+        rejected = reject_ir(red, green, blue, clear)
+        readings = {ch: rejected[ch.lower()] for ch in readings}
+    inv_scale = 1.0 / calculate_scale(gain, integration_time)
+    weights = np.asarray(fit.weights, dtype=np.float64)
+    lux = sum(weight * np.asarray(readings[ch], dtype=np.float64) for weight, ch in zip(weights, fit.channels))
+    return lux * inv_scale
+
+
+# Same as counts_to_lux, but with the AGAIN (0-3) and ATIME (0-255) register values of every reading
+def register_counts_to_lux(fit, red, green, blue, clear, again, atime, inverse_scale=inverse_scale_table):
+    inv_scale = inverse_scale[np.asarray(again, dtype=np.intp), np.asarray(atime, dtype=np.intp)]
+    return counts_to_lux(fit, red, green, blue, clear) * inv_scale
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fit lux weights of the channels over simulated lights.')
+    parser.add_argument('--responsivity', default=default_responsivity_file, help='responsivity CSV or .dig file')
+    parser.add_argument('--photopic', default=default_photopic_file, help='CIE photopic V(λ) CSV')
+    parser.add_argument('--lux-floor', type=float, default=0.0, help='lux below which the error is absolute')
+    parser.add_argument('--ridge', type=float, default=0.0, help='penalty of the weights, relative to their inputs')
+    parser.add_argument('--no-ir-rejection', dest='ir_rejection', action='store_false',
+                        help='fit the raw counts instead of the IR-rejected ones')
+    args = parser.parse_args()
+
+    fit, fwhm_errors = fit_lux_weights(args.responsivity, args.photopic, lux_floor=args.lux_floor,
+                                       ir_rejection=args.ir_rejection, ridge=args.ridge)
+    for ch, weight in zip(fit.channels, fit.weights):
+        print(f'{ch}: {weight:.6g} lux per count')
+    print('light type,fit mean,fit p95,fit bias,FWHM mean,FWHM p95,FWHM bias')
+    for light_type, error in fit.relative_error.items():
+        old = fwhm_errors[light_type]
+        print(f"{light_type},{error['mean']:.4f},{error['p95']:.4f},{error['bias']:.4f},"
+              f"{old['mean']:.4f},{old['p95']:.4f},{old['bias']:.4f}")
+
+
+if __name__ == '__main__':
+    main()
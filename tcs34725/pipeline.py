@@ -0,0 +1,288 @@
+import argparse
+import functools
+import graphlib
+import hashlib
+import inspect
+import json
+import os
+import sys
+from collections import namedtuple
+
+from . import calibration
+from .binary_format import hash_file
+from .cie import default_cmf_file, default_photopic_file, interpolate_cmfs, load_cie_cmfs, load_photopic
+from .responsivity import channels, default_responsivity_file, load_responsivity_channels, read_responsivity, \
+    wavelength_grid
+from .xyz_fit import fit_xyz_matrix
+
+# Sources a stage input can be taken from: a file path, a parameter or another stage's output
+FileInput = namedtuple('FileInput', ['name'])
+ParamInput = namedtuple('ParamInput', ['name'])
+StageOutput = namedtuple('StageOutput', ['stage', 'output'])
+
+# A pipeline stage: inputs maps the function's arguments to their sources,
+# outputs maps the names of the returned values to their types
+Stage = namedtuple('Stage', ['name', 'function', 'inputs', 'outputs'])
+
+
+# Simulate the datasheet LEDs on the Clear channel to scale the graph to counts per µW/cm²
+def graph_conversion_factor_stage(responsivity_file, leds, grid_step):
+    wavelengths, responsivity = load_responsivity_channels(
+        calibration.simulation_grid(responsivity_file, grid_step, leds), responsivity_file=responsivity_file)
+    led_conversion_factors, conversion_factor = calibration.calculate_graph_conversion_factor(
+        wavelengths, responsivity['Clear'], leds)
+    return {'led_conversion_factors': led_conversion_factors, 'conversion_factor': conversion_factor}
+
+
+# Counts per µW/cm² of each channel at the requested gain and integration time
+#
+# The analytic FWHM integrals work on the PCHIP interpolant of the measured samples, so only the
+# sampled ones depend on the grid step.
+def channel_conversion_factors_stage(responsivity_file, conversion_factor, gain, integration_time, grid_step, fwhm):
+    if fwhm == 'analytic':
+        wavelengths, responsivity = read_responsivity(responsivity_file)
+        responsivity = dict(zip(channels, responsivity))
+    else:
+        wavelengths, responsivity = load_responsivity_channels(calibration.integer_grid(responsivity_file, grid_step),
+                                                               responsivity_file=responsivity_file)
+    return {'channel_conversion_factors': calibration.calculate_channel_conversion_factors(
+        wavelengths, responsivity, conversion_factor, gain, integration_time, fwhm)}
+
+
+# Lux per µW/cm² for the Red, Green and Blue channels
+def lux_factors_stage(responsivity_file, photopic_file, channel_conversion_factors, irradiance_per_lux, grid_step,
+                      fwhm):
+    wavelengths_cie, V_lambda = load_photopic(photopic_file)
+    return {'lux_factors': calibration.calculate_lux_factors(
+        responsivity_file, channel_conversion_factors, wavelengths_cie, V_lambda, irradiance_per_lux, grid_step,
+        fwhm)}
+
+
+# Counts per µW/cm² of every channel for the reference LEDs
+def led_channel_counts_stage(responsivity_file, leds, grid_step):
+    wavelengths, responsivity = load_responsivity_channels(
+        calibration.simulation_grid(responsivity_file, grid_step, leds), responsivity_file=responsivity_file)
+    return {'led_data': calibration.calculate_led_channel_counts(wavelengths, responsivity, leds)}
+
+
+def normalized_rgb_stage(led_data):
+    return {'normalized_rgb': calibration.normalize_rgb(led_data)}
+
+
+# XYZ tristimulus values of the reference LEDs on a 1 nm grid from 360 nm to 830 nm
+def led_xyz_stage(cmf_file, leds):
+    wavelengths_cie, cmfs = load_cie_cmfs(cmf_file)
+    wavelengths = wavelength_grid(360, 830)
+    return {'led_xyz': calibration.calculate_led_xyz(wavelengths, interpolate_cmfs(wavelengths_cie, cmfs, wavelengths),
+                                                     leds)}
+
+
+def rgb_to_xyz_matrix_stage(led_xyz, normalized_rgb):
+    return {'RGB_to_XYZ_matrix': calibration.calculate_rgb_to_xyz_matrix(led_xyz, normalized_rgb).tolist()}
+
+
+# Counts to XYZ matrix fitted over simulated lights, as an alternative to the three LED matrix
+def fitted_xyz_matrix_stage(responsivity_file, cmf_file, conversion_factor):
+    fit, _ = fit_xyz_matrix(responsivity_file, cmf_file, conversion_factor)
+    return {'counts_to_XYZ_matrix': fit.matrix.tolist(), 'channels': fit.channels,
+            'ir_rejection': fit.ir_rejection, 'xy_error': fit.xy_error}
+
+
+# The README workflow as a dependency graph
+calibration_stages = [
+    Stage('graph_conversion_factor', graph_conversion_factor_stage,
+          {'responsivity_file': FileInput('responsivity'), 'leds': ParamInput('graph_leds'),
+           'grid_step': ParamInput('grid_step')},
+          {'led_conversion_factors': dict, 'conversion_factor': float}),
+    Stage('channel_conversion_factors', channel_conversion_factors_stage,
+          {'responsivity_file': FileInput('responsivity'),
+           'conversion_factor': StageOutput('graph_conversion_factor', 'conversion_factor'),
+           'gain': ParamInput('gain'), 'integration_time': ParamInput('integration_time'),
+           'grid_step': ParamInput('grid_step'), 'fwhm': ParamInput('fwhm')},
+          {'channel_conversion_factors': dict}),
+    Stage('lux_factors', lux_factors_stage,
+          {'responsivity_file': FileInput('responsivity'), 'photopic_file': FileInput('photopic'),
+           'channel_conversion_factors': StageOutput('channel_conversion_factors', 'channel_conversion_factors'),
+           'irradiance_per_lux': ParamInput('irradiance_per_lux'), 'grid_step': ParamInput('grid_step'),
+           'fwhm': ParamInput('fwhm')},
+          {'lux_factors': dict}),
+    Stage('led_channel_counts', led_channel_counts_stage,
+          {'responsivity_file': FileInput('responsivity'), 'leds': ParamInput('channel_leds'),
+           'grid_step': ParamInput('grid_step')},
+          {'led_data': dict}),
+    Stage('normalized_rgb', normalized_rgb_stage,
+          {'led_data': StageOutput('led_channel_counts', 'led_data')},
+          {'normalized_rgb': dict}),
+    Stage('led_xyz', led_xyz_stage,
+          {'cmf_file': FileInput('cmf'), 'leds': ParamInput('channel_leds')},
+          {'led_xyz': dict}),
+    Stage('rgb_to_xyz_matrix', rgb_to_xyz_matrix_stage,
+          {'led_xyz': StageOutput('led_xyz', 'led_xyz'),
+           'normalized_rgb': StageOutput('normalized_rgb', 'normalized_rgb')},
+          {'RGB_to_XYZ_matrix': list}),
+    Stage('fitted_xyz_matrix', fitted_xyz_matrix_stage,
+          {'responsivity_file': FileInput('responsivity'), 'cmf_file': FileInput('cmf'),
+           'conversion_factor': StageOutput('graph_conversion_factor', 'conversion_factor')},
+          {'counts_to_XYZ_matrix': list, 'channels': list, 'ir_rejection': bool, 'xy_error': dict}),
+]
+
+default_files = {
+    'responsivity': default_responsivity_file,
+    'cmf': default_cmf_file,
+    'photopic': default_photopic_file
+}
+
+default_params = {
+    'graph_leds': calibration.graph_reference_leds,
+    'channel_leds': calibration.channel_reference_leds,
+    'gain': 1,
+    'integration_time': 2.4,
+    'irradiance_per_lux': calibration.irradiance_per_lux,
+    'grid_step': 1,  # nm or 'adaptive', of the grids of the LED simulations, channel and lux factors
+    'fwhm': 'analytic'  # FWHM windows of the channel and lux factors, 'sampled' reproduces the scripts
+}
+
+
+def _hash_json(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode()).hexdigest()
+
+
+# Hash of a stage function's source and of the source files of every module of this package it
+# depends on, directly or through their imports, so editing a stage or the calibration code it
+# calls invalidates the recorded outputs
+@functools.lru_cache(maxsize=None)
+def _code_hash(function):
+    digest = hashlib.sha256(inspect.getsource(function).encode())
+    pending = [function.__globals__[name] for name in function.__code__.co_names if name in function.__globals__]
+    modules = {}
+    while pending:
+        value = pending.pop()
+        if inspect.ismodule(value):
+            module = value
+        elif inspect.isfunction(value) or inspect.isclass(value):
+            module = sys.modules.get(value.__module__)
+        else:
+            continue
+        if module is None or module.__name__ in modules or module.__name__ == __name__ or \
+                not module.__name__.startswith(f'{__package__}.'):
+            continue
+        modules[module.__name__] = module.__file__
+        pending.extend(vars(module).values())
+    for name in sorted(modules):
+        digest.update(hash_file(modules[name]).encode())
+    return digest.hexdigest()
+
+
+# Stages in dependency order, limited to the ones the targets need
+def order_stages(stages, targets=None):
+    by_name = {stage.name: stage for stage in stages}
+    graph = {stage.name: {source.stage for source in stage.inputs.values() if isinstance(source, StageOutput)}
+             for stage in stages}
+    for name, dependencies in graph.items():
+        unknown = dependencies - by_name.keys()
+        if unknown:
+            raise ValueError(f"Stage '{name}' depends on unknown stages: {sorted(unknown)}")
+
+    if targets is not None:
+        needed = set()
+        pending = list(targets)
+        while pending:
+            name = pending.pop()
+            if name not in by_name:
+                raise ValueError(f"Unknown stage '{name}'")
+            if name not in needed:
+                needed.add(name)
+                pending.extend(graph[name])
+        graph = {name: graph[name] for name in needed}
+
+    return [by_name[name] for name in graphlib.TopologicalSorter(graph).static_order()]
+
+
+# Run the stages whose inputs changed since the last run recorded in state_file
+#
+# Every stage input is content-hashed: files by their bytes, parameters and upstream
+# outputs by their JSON form, and the stage's code by _code_hash. A stage whose input hash
+# matches the state file reuses its recorded outputs, so only the stages downstream of a
+# change are re-run.
+# Returns the outputs of all run stages and the names of the stages that were executed.
+def run_pipeline(stages=calibration_stages, files=None, params=None, state_file=None, targets=None, force=False):
+    files = {**default_files, **(files or {})}
+    params = {**default_params, **(params or {})}
+
+    state = {}
+    if state_file is not None and os.path.exists(state_file):
+        with open(state_file) as f:
+            state = json.load(f)
+
+    file_hashes = {}
+    results = {}
+    executed = []
+    for stage in order_stages(stages, targets):
+        arguments = {}
+        input_hashes = {}
+        for argument, source in stage.inputs.items():
+            if isinstance(source, FileInput):
+                path = files[source.name]
+                if path not in file_hashes:
+                    file_hashes[path] = hash_file(path)
+                arguments[argument] = path
+                input_hashes[argument] = file_hashes[path]
+            elif isinstance(source, ParamInput):
+                arguments[argument] = params[source.name]
+                input_hashes[argument] = _hash_json(params[source.name])
+            else:
+                arguments[argument] = results[source.stage][source.output]
+                input_hashes[argument] = _hash_json(arguments[argument])
+        input_hash = _hash_json({'function': stage.function.__qualname__, 'code': _code_hash(stage.function),
+                                 'inputs': input_hashes})
+
+        recorded = state.get(stage.name)
+        if not force and recorded is not None and recorded['input_hash'] == input_hash:
+            results[stage.name] = recorded['outputs']
+            continue
+
+        outputs = stage.function(**arguments)
+        for output, output_type in stage.outputs.items():
+            if not isinstance(outputs.get(output), output_type):
+                raise TypeError(f"Stage '{stage.name}' output '{output}' must be {output_type.__name__}, "
+                                f"got {type(outputs.get(output)).__name__}")
+
+        # Round-trip through JSON so fresh and recorded outputs look the same downstream
+        results[stage.name] = json.loads(json.dumps(outputs))
+        state[stage.name] = {'input_hash': input_hash, 'outputs': results[stage.name]}
+        executed.append(stage.name)
+
+    if state_file is not None and executed:
+        tmp_file = state_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(state, f, indent=2, sort_keys=True)
+        os.replace(tmp_file, state_file)
+
+    return results, executed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the calibration pipeline, re-running only changed stages.')
+    parser.add_argument('--responsivity', default=default_files['responsivity'], help='sensor responsivity CSV')
+    parser.add_argument('--cmf', default=default_files['cmf'], help='CIE 1931 2° color-matching functions CSV')
+    parser.add_argument('--photopic', default=default_files['photopic'], help='CIE photopic V(λ) CSV')
+    parser.add_argument('--params', help='JSON file overriding the default parameters')
+    parser.add_argument('--state', default='calibration_state.json', help='state file of the previous run')
+    parser.add_argument('--target', action='append', dest='targets', help='only run the stages this one needs')
+    parser.add_argument('--force', action='store_true', help='re-run all stages')
+    args = parser.parse_args()
+
+    params = None
+    if args.params:
+        with open(args.params) as f:
+            params = json.load(f)
+
+    results, executed = run_pipeline(files={'responsivity': args.responsivity, 'cmf': args.cmf,
+                                            'photopic': args.photopic},
+                                     params=params, state_file=args.state, targets=args.targets, force=args.force)
+    print(f"Executed stages: {', '.join(executed) if executed else 'none'}")
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
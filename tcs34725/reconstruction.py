@@ -0,0 +1,175 @@
+import argparse
+import hashlib
+import os
+from collections import namedtuple
+
+import numpy as np
+
+from .binary_format import atomic_write, hash_file
+from .calibration import counts_per_uW_cm2, graph_counts_scale
+from .cie import default_cmf_file, interpolate_cmfs, load_cie_cmfs
+from .converter import calculate_chromaticity, calculate_scale, graph_conversion_factor
+from .integration import trapezoid_weights
+from .light_sources import scenario_spectra
+from .lux_fit import max_luminous_efficacy
+from .responsivity import channels, default_cache_dir, default_responsivity_file, load_responsivity_grid
+
+reconstruction_version = 2
+
+# Band the training spectra are normalized over, nm: their power beyond it (mostly the IR of warm
+# Planckians) would otherwise dominate the basis, and the visible shape is what XYZ depends on
+visible_band = (380, 780)
+
+# Linear map from a batch of (reading x channel) counts at 1x gain and 2.4 ms to X, Y, Z (Y in lux)
+# and the spectral irradiance in µW/cm²/nm at the wavelengths: outputs = counts @ matrix, matrix is
+# (channel x (3 + wavelength)) with the channels ordered like `channels`
+ReconstructionOperator = namedtuple('ReconstructionOperator', ['wavelengths', 'matrix'])
+
+# Operators already loaded by this process, keyed by their cache key
+_loaded_operators = {}
+
+
+# The first components of the singular value decomposition of spectra, shape (component x wavelength)
+#
+# The spectra aren't centered, so the first component is their common shape and the basis spans
+# the training spectra themselves instead of their deviation from the mean. Every component is
+# scaled by its singular value, so the regularization of build_reconstruction penalizes the
+# coefficients relative to their spread over the training spectra.
+def spectral_basis(spectra, components=6):
+    _, singular_values, vt = np.linalg.svd(np.asarray(spectra, dtype=np.float64), full_matrices=False)
+    return vt[:components] * singular_values[:components, np.newaxis]
+
+
+# Scale every spectrum to a power (trapezoid integral) of 1 within visible_band
+def normalize_visible_power(spectra, wavelengths, band=visible_band):
+    wavelengths = np.asarray(wavelengths, dtype=np.float64)
+    visible = (wavelengths >= band[0]) & (wavelengths <= band[1])
+    weights = np.where(visible, trapezoid_weights(wavelengths), 0)
+    spectra = np.asarray(spectra, dtype=np.float64)
+    return spectra / (spectra @ weights)[..., np.newaxis]
+
+
+# Regularized pseudo-inverse of the sensor for spectra in the span of the basis
+#
+# A reading m of a spectrum s = Bᵀc is m = A s with A the (channel x wavelength) counts per
+# µW/cm²/nm at 1x/2.4 ms. With M = ABᵀ the coefficients c = (MᵀM + λI)⁻¹ Mᵀ m minimize the
+# reading error plus λ |c|², λ is regularization times the largest eigenvalue of MᵀM so it
+# doesn't depend on the units. Components with larger rows are penalized less, see spectral_basis.
+# The spectrum and its XYZ follow linearly, so both are folded into one matrix.
+def build_reconstruction(wavelengths, responsivity, basis, cmfs, regularization=1e-3,
+                         conversion_factor=graph_conversion_factor):
+    wavelengths = np.asarray(wavelengths, dtype=np.float64)
+    basis = np.atleast_2d(np.asarray(basis, dtype=np.float64))
+    weights = trapezoid_weights(wavelengths)
+    A = np.asarray(responsivity, dtype=np.float64) * weights * graph_counts_scale(conversion_factor)
+
+    M = A @ basis.T  # (channel x component)
+    normal = M.T @ M
+    normal += regularization * np.linalg.eigvalsh(normal)[-1] * np.eye(len(normal))
+    inverse = np.linalg.solve(normal, M.T)  # (component x channel)
+    spectra = basis.T @ inverse  # (wavelength x channel)
+
+    # Illuminance in lux of spectral irradiance in µW/cm²/nm: 683 lm/W · 0.01 (W/m²)/(µW/cm²)
+    XYZ = (max_luminous_efficacy * 0.01 * np.asarray(cmfs, dtype=np.float64) * weights) @ spectra
+    return ReconstructionOperator(wavelengths, np.vstack([XYZ, spectra]).T)
+
+
+def _cache_key(responsivity_file, cmf_file, wavelengths, basis_key, regularization):
+    digest = hashlib.sha256()
+    for path in [responsivity_file, cmf_file]:
+        digest.update(hash_file(path).encode())
+    digest.update(np.ascontiguousarray(wavelengths, dtype=np.float64).tobytes())
+    digest.update(f'{basis_key};regularization={regularization!r};version={reconstruction_version}'.encode())
+    return digest.hexdigest()
+
+
+# Load the reconstruction operator of a responsivity, building it only if it isn't cached yet
+#
+# Without a basis the first components of the scenario lights (light_sources.scenario_spectra),
+# normalized by their visible power, are used. The operator is cached as .npz in the cache directory next to the responsivity grids,
+# keyed by the source files, the grid, the basis and the regularization.
+def load_reconstruction(responsivity_file=default_responsivity_file, cmf_file=default_cmf_file, basis=None,
+                        components=6, regularization=1e-3, wavelengths=None, cache_dir=None):
+    wavelengths, responsivity = load_responsivity_grid(wavelengths, responsivity_file)
+    if basis is None:
+        basis_key = f'scenario;components={components};visible_band={visible_band}'
+    else:
+        basis = np.asarray(basis, dtype=np.float64)
+        basis_key = hashlib.sha256(np.ascontiguousarray(basis).tobytes()).hexdigest()
+    key = _cache_key(responsivity_file, cmf_file, wavelengths, basis_key, regularization)
+    if key in _loaded_operators:
+        return _loaded_operators[key]
+
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    cache_file = os.path.join(cache_dir, f'reconstruction_{key}.npz')
+    if not os.path.exists(cache_file):
+        if basis is None:
+            spectra, _ = scenario_spectra(wavelengths)
+            basis = spectral_basis(normalize_visible_power(spectra, wavelengths), components)
+        wavelengths_cie, cmfs = load_cie_cmfs(cmf_file)
+        operator = build_reconstruction(wavelengths, responsivity, basis,
+                                        interpolate_cmfs(wavelengths_cie, cmfs, wavelengths), regularization)
+        atomic_write(cache_file, lambda f: np.savez(f, wavelengths=operator.wavelengths, matrix=operator.matrix))
+
+    with np.load(cache_file) as data:
+        operator = ReconstructionOperator(data['wavelengths'], data['matrix'])
+    _loaded_operators[key] = operator
+    return operator
+
+
+# (reading x channel) counts at 1x gain and 2.4 ms of raw counts at any gain and integration time (ms),
+# the columns are ordered like `channels`
+def _reference_counts(clear, red, green, blue, gain, integration_time):
+    readings = {'Clear': clear, 'Red': red, 'Green': green, 'Blue': blue}
+    counts = np.stack(np.broadcast_arrays(*[np.asarray(readings[ch], dtype=np.float64) for ch in channels]), axis=-1)
+    return counts / calculate_scale(gain, integration_time)[..., np.newaxis]
+
+
+# Reconstructed spectral irradiance (µW/cm²/nm at operator.wavelengths) of a batch of raw counts
+#
+# The result has one spectrum per reading, so batches of millions of readings should be split.
+def reconstruct_spectra(operator, clear, red, green, blue, gain=1, integration_time=2.4):
+    return _reference_counts(clear, red, green, blue, gain, integration_time) @ operator.matrix[:, 3:]
+
+
+# Lux, XYZ and xy of the reconstructed spectra of a batch of raw counts, without forming the spectra
+def reconstruct_xyz(operator, clear, red, green, blue, gain=1, integration_time=2.4):
+    XYZ = _reference_counts(clear, red, green, blue, gain, integration_time) @ operator.matrix[:, :3]
+    X, Y, Z = XYZ[..., 0], XYZ[..., 1], XYZ[..., 2]
+    x, y = calculate_chromaticity(X, Y, Z)
+    return {'lux': Y, 'X': X, 'Y': Y, 'Z': Z, 'x': x, 'y': y}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the spectral reconstruction operator and report its error '
+                                                 'on the scenario lights.')
+    parser.add_argument('--responsivity', default=default_responsivity_file, help='responsivity CSV or .dig file')
+    parser.add_argument('--cmf', default=default_cmf_file, help='CIE 1931 2° color-matching functions CSV')
+    parser.add_argument('--components', type=int, default=6, help='basis components')
+    parser.add_argument('--regularization', type=float, default=1e-3, help='relative Tikhonov regularization')
+    args = parser.parse_args()
+
+    operator = load_reconstruction(args.responsivity, args.cmf, components=args.components,
+                                   regularization=args.regularization)
+    wavelengths, responsivity = load_responsivity_grid(operator.wavelengths, args.responsivity)
+    spectra, light_types = scenario_spectra(wavelengths, seed=1)
+    counts = counts_per_uW_cm2(spectra, wavelengths, responsivity)
+    wavelengths_cie, cmfs = load_cie_cmfs(args.cmf)
+    XYZ = spectra @ (max_luminous_efficacy * 0.01 * interpolate_cmfs(wavelengths_cie, cmfs, wavelengths) *
+                     trapezoid_weights(wavelengths)).T
+
+    columns = [counts[:, channels.index(ch)] for ch in ['Clear', 'Red', 'Green', 'Blue']]
+    result = reconstruct_xyz(operator, *columns)
+    lux_error = np.abs(result['lux'] / XYZ[:, 1] - 1)
+    x, y = calculate_chromaticity(*XYZ.T)
+    xy_error = np.hypot(result['x'] - x, result['y'] - y)
+    print('light type,lux error median,lux error p95,xy error median,xy error p95')
+    for light_type in np.unique(light_types):
+        mask = light_types == light_type
+        print(f'{light_type},{np.median(lux_error[mask]):.4f},{np.percentile(lux_error[mask], 95):.4f},'
+              f'{np.median(xy_error[mask]):.4f},{np.percentile(xy_error[mask], 95):.4f}')
+
+
+if __name__ == '__main__':
+    main()
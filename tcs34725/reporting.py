@@ -0,0 +1,166 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .binary_format import atomic_write, hash_file
+from .cie import default_cmf_file, load_cie_cmfs
+from .converter import calculate_chromaticity
+from .gamut import channel_gamuts, gamut_grid, gamut_triangles, reference_gamuts
+from .responsivity import default_cache_dir, interpolate_responsivity, read_responsivity
+
+# Colors of the reference gamuts, in the order of reference_gamuts (as in the gamut script)
+reference_colors = ['blue', 'green', 'orange', 'purple', 'cyan']
+
+# Loci already loaded by this process, keyed by the hash of the CMF file
+_loaded_loci = {}
+
+# Figure of the worker process, created once by _init_worker and reused for every device
+_worker_figure = None
+
+
+# xy coordinates of the spectral locus, shape (wavelength x xy)
+#
+# Computed from the CMF file once and cached as .npy in the cache directory keyed by the
+# file hash, later calls (also of other processes) load the cached array.
+def spectral_locus(cmf_file=default_cmf_file, cache_dir=None):
+    key = hash_file(cmf_file)
+    if key in _loaded_loci:
+        return _loaded_loci[key]
+
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    cache_file = os.path.join(cache_dir, f'locus_{key}.npy')
+    if not os.path.exists(cache_file):
+        _, cmfs = load_cie_cmfs(cmf_file)
+        locus = np.column_stack(calculate_chromaticity(*cmfs))
+        atomic_write(cache_file, lambda f: np.save(f, locus))
+
+    locus = np.load(cache_file)
+    _loaded_loci[key] = locus
+    return locus
+
+
+# CIE 1931 diagram with the spectral locus and reference gamuts, rendered without a GUI backend
+#
+# The background (locus, reference gamuts, labels) is drawn once; every render only replaces
+# the sensor triangle and the title and writes the figure, so one instance renders any number
+# of devices.
+class GamutFigure:
+    def __init__(self, cmf_file=default_cmf_file, gamuts=reference_gamuts, figsize=(8, 8), dpi=100):
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+
+        self.figure = Figure(figsize=figsize, dpi=dpi)
+        FigureCanvasAgg(self.figure)
+        self.axes = self.figure.add_subplot()
+
+        locus = spectral_locus(cmf_file)
+        self.axes.plot(locus[:, 0], locus[:, 1], label='CIE 1931 spectrum', color='black', linewidth=0.5)
+        for name, triangle, color in zip(gamuts, gamut_triangles(gamuts), reference_colors):
+            closed = np.vstack([triangle, triangle[:1]])
+            self.axes.plot(closed[:, 0], closed[:, 1], label=name, color=color)
+            self.axes.fill(closed[:, 0], closed[:, 1], color=color, alpha=0.1)
+
+        self.sensor_line, = self.axes.plot([], [], 'r-', label='Sensor Gamut')
+        self.sensor_fill, = self.axes.fill([0, 0, 0], [0, 0, 0], 'r', alpha=0.2)
+        self.axes.set_xlabel('x')
+        self.axes.set_ylabel('y')
+        self.axes.set_title('CIE 1931 Chromaticity Diagram with Reference Color Gamuts')
+        self.axes.legend()
+        self.axes.grid(True)
+
+    # Draw the (vertex x xy) sensor triangle and write the figure to output_file
+    def render(self, triangle, output_file, title=None):
+        closed = np.vstack([triangle, triangle[:1]])
+        self.sensor_line.set_data(closed[:, 0], closed[:, 1])
+        self.sensor_fill.set_xy(closed)
+        if title is not None:
+            self.axes.set_title(title)
+        self.figure.savefig(output_file)
+
+
+def _init_worker(cmf_file):
+    global _worker_figure
+    _worker_figure = GamutFigure(cmf_file)
+
+
+def _render_task(task):
+    device_id, triangle, output_file = task
+    _worker_figure.render(triangle, output_file, f'{device_id}: sensor gamut')
+    return output_file
+
+
+# Render one gamut diagram per device into output_dir, on max_workers processes
+#
+# triangles is a (device x vertex x xy) array, e.g. from gamut.channel_gamuts. Every worker
+# builds the background once and renders its share of the devices into it. Returns the
+# written file names in device order.
+def render_gamut_reports(device_ids, triangles, output_dir, cmf_file=default_cmf_file, image_format='png',
+                         max_workers=None, chunksize=8):
+    os.makedirs(output_dir, exist_ok=True)
+    spectral_locus(cmf_file)  # fill the cache once, before the workers start
+    tasks = [(device_id, triangle, os.path.join(output_dir, f'{device_id}_gamut.{image_format}'))
+             for device_id, triangle in zip(device_ids, np.asarray(triangles))]
+    if max_workers == 1:
+        _init_worker(cmf_file)
+        return [_render_task(task) for task in tasks]
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(cmf_file,)) as executor:
+        return list(executor.map(_render_task, tasks, chunksize=chunksize))
+
+
+# Normalized R/G/B responses and V(λ) as in the lux script, written to output_file
+def render_response_figure(wavelengths, responses, V_lambda, output_file, title=None):
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    figure = Figure(figsize=(10, 6))
+    FigureCanvasAgg(figure)
+    axes = figure.add_subplot()
+    for ch, response in zip(['Red', 'Green', 'Blue'], responses):
+        axes.plot(wavelengths, response, label=f'Normalized {ch} Response')
+    axes.plot(wavelengths, V_lambda / np.max(V_lambda), label='Normalized V(λ)')
+    axes.set_xlabel('Wavelength (nm)')
+    axes.set_ylabel('Normalized Response')
+    axes.set_title(title or 'Normalized Spectral Responses and CIE Photopic Curve')
+    axes.legend()
+    axes.grid(True)
+    figure.savefig(output_file)
+
+
+# Device ids of responsivity files: the file names without extension, or the names of their
+# directories when file names repeat like in the fleet layout (devices/<id>/<file>)
+def device_ids_from_paths(paths):
+    ids = [os.path.splitext(os.path.basename(path))[0] for path in paths]
+    if len(set(ids)) < len(ids):
+        ids = [os.path.basename(os.path.dirname(os.path.abspath(path))) for path in paths]
+    if len(set(ids)) < len(ids):
+        duplicates = sorted({device_id for device_id in ids if ids.count(device_id) > 1})
+        raise ValueError(f'Responsivity files without unique file or directory names: {duplicates}')
+    return ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Render a gamut diagram per responsivity file without a display.')
+    parser.add_argument('responsivity_files', nargs='+', help='responsivity CSV or .dig files, one per device')
+    parser.add_argument('-o', '--output-dir', default='reports', help='directory for the figures')
+    parser.add_argument('--cmf', default=default_cmf_file, help='CIE 1931 2° color-matching functions CSV')
+    parser.add_argument('--format', default='png', help='image format (png, svg, pdf, ...)')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='worker processes (default: all cores)')
+    args = parser.parse_args()
+
+    responsivities = []
+    for responsivity_file in args.responsivity_files:
+        wavelengths_sensor, responsivity = read_responsivity(responsivity_file)
+        responsivities.append(interpolate_responsivity(wavelengths_sensor, responsivity, gamut_grid,
+                                                       extrapolate=False))
+    triangles = channel_gamuts(gamut_grid, np.array(responsivities), args.cmf)
+    device_ids = device_ids_from_paths(args.responsivity_files)
+    for output_file in render_gamut_reports(device_ids, triangles, args.output_dir, args.cmf, args.format,
+                                            args.workers):
+        print(output_file)
+
+
+if __name__ == '__main__':
+    main()
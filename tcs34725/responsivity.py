@@ -0,0 +1,118 @@
+import hashlib
+import os
+
+import numpy as np
+
+from .binary_format import atomic_write, hash_file
+
+# Sensor responsivity curves exported from calibration_data/TCS34725_color_curve.dig
+default_responsivity_file = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                         'calibration_data', 'TCS34725_spectral_responsivity.csv')
+
+# Row order of the channels in every responsivity matrix
+channels = ['Clear', 'Red', 'Green', 'Blue']
+
+# Bump this when the layout of the cached files changes
+cache_version = 1
+
+# Grids already loaded by this process, keyed by their cache file
+_loaded_grids = {}
+
+
+# Directory for the interpolated grids, can be moved with TCS34725_CACHE_DIR
+def default_cache_dir():
+    return os.environ.get('TCS34725_CACHE_DIR',
+                          os.path.join(os.path.expanduser('~'), '.cache', 'tcs34725'))
+
+
+# Create a wavelength grid from start to stop (inclusive) with the given step in nm
+def wavelength_grid(start, stop, step=1):
+    count = int(round((stop - start) / step)) + 1
+    return start + np.arange(count) * step
+
+
+# Read the sensor responsivity CSV into the wavelengths and a (channel x sample) matrix
+def read_responsivity_csv(responsivity_file=default_responsivity_file):
+    data = np.genfromtxt(responsivity_file, delimiter=',', names=True)
+    return data['Wavelength'], np.array([data[ch] for ch in channels])
+
+
+# Read the responsivity from the exported CSV or straight from an Engauge .dig document
+def read_responsivity(responsivity_file=default_responsivity_file):
+    if responsivity_file.endswith('.dig'):
+        from .engauge import read_responsivity_dig
+
+        return read_responsivity_dig(responsivity_file)
+    return read_responsivity_csv(responsivity_file)
+
+
+# Resample the responsivity matrix to the wavelengths with PCHIP interpolation
+#
+# Without extrapolation everything outside of the measured range is 0.
+def interpolate_responsivity(wavelengths_sensor, responsivity, wavelengths, extrapolate=True):
+    from scipy.interpolate import PchipInterpolator
+
+    pchip = PchipInterpolator(wavelengths_sensor, responsivity, axis=1, extrapolate=extrapolate)
+    return np.nan_to_num(pchip(wavelengths))
+
+
+# Hash of the source file content, the grid (None for the 1 nm grid of the measured range) and the
+# interpolation options
+def responsivity_cache_key(responsivity_file, wavelengths, extrapolate):
+    digest = hashlib.sha256(hash_file(responsivity_file).encode())
+    if wavelengths is None:
+        digest.update(b'grid=measured')
+    else:
+        digest.update(np.ascontiguousarray(wavelengths, dtype=np.float64).tobytes())
+    digest.update(f'extrapolate={bool(extrapolate)};version={cache_version}'.encode())
+    return digest.hexdigest()
+
+
+# Load the interpolated responsivity grid, interpolating only if it isn't cached yet
+#
+# Returns the wavelengths and the (channel x wavelength) matrix with rows ordered like
+# `channels`. Both are read-only views into a memory-mapped .npy file, so every process
+# loading the same grid shares the same pages. When wavelengths is None the 1 nm grid
+# inside the measured range is used, the source file is only parsed when that grid isn't cached.
+def load_responsivity_grid(wavelengths=None, responsivity_file=default_responsivity_file,
+                           extrapolate=True, cache_dir=None):
+    if wavelengths is not None:
+        wavelengths = np.asarray(wavelengths, dtype=np.float64)
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    key = responsivity_cache_key(responsivity_file, wavelengths, extrapolate)
+    cache_file = os.path.join(cache_dir, f'responsivity_{key}.npy')
+    if cache_file in _loaded_grids:
+        grid = _loaded_grids[cache_file]
+        return grid[0], grid[1:]
+
+    if not os.path.exists(cache_file):
+        wavelengths_sensor, responsivity = read_responsivity(responsivity_file)
+        if wavelengths is None:
+            wavelengths = wavelength_grid(np.ceil(wavelengths_sensor.min()), np.floor(wavelengths_sensor.max()))
+        grid = np.vstack([wavelengths,
+                          interpolate_responsivity(wavelengths_sensor, responsivity, wavelengths, extrapolate)])
+
+        atomic_write(cache_file, lambda f: np.save(f, grid))
+
+    grid = np.load(cache_file, mmap_mode='r')
+    _loaded_grids[cache_file] = grid
+    return grid[0], grid[1:]
+
+
+# Same as load_responsivity_grid, but as a dict of channel name to response
+def load_responsivity_channels(wavelengths=None, **kwargs):
+    wavelengths, responsivity = load_responsivity_grid(wavelengths, **kwargs)
+    return wavelengths, dict(zip(channels, responsivity))
+
+
+# Remove all cached grids
+def clear_responsivity_cache(cache_dir=None):
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    _loaded_grids.clear()
+    if not os.path.isdir(cache_dir):
+        return
+    for name in os.listdir(cache_dir):
+        if name.startswith('responsivity_') and name.endswith('.npy'):
+            os.unlink(os.path.join(cache_dir, name))
@@ -0,0 +1,89 @@
+import numpy as np
+
+# Gain multipliers of the AGAIN register values 0 to 3
+gains = np.array([1, 4, 16, 60], dtype=np.float64)
+
+# Every ATIME register value (0 to 255)
+atimes = np.arange(256)
+
+# One integration cycle takes 2.4 ms, ATIME counts the cycles down from 256
+integration_cycle_time = 2.4  # ms
+
+# Gain and integration time the conversion factors refer to: 1x and a single cycle
+reference_gain = 1
+reference_integration_time = integration_cycle_time  # ms
+
+# The count registers are 16 bit
+max_register_count = 65535
+
+# Below 64 integration cycles the ADC saturates before the register does (ripple saturation),
+# readings above 75 % of the maximum count are not trustworthy there
+ripple_saturation_cycles = 64
+ripple_saturation_fraction = 0.75
+
+# Clear counts below which a reading has too little signal for a usable conversion (under-range)
+min_clear_count = 10
+
+
+# Number of integration cycles of ATIME values
+def integration_cycles(atime):
+    return 256 - np.asarray(atime, dtype=np.int64)
+
+
+# Integration time in ms of ATIME values
+def atime_to_integration_time(atime):
+    return integration_cycles(atime) * integration_cycle_time
+
+
+# ATIME value closest to an integration time in ms
+def integration_time_to_atime(integration_time):
+    cycles = np.clip(np.rint(np.asarray(integration_time, dtype=np.float64) / integration_cycle_time), 1, 256)
+    return (256 - cycles).astype(np.int64)
+
+
+# Highest count the Clear/R/G/B registers reach for ATIME values
+def max_counts(atime):
+    return np.minimum(max_register_count, 1024 * integration_cycles(atime))
+
+
+# Counts at or above which a reading has to be treated as saturated
+def saturation_counts(atime):
+    cycles = integration_cycles(atime)
+    limit = max_counts(atime)
+    return np.where(cycles < ripple_saturation_cycles, np.floor(limit * ripple_saturation_fraction), limit)
+
+
+# Tables over every (AGAIN, ATIME) setting, indexed as table[again, atime]
+integration_time_table = atime_to_integration_time(atimes).astype(np.float64)
+max_count_table = max_counts(atimes)
+saturation_count_table = saturation_counts(atimes)
+
+
+# Scale of every setting relative to the reference setting of the conversion factors
+def build_scale_table(gain_table=gains):
+    gain_table = np.asarray(gain_table, dtype=np.float64)
+    return (gain_table[:, np.newaxis] / reference_gain) * \
+           (integration_time_table[np.newaxis, :] / reference_integration_time)
+
+
+scale_table = build_scale_table()
+inverse_scale_table = 1 / scale_table
+
+
+# Per-reading scale of mixed-setting batches by indexing the table with the register values
+def settings_scale(again, atime, table=scale_table):
+    return table[np.asarray(again, dtype=np.intp), np.asarray(atime, dtype=np.intp)]
+
+
+# Mask of readings where any channel reaches the saturation count of its ATIME
+def saturated(atime, *channel_counts):
+    limit = saturation_count_table[np.asarray(atime, dtype=np.intp)]
+    mask = np.zeros(np.broadcast_shapes(np.shape(limit), *[np.shape(c) for c in channel_counts]), dtype=bool)
+    for counts in channel_counts:
+        mask |= np.asarray(counts) >= limit
+    return mask
+
+
+# Mask of readings whose Clear count is below min_clear (under-range)
+def under_range(clear, min_clear=min_clear_count):
+    return np.asarray(clear) < min_clear
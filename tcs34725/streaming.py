@@ -0,0 +1,198 @@
+import argparse
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .converter import convert_counts, convert_register_counts
+
+# Record layout of binary logs: a millisecond timestamp followed by the data registers in
+# register order (CDATA, RDATA, GDATA, BDATA) and the AGAIN and ATIME settings of the read
+raw_record_dtype = np.dtype([
+    ('timestamp', '<u8'),
+    ('clear', '<u2'),
+    ('red', '<u2'),
+    ('green', '<u2'),
+    ('blue', '<u2'),
+    ('again', 'u1'),
+    ('atime', 'u1')
+])
+
+# Columns every input needs, plus either again/atime or gain/integration_time (ms)
+count_columns = ['red', 'green', 'blue', 'clear']
+
+# Converted columns written to the output, in this order
+output_columns = ['irradiance_red', 'irradiance_green', 'irradiance_blue', 'irradiance_clear', 'lux', 'x', 'y']
+
+default_chunk_size = 1 << 20  # readings
+
+
+# Read a CSV log in chunks of chunk_size rows, '-' reads from stdin
+def read_csv_chunks(input_file, chunk_size=default_chunk_size):
+    import pandas as pd
+
+    source = sys.stdin if input_file == '-' else input_file
+    yield from pd.read_csv(source, chunksize=chunk_size)
+
+
+# Read a binary log of raw_record_dtype records in chunks of chunk_size records
+def read_binary_chunks(input_file, chunk_size=default_chunk_size, dtype=raw_record_dtype):
+    import pandas as pd
+
+    with open(input_file, 'rb') as f:
+        while True:
+            block = f.read(chunk_size * dtype.itemsize)
+            if not block:
+                break
+            records = np.frombuffer(block, dtype=dtype, count=len(block) // dtype.itemsize)
+            yield pd.DataFrame({name: records[name] for name in dtype.names})
+
+
+# Masks added by the IR rejection of register-setting inputs
+ir_rejection_columns = ['ir', 'under_range', 'clipped', 'valid']
+
+
+# Convert one chunk, keeping all input columns that aren't counts or settings (timestamps, ids, ...)
+def convert_chunk(chunk, ir_rejection=False):
+    import pandas as pd
+
+    counts = [chunk[column].to_numpy() for column in count_columns]
+    if 'again' in chunk and 'atime' in chunk:
+        result = convert_register_counts(*counts, chunk['again'].to_numpy(), chunk['atime'].to_numpy(),
+                                         ir_rejection=ir_rejection)
+        settings_columns = ['again', 'atime']
+    elif 'gain' in chunk and 'integration_time' in chunk:
+        result = convert_counts(*counts, chunk['gain'].to_numpy(), chunk['integration_time'].to_numpy())
+        settings_columns = ['gain', 'integration_time']
+    else:
+        raise ValueError('Input needs again/atime or gain/integration_time columns')
+
+    passthrough = [column for column in chunk.columns if column not in count_columns + settings_columns]
+    converted = {column: chunk[column].to_numpy() for column in passthrough}
+    converted.update({column: result[column] for column in output_columns})
+    for column in ['saturated'] + ir_rejection_columns:
+        if column in result:
+            converted[column] = result[column]
+    return pd.DataFrame(converted)
+
+
+# Writes chunks as one CSV file (or stdout with '-'), the header only once
+class CsvChunkWriter:
+    def __init__(self, output_file):
+        self.file = sys.stdout if output_file == '-' else open(output_file, 'w', newline='')
+        self.header = True
+
+    def write(self, frame):
+        frame.to_csv(self.file, header=self.header, index=False)
+        self.header = False
+
+    def close(self):
+        if self.file is not sys.stdout:
+            self.file.close()
+
+
+# Schema of the Parquet output, derived from the first chunk but valid for all of them
+#
+# Every CSV chunk gets its column types inferred anew, so a passthrough column of integers in
+# one chunk can hold NaNs (floats) in a later one, and a column without any value in the first
+# chunk can hold strings later. Integer columns are widened to float64 and empty ones to strings.
+def stable_schema(schema):
+    import pyarrow as pa
+
+    fields = []
+    for field in schema:
+        if pa.types.is_integer(field.type):
+            field = field.with_type(pa.float64())
+        elif pa.types.is_null(field.type):
+            field = field.with_type(pa.string())
+        fields.append(field)
+    return pa.schema(fields)
+
+
+# Writes chunks as row groups of one Parquet file with stable_schema, needs pyarrow
+class ParquetChunkWriter:
+    def __init__(self, output_file):
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise ImportError('Writing Parquet needs pyarrow, install it or write CSV instead') from None
+        self.output_file = output_file
+        self.schema = None
+        self.writer = None
+
+    def write(self, frame):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        table = pa.Table.from_pandas(frame, preserve_index=False).replace_schema_metadata()
+        if self.writer is None:
+            self.schema = stable_schema(table.schema)
+            self.writer = pq.ParquetWriter(self.output_file, self.schema)
+        self.writer.write_table(table.cast(self.schema))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def open_chunk_writer(output_file):
+    if output_file.endswith('.parquet'):
+        return ParquetChunkWriter(output_file)
+    return CsvChunkWriter(output_file)
+
+
+def open_chunk_reader(input_file, chunk_size):
+    if input_file.endswith('.bin'):
+        return read_binary_chunks(input_file, chunk_size)
+    return read_csv_chunks(input_file, chunk_size)
+
+
+# Convert a log chunk by chunk, the output is written in input order
+#
+# With workers > 1 chunks are converted on a process pool, with at most two chunks per
+# worker in flight, so memory stays bounded by the chunk size either way. ir_rejection only
+# applies to inputs with register settings, see convert_register_counts.
+def stream_convert(input_file, output_file, chunk_size=default_chunk_size, workers=1, ir_rejection=False):
+    chunks = open_chunk_reader(input_file, chunk_size)
+    writer = open_chunk_writer(output_file)
+    converted_readings = 0
+    try:
+        if workers <= 1:
+            for chunk in chunks:
+                writer.write(convert_chunk(chunk, ir_rejection))
+                converted_readings += len(chunk)
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                pending = deque()
+                for chunk in chunks:
+                    pending.append(executor.submit(convert_chunk, chunk, ir_rejection))
+                    if len(pending) >= 2 * workers:
+                        frame = pending.popleft().result()
+                        writer.write(frame)
+                        converted_readings += len(frame)
+                while pending:
+                    frame = pending.popleft().result()
+                    writer.write(frame)
+                    converted_readings += len(frame)
+    finally:
+        writer.close()
+    return converted_readings
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert raw TCS34725 logs to irradiance, lux and xy in chunks.')
+    parser.add_argument('input', help="CSV log, binary log (.bin) or '-' for CSV on stdin")
+    parser.add_argument('-o', '--output', default='-', help="CSV or .parquet file, '-' for CSV on stdout")
+    parser.add_argument('--chunk-size', type=int, default=default_chunk_size, help='readings per chunk')
+    parser.add_argument('-j', '--workers', type=int, default=1, help='worker processes converting chunks')
+    parser.add_argument('--ir-rejection', action='store_true',
+                        help='subtract the IR estimated from Clear and add the ir/under_range/clipped/valid columns')
+    args = parser.parse_args()
+
+    converted_readings = stream_convert(args.input, args.output, args.chunk_size, args.workers, args.ir_rejection)
+    print(f"Converted {converted_readings} readings", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
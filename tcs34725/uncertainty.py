@@ -0,0 +1,223 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from . import calibration
+from .cie import default_cmf_file, default_photopic_file, interpolate_cmfs, load_cie_cmfs, load_photopic
+from .fleet import coefficient_columns, write_coefficient_table
+from .curve_features import pchip_curves, pchip_features, pchip_integrals
+from .integration import trapezoid_between, trapezoid_weights
+from .light_sources import gaussian, gaussian_normalized
+from .responsivity import channels, default_responsivity_file, read_responsivity, wavelength_grid
+
+# Standard deviations of the calibration inputs
+#
+# responsivity_noise is the digitization error of every sample of the curves (absolute, in the
+# unitless graph scale), responsivity_scale a relative error of every whole curve and
+# wavelength_shift an error of the graph's wavelength axis in nm. led_center and led_halfwidth
+# (nm) apply to every datasheet LED independently, reference_counts is the relative error of
+# the datasheet counts per µW/cm².
+default_uncertainties = {
+    'responsivity_noise': 0.005,
+    'responsivity_scale': 0.02,
+    'wavelength_shift': 1.0,
+    'led_center': 2.0,
+    'led_halfwidth': 2.0,
+    'reference_counts': 0.05
+}
+
+default_chunk_size = 1000  # draws per batch, about 30 MB of responsivity grids
+
+rgb_rows = [channels.index(ch) for ch in ['Red', 'Green', 'Blue']]
+clear_row = channels.index('Clear')
+
+# Coefficients of the chain, the fitted XYZ matrix isn't propagated (it is a non-linear fit per draw)
+chain_columns = [column for column in coefficient_columns if not column.startswith('F_')]
+
+
+# Everything the batched chain needs besides the random draws, computed once
+#
+# Responses are perturbed at the digitized samples and resampled to the 1 nm simulation grid
+# (0 outside the digitized range) for the LED stages, the CMFs are sampled on the 1 nm grid
+# from 360 nm to 830 nm of the XYZ stage.
+def chain_inputs(responsivity_file=default_responsivity_file, cmf_file=default_cmf_file,
+                 photopic_file=default_photopic_file, graph_leds=calibration.graph_reference_leds,
+                 channel_leds=calibration.channel_reference_leds):
+    from scipy.interpolate import PchipInterpolator
+
+    wavelengths_sensor, responsivity = read_responsivity(responsivity_file)
+    wavelengths = calibration.simulation_grid(responsivity_file)
+
+    wavelengths_cie, V_lambda = load_photopic(photopic_file)
+    wavelengths_cmf, cmfs = load_cie_cmfs(cmf_file)
+    wavelengths_xyz = wavelength_grid(360, 830)
+    return {
+        'wavelengths_sensor': wavelengths_sensor,
+        'pchip': PchipInterpolator(wavelengths_sensor, responsivity, axis=1, extrapolate=False),
+        'wavelengths': wavelengths,
+        'weights': trapezoid_weights(wavelengths),
+        'V_lambda': calibration.interpolate_response(wavelengths_cie, V_lambda, wavelengths),
+        'wavelengths_xyz': wavelengths_xyz,
+        'cmf_weights': interpolate_cmfs(wavelengths_cmf, cmfs, wavelengths_xyz) * trapezoid_weights(wavelengths_xyz),
+        'graph_leds': [[led[key] for led in graph_leds.values()]
+                       for key in ['center', 'halfwidth', 'counts_per_uW_cm2']],
+        'channel_leds': [[led[key] for led in channel_leds.values()] for key in ['center', 'halfwidth']]
+    }
+
+
+# Per-draw perturbed inputs of a batch, all zero standard deviations give the nominal inputs
+def draw_inputs(inputs, draws, rng, uncertainties=default_uncertainties):
+    u = {**default_uncertainties, **uncertainties}
+    wavelengths_sensor = inputs['wavelengths_sensor']
+    shift = rng.normal(0, u['wavelength_shift'], (draws, 1))
+    # A shifted wavelength axis moves the first and last samples off the curve, they keep their value
+    shifted = np.clip(wavelengths_sensor - shift, wavelengths_sensor[0], wavelengths_sensor[-1])
+    samples = np.moveaxis(inputs['pchip'](shifted), 0, 1) * rng.normal(1, u['responsivity_scale'],
+                                                                         (draws, len(channels), 1)) \
+        + rng.normal(0, u['responsivity_noise'], (draws, len(channels), len(wavelengths_sensor)))
+
+    graph_centers, graph_halfwidths, graph_counts = (np.asarray(values, dtype=np.float64)
+                                                     for values in inputs['graph_leds'])
+    channel_centers, channel_halfwidths = (np.asarray(values, dtype=np.float64) for values in inputs['channel_leds'])
+    return {
+        'responsivity_samples': samples,
+        'graph_centers': graph_centers + rng.normal(0, u['led_center'], (draws, len(graph_centers))),
+        'graph_halfwidths': graph_halfwidths + rng.normal(0, u['led_halfwidth'], (draws, len(graph_centers))),
+        'graph_counts': graph_counts * rng.normal(1, u['reference_counts'], (draws, len(graph_centers))),
+        'channel_centers': channel_centers + rng.normal(0, u['led_center'], (draws, len(channel_centers))),
+        'channel_halfwidths': channel_halfwidths + rng.normal(0, u['led_halfwidth'], (draws, len(channel_centers)))
+    }
+
+
+# The calibration chain for a batch of draws, one coefficient row per draw
+#
+# Batched form of the pipeline stages: graph conversion factor (median over the graph LEDs),
+# channel conversion factors over each channel's FWHM, lux factors and the three LED RGB to
+# XYZ matrix. The counts of the channel LEDs cancel in the normalized RGB values, and the
+# conversion factor cancels in the lux factors, so neither is drawn for those.
+def run_chain(inputs, drawn, gain=1, integration_time=2.4, irradiance_per_lux=calibration.irradiance_per_lux):
+    # PCHIP interpolant of the drawn samples like in the pipeline, resampled for the LED stages
+    samples = drawn['responsivity_samples']  # (draw x channel x sample)
+    pchip = pchip_curves(inputs['wavelengths_sensor'], samples.reshape(-1, samples.shape[-1]))
+    wavelengths = inputs['wavelengths']
+    weights = inputs['weights']
+    responsivity = np.nan_to_num(pchip(wavelengths)).reshape(samples.shape[:2] + (len(wavelengths),))
+
+    # Graph conversion factor
+    emission = gaussian(wavelengths, drawn['graph_centers'][..., np.newaxis],
+                        drawn['graph_halfwidths'][..., np.newaxis])
+    unitless_avg = (emission @ (responsivity[:, clear_row] * weights)[..., np.newaxis])[..., 0] / (emission @ weights)
+    conversion_factor = np.median(drawn['graph_counts'] / unitless_avg, axis=1)
+
+    # Exact FWHM edges and integrals of every drawn response, as in the analytic FWHM method of the pipeline
+    features = pchip_features(pchip)
+    start = features.fwhm_start.reshape(responsivity.shape[:2])
+    end = features.fwhm_end.reshape(responsivity.shape[:2])
+    fwhm_integrals = pchip_integrals(pchip, features.fwhm_start, features.fwhm_end).reshape(responsivity.shape[:2])
+    scale = (gain / calibration.graph_gain) * (integration_time / calibration.graph_integration_time)
+    channel_factors = conversion_factor[:, np.newaxis] * fwhm_integrals / fwhm_integrals[:, clear_row:clear_row + 1] \
+        * scale
+
+    # Lux factors, weights of V(λ) over the FWHM of the responses scaled by 1 / C
+    weighted_V = trapezoid_between(wavelengths, (responsivity[:, rgb_rows] * inputs['V_lambda']).reshape(
+        -1, len(wavelengths)), start[:, rgb_rows].ravel(), end[:, rgb_rows].ravel()).reshape(-1, len(rgb_rows))
+    factors = weighted_V / channel_factors[:, rgb_rows]
+    lux_factors = factors / factors.sum(axis=1, keepdims=True) / (irradiance_per_lux * 100)
+
+    # RGB to XYZ matrix C = (S⁻¹ · T)ᵀ of the channel LEDs
+    emission = gaussian(wavelengths, drawn['channel_centers'][..., np.newaxis],
+                        drawn['channel_halfwidths'][..., np.newaxis])
+    channel_avg = emission @ np.swapaxes(responsivity * weights, 1, 2)  # (draw x LED x channel)
+    S = channel_avg[..., rgb_rows] / channel_avg[..., clear_row:clear_row + 1]
+    emission_xyz = gaussian_normalized(inputs['wavelengths_xyz'], drawn['channel_centers'][..., np.newaxis],
+                                       drawn['channel_halfwidths'][..., np.newaxis])
+    T = emission_xyz @ inputs['cmf_weights'].T
+    matrix = np.swapaxes(np.linalg.solve(S, T), 1, 2)
+
+    return np.column_stack([conversion_factor, channel_factors, lux_factors, matrix.reshape(len(matrix), 9)])
+
+
+# Worker entry point: draw and run one batch with its own seed sequence
+def _run_batch(task):
+    inputs, draws, seed, uncertainties = task
+    rng = np.random.default_rng(seed)
+    return run_chain(inputs, draw_inputs(inputs, draws, rng, uncertainties))
+
+
+# Propagate the input uncertainties through the calibration chain by Monte Carlo
+#
+# The draws are run in batches of chunk_size, each batch seeded from its own branch of the
+# seed sequence, so the result doesn't depend on max_workers. With max_workers > 1 the
+# batches run on a process pool. Returns the nominal coefficients (no perturbation) and a
+# structured array with one row of coefficients per draw, columns as in the fleet table without
+# the fitted XYZ matrix.
+def propagate_uncertainty(draws=10000, uncertainties=default_uncertainties, inputs=None, seed=0,
+                          chunk_size=default_chunk_size, max_workers=1):
+    if inputs is None:
+        inputs = chain_inputs()
+    dtype = [(column, np.float64) for column in chain_columns]
+    nominal = run_chain(inputs, draw_inputs(inputs, 1, np.random.default_rng(0),
+                                            {key: 0.0 for key in default_uncertainties}))[0]
+
+    sizes = [min(chunk_size, draws - start) for start in range(0, draws, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    tasks = [(inputs, size, batch_seed, uncertainties) for size, batch_seed in zip(sizes, seeds)]
+    if max_workers > 1:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            batches = list(executor.map(_run_batch, tasks))
+    else:
+        batches = [_run_batch(task) for task in tasks]
+
+    samples = np.zeros(draws, dtype=dtype)
+    rows = np.concatenate(batches)
+    for i, column in enumerate(chain_columns):
+        samples[column] = rows[:, i]
+    return dict(zip(chain_columns, nominal.tolist())), samples
+
+
+# Mean, standard deviation, median and the central confidence interval of every coefficient
+def confidence_intervals(samples, level=0.95):
+    tail = (1 - level) / 2 * 100
+    summary = {}
+    for column in samples.dtype.names:
+        values = samples[column]
+        low, median, high = np.percentile(values, [tail, 50, 100 - tail])
+        summary[column] = {'mean': float(values.mean()), 'std': float(values.std(ddof=1)), 'median': float(median),
+                           'low': float(low), 'high': float(high)}
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Propagate the calibration input uncertainties by Monte Carlo.')
+    parser.add_argument('-n', '--draws', type=int, default=10000, help='number of Monte Carlo draws')
+    parser.add_argument('-j', '--workers', type=int, default=1, help='worker processes')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--level', type=float, default=0.95, help='confidence level of the intervals')
+    parser.add_argument('--responsivity', default=default_responsivity_file, help='sensor responsivity CSV or .dig')
+    parser.add_argument('--cmf', default=default_cmf_file, help='CIE 1931 2° color-matching functions CSV')
+    parser.add_argument('--photopic', default=default_photopic_file, help='CIE photopic V(λ) CSV')
+    for key, value in default_uncertainties.items():
+        parser.add_argument(f"--{key.replace('_', '-')}", type=float, default=value,
+                            help=f'standard deviation (default {value})')
+    parser.add_argument('-o', '--output', help='write the draws as a coefficient table (.csv or .npy)')
+    args = parser.parse_args()
+
+    uncertainties = {key: getattr(args, key) for key in default_uncertainties}
+    inputs = chain_inputs(args.responsivity, args.cmf, args.photopic)
+    nominal, samples = propagate_uncertainty(args.draws, uncertainties, inputs, args.seed, max_workers=args.workers)
+
+    print(f"{'coefficient':<18}{'nominal':>14}{'std':>14}{'low':>14}{'high':>14}  ({args.level:.0%} interval)")
+    for column, stats in confidence_intervals(samples, args.level).items():
+        print(f"{column:<18}{nominal[column]:>14.6g}{stats['std']:>14.3g}{stats['low']:>14.6g}{stats['high']:>14.6g}")
+
+    if args.output:
+        table = np.zeros(len(samples), dtype=[('device_id', 'U12')] + samples.dtype.descr)
+        table['device_id'] = [f'draw_{i}' for i in range(len(samples))]
+        for column in samples.dtype.names:
+            table[column] = samples[column]
+        write_coefficient_table(table, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+import argparse
+from collections import namedtuple
+
+import numpy as np
+
+from .calibration import graph_counts_scale
+from .cie import default_cmf_file, interpolate_cmfs, load_cie_cmfs
+from .converter import calculate_chromaticity, calculate_scale, convert_counts, graph_conversion_factor, reject_ir
+from .integration import SpectralIntegrator
+from .light_sources import planckian, scenario_spectra
+from .responsivity import channels, default_responsivity_file, load_responsivity_grid
+
+# Channels the fitted matrix takes as input, in column order
+fit_channels = ['Red', 'Green', 'Blue', 'Clear']
+
+# Result of a fit: the (XYZ x channel) matrix, its input channels, whether the IR estimate of
+# reject_ir is removed from the counts first and the chromaticity error on the training set per
+# light type (mean, 95th percentile and max distance in xy)
+XYZFit = namedtuple('XYZFit', ['matrix', 'channels', 'ir_rejection', 'xy_error'])
+
+# Planckian locus sampled in CIE 1960 (u, v), used by estimate_cct_duv
+PlanckianTable = namedtuple('PlanckianTable', ['cct', 'u', 'v', 'tree'])
+
+
+# Counts at 1x gain and 2.4 ms (per µW/cm² of a spectrum with a radiant power of 1) and XYZ of every spectrum
+def simulate_training_set(integrator, spectra, conversion_factor=graph_conversion_factor):
+    integrals = integrator.integrate(spectra)
+    counts = integrals[:, [integrator.columns.index(ch) for ch in channels]] * graph_counts_scale(conversion_factor)
+    XYZ = integrals[:, [integrator.columns.index(c) for c in ['X', 'Y', 'Z']]]
+    return counts, XYZ
+
+
+# Input columns of a fitted matrix: the counts of channel_names, after removing the IR estimate of
+# reject_ir when ir_rejection is set
+#
+# counts has one column per entry of `channels`.
+def fit_inputs(counts, channel_names=fit_channels, ir_rejection=True):
+    counts = np.asarray(counts, dtype=np.float64)
+    if ir_rejection:
+        rejected = reject_ir(*[counts[:, channels.index(ch)] for ch in ['Red', 'Green', 'Blue', 'Clear']])
+        counts = np.column_stack([rejected[ch.lower()] for ch in channels])
+    return counts[:, [channels.index(ch) for ch in channel_names]]
+
+
+# Weighted fit of XYZ ≈ counts · Mᵀ for the chromaticity and the luminance
+#
+# The Y row is the least squares fit of Y relative to its magnitude. The X and Z rows then
+# minimize the xy distances with Gauss-Newton steps, starting from the least squares fit of XYZ
+# relative to the sum of XYZ. That fit alone matches the sum but not the ratios: with the IR
+# beyond 830 nm in the counts its xy error is about that of the three LED matrix.
+def fit_counts_to_xyz(counts, XYZ, weights=None, channel_names=fit_channels, ir_rejection=True):
+    from scipy.optimize import least_squares
+
+    XYZ = np.asarray(XYZ, dtype=np.float64)
+    A = fit_inputs(counts, channel_names, ir_rejection)
+    if weights is None:
+        weights = np.ones(len(XYZ))
+    sqrt_weights = np.sqrt(weights)
+
+    relative = (sqrt_weights / XYZ[:, 1])[:, np.newaxis]
+    Y_row, _, _, _ = np.linalg.lstsq(A * relative, XYZ[:, 1] * relative[:, 0], rcond=None)
+    relative = (sqrt_weights / np.sum(XYZ, axis=1))[:, np.newaxis]
+    start, _, _, _ = np.linalg.lstsq(A * relative, XYZ * relative, rcond=None)
+
+    x, y = calculate_chromaticity(*XYZ.T)
+    count = len(channel_names)
+
+    def matrix(rows):
+        return np.vstack([rows[:count], Y_row, rows[count:]])
+
+    def residuals(rows):
+        x_fitted, y_fitted = calculate_chromaticity(*(A @ matrix(rows).T).T)
+        return np.concatenate([sqrt_weights * (x_fitted - x), sqrt_weights * (y_fitted - y)])
+
+    return matrix(least_squares(residuals, np.concatenate([start[:, 0], start[:, 2]])).x)
+
+
+# Mean, 95th percentile and max distance in xy between the fitted and the true chromaticities,
+# over all lights and for every light type
+def chromaticity_error(XYZ_fitted, XYZ, light_types):
+    x_fitted, y_fitted = calculate_chromaticity(*XYZ_fitted.T)
+    x, y = calculate_chromaticity(*XYZ.T)
+    distance = np.hypot(x_fitted - x, y_fitted - y)
+    groups = {'all': np.ones(len(distance), dtype=bool)}
+    groups.update({light_type: light_types == light_type for light_type in np.unique(light_types)})
+    return {name: {'mean': float(np.mean(distance[mask])), 'p95': float(np.percentile(distance[mask], 95)),
+                   'max': float(np.max(distance[mask]))}
+            for name, mask in groups.items()}
+
+
+# Fit the counts to XYZ matrix over simulated lights from the responsivity curves and the CIE 1931 CMFs
+#
+# The spectra default to scenario_spectra on the measured wavelength range of the sensor,
+# so the IR part the sensor sees beyond 830 nm is part of the simulation. Without weights
+# every light type weighs the same in total. Returns the fit and the error of the three LED
+# matrix of convert_counts on the same set.
+def fit_xyz_matrix(responsivity_file=default_responsivity_file, cmf_file=default_cmf_file,
+                   conversion_factor=graph_conversion_factor, spectra=None, light_types=None, wavelengths=None,
+                   weights=None, channel_names=fit_channels, ir_rejection=True):
+    wavelengths, responsivity = load_responsivity_grid(wavelengths, responsivity_file)
+    wavelengths_cie, cmfs = load_cie_cmfs(cmf_file)
+    integrator = SpectralIntegrator(wavelengths, responsivity, interpolate_cmfs(wavelengths_cie, cmfs, wavelengths))
+    if spectra is None:
+        spectra, light_types = scenario_spectra(wavelengths)
+    if light_types is None:
+        light_types = np.array(['all'] * len(spectra))
+    if weights is None:
+        _, type_index, type_counts = np.unique(light_types, return_inverse=True, return_counts=True)
+        weights = 1 / type_counts[type_index]
+
+    counts, XYZ = simulate_training_set(integrator, spectra, conversion_factor)
+    matrix = fit_counts_to_xyz(counts, XYZ, weights, channel_names, ir_rejection)
+    XYZ_fitted = fit_inputs(counts, channel_names, ir_rejection) @ matrix.T
+    fit = XYZFit(matrix, list(channel_names), ir_rejection, chromaticity_error(XYZ_fitted, XYZ, light_types))
+
+    converted = convert_counts(*[counts[:, channels.index(ch)] for ch in ['Red', 'Green', 'Blue', 'Clear']])
+    XYZ_matrix = np.column_stack([converted['X'], converted['Y'], converted['Z']])
+    return fit, chromaticity_error(XYZ_matrix, XYZ, light_types)
+
+
+# Apply a fitted matrix to a batch of raw counts at any gain and integration time (ms)
+def counts_to_xyz(fit, red, green, blue, clear, gain=1, integration_time=2.4):
+    readings = {'Red': red, 'Green': green, 'Blue': blue, 'Clear': clear}
+    if fit.ir_rejection:
+        rejected = reject_ir(red, green, blue, clear)
+        readings = {ch: rejected[ch.lower()] for ch in readings}
+    inv_scale = 1.0 / calculate_scale(gain, integration_time)
+    counts = np.stack(np.broadcast_arrays(*[np.asarray(readings[ch], dtype=np.float64) * inv_scale
+                                            for ch in fit.channels]), axis=-1)
+    XYZ = counts @ np.asarray(fit.matrix).T
+    return XYZ[..., 0], XYZ[..., 1], XYZ[..., 2]
+
+
+# CIE 1960 UCS coordinates
+def xyz_to_uv(X, Y, Z):
+    denominator = X + 15 * Y + 3 * Z
+    nonzero = denominator != 0
+    u = np.divide(4 * X, denominator, out=np.zeros_like(denominator, dtype=np.float64), where=nonzero)
+    v = np.divide(6 * Y, denominator, out=np.zeros_like(denominator, dtype=np.float64), where=nonzero)
+    return u, v
+
+
+# Sample the Planckian locus evenly in mired between cct_min and cct_max
+def planckian_locus_table(cmf_file=default_cmf_file, cct_min=1000, cct_max=25000, count=1000):
+    from scipy.spatial import cKDTree
+
+    wavelengths_cie, cmfs = load_cie_cmfs(cmf_file)
+    cct = 1e6 / np.linspace(1e6 / cct_max, 1e6 / cct_min, count)[::-1]
+    integrator = SpectralIntegrator(wavelengths_cie, cmfs=cmfs)
+    XYZ = integrator.xyz(planckian(wavelengths_cie, cct))
+    u, v = xyz_to_uv(*XYZ.T)
+    return PlanckianTable(cct, u, v, cKDTree(np.column_stack([u, v])))
+
+
+# Correlated color temperature and Duv of a batch of XYZ values
+#
+# The nearest table point is found with a k-d tree and refined with Ohno's parabolic
+# interpolation over its neighbours. Duv is positive above the locus.
+def estimate_cct_duv(X, Y, Z, table):
+    return uv_to_cct_duv(*xyz_to_uv(np.asarray(X, dtype=np.float64), np.asarray(Y, dtype=np.float64),
+                                    np.asarray(Z, dtype=np.float64)), table)
+
+
+# Same as estimate_cct_duv for CIE 1960 (u, v) coordinates
+def uv_to_cct_duv(u, v, table):
+    u = np.asarray(u, dtype=np.float64)
+    v = np.asarray(v, dtype=np.float64)
+    _, nearest = table.tree.query(np.column_stack([np.ravel(u), np.ravel(v)]))
+    i = np.clip(nearest, 1, len(table.cct) - 2).reshape(np.shape(u))
+
+    T0, T1, T2 = table.cct[i - 1], table.cct[i], table.cct[i + 1]
+    d0 = np.hypot(u - table.u[i - 1], v - table.v[i - 1])
+    d1 = np.hypot(u - table.u[i], v - table.v[i])
+    d2 = np.hypot(u - table.u[i + 1], v - table.v[i + 1])
+
+    denominator = (T2 - T1) * (T0 - T2) * (T1 - T0)
+    a = (T0 * (d2 - d1) + T1 * (d0 - d2) + T2 * (d1 - d0)) / denominator
+    b = -(T0 ** 2 * (d2 - d1) + T1 ** 2 * (d0 - d2) + T2 ** 2 * (d1 - d0)) / denominator
+    c = -(d0 * (T2 - T1) * T1 * T2 + d1 * (T0 - T2) * T0 * T2 + d2 * (T1 - T0) * T0 * T1) / denominator
+
+    cct = -b / (2 * a)
+    duv = np.sign(v - table.v[i]) * (a * cct ** 2 + b * cct + c)
+    return cct, duv
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fit a counts to XYZ matrix over simulated lights.')
+    parser.add_argument('--responsivity', default=default_responsivity_file, help='responsivity CSV or .dig file')
+    parser.add_argument('--cmf', default=default_cmf_file, help='CIE 1931 2° color-matching functions CSV')
+    parser.add_argument('--no-ir-rejection', dest='ir_rejection', action='store_false',
+                        help='fit the raw counts instead of the IR-rejected ones')
+    args = parser.parse_args()
+
+    fit, matrix_errors = fit_xyz_matrix(args.responsivity, args.cmf, ir_rejection=args.ir_rejection)
+    for name, row in zip('XYZ', fit.matrix):
+        print(f"{name}: " + ', '.join(f'{weight:.6g} · {ch}' for weight, ch in zip(row, fit.channels)))
+    print('light type,fit mean,fit p95,fit max,matrix mean,matrix p95,matrix max')
+    for light_type, error in fit.xy_error.items():
+        old = matrix_errors[light_type]
+        print(f"{light_type},{error['mean']:.4f},{error['p95']:.4f},{error['max']:.4f},"
+              f"{old['mean']:.4f},{old['p95']:.4f},{old['max']:.4f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+
+# Asymmetric Gaussian lobe of the multi-lobe fit of the CIE 1931 CMFs by Wyman, Sloan and Shirley (2013)
+def _lobe(wavelengths, center, sigma_below, sigma_above):
+    sigma = np.where(wavelengths < center, sigma_below, sigma_above)
+    return np.exp(-0.5 * ((wavelengths - center) / sigma) ** 2)
+
+
+# The CIE datasets aren't part of the repository, the tests use analytic stand-ins in the same CSV layout
+@pytest.fixture(scope='session')
+def cie_files(tmp_path_factory):
+    directory = tmp_path_factory.mktemp('cie')
+    wavelengths = np.arange(360, 831, dtype=np.float64)
+    x_bar = (1.056 * _lobe(wavelengths, 599.8, 37.9, 31.0) + 0.362 * _lobe(wavelengths, 442.0, 16.0, 26.7)
+             - 0.065 * _lobe(wavelengths, 501.1, 20.4, 26.2))
+    y_bar = 0.821 * _lobe(wavelengths, 568.8, 46.9, 40.5) + 0.286 * _lobe(wavelengths, 530.9, 16.3, 31.1)
+    z_bar = 1.217 * _lobe(wavelengths, 437.0, 11.8, 36.0) + 0.681 * _lobe(wavelengths, 459.0, 26.0, 13.8)
+
+    files = {'cmf': str(directory / 'CIE_xyz_1931_2deg.csv'), 'photopic': str(directory / 'CIE_sle_photopic.csv')}
+    np.savetxt(files['cmf'], np.column_stack([wavelengths, x_bar, y_bar, z_bar]), delimiter=',')
+    np.savetxt(files['photopic'], np.column_stack([wavelengths, y_bar]), delimiter=',')
+    return files
+
+
+# Keep the interpolated grids of every test out of the user's cache
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv('TCS34725_CACHE_DIR', str(tmp_path / 'cache'))
+    return tmp_path / 'cache'
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from tcs34725.binary_format import hash_file, map_arrays, write_arrays
+
+magic = b'TEST\0'
+
+
+def test_write_map_round_trip(tmp_path):
+    path = str(tmp_path / 'arrays.bin')
+    arrays = {
+        'float': np.linspace(0, 1, 7),
+        'big_endian': np.arange(12, dtype='>f8').reshape(3, 4),
+        'integers': np.arange(5, dtype=np.int32),
+        'matrix': np.asfortranarray(np.arange(6, dtype=np.float32).reshape(2, 3)),
+        'empty': np.zeros((0, 3))
+    }
+    write_arrays(path, magic, {'version': 1, 'names': ['a', 'b']}, arrays)
+
+    header, mapped = map_arrays(path, magic, 'test')
+    assert header['version'] == 1
+    assert header['names'] == ['a', 'b']
+    assert mapped.keys() == arrays.keys()
+    for name, array in arrays.items():
+        assert mapped[name].dtype == array.dtype.newbyteorder('<')
+        assert mapped[name].shape == array.shape
+        np.testing.assert_array_equal(mapped[name], array)
+        assert not mapped[name].flags.writeable
+    for spec in header['arrays'].values():
+        assert spec['offset'] % 64 == 0
+
+
+def test_map_rejects_other_files(tmp_path):
+    path = tmp_path / 'other.bin'
+    path.write_bytes(b'OTHER\0' + bytes(16))
+    with pytest.raises(ValueError, match='not a test file'):
+        map_arrays(str(path), magic, 'test')
+
+
+def test_hash_file_follows_content(tmp_path):
+    path = tmp_path / 'data.csv'
+    path.write_text('1,2,3\n')
+    first = hash_file(str(path))
+    assert hash_file(str(path)) == first
+    path.write_text('1,2,3,4\n')
+    assert hash_file(str(path)) != first
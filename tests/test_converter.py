@@ -0,0 +1,38 @@
+import numpy as np
+
+from tcs34725.converter import (coefficients_from_results, convert_counts, convert_register_counts,
+                                default_coefficients, load_coefficients)
+from tcs34725.pipeline import run_pipeline
+from tcs34725.settings import gains, integration_time_table
+
+
+def test_register_counts_match_convert_counts():
+    rng = np.random.default_rng(0)
+    red, green, blue, clear = rng.uniform(0, 20000, (4, 500))
+    again = rng.integers(0, 4, 500)
+    atime = rng.integers(0, 256, 500)
+
+    registers = convert_register_counts(red, green, blue, clear, again, atime)
+    counts = convert_counts(red, green, blue, clear, gains[again], integration_time_table[atime])
+    for name, values in counts.items():
+        np.testing.assert_allclose(registers[name], values, rtol=1e-12, err_msg=name)
+
+
+def test_reference_leds_map_to_their_xyz(cie_files):
+    results, _ = run_pipeline(files=cie_files, targets=['rgb_to_xyz_matrix'])
+    matrix = np.array(results['rgb_to_xyz_matrix']['RGB_to_XYZ_matrix'])
+    led_xyz = results['led_xyz']['led_xyz']
+    normalized_rgb = results['normalized_rgb']['normalized_rgb']
+    for led, XYZ in led_xyz.items():
+        rgb = np.array([normalized_rgb[led][ch] for ch in ['red', 'green', 'blue']])
+        np.testing.assert_allclose(matrix @ rgb, XYZ, rtol=1e-9, atol=1e-12, err_msg=led)
+
+
+# The coefficients of a pipeline run read back from its state file, with the datasheet conversion factors
+def test_load_coefficients_from_state_file(cie_files, tmp_path):
+    state_file = str(tmp_path / 'state.json')
+    results, _ = run_pipeline(files=cie_files, params={'fwhm': 'sampled'}, state_file=state_file)
+    coefficients = load_coefficients(state_file)
+    assert coefficients == coefficients_from_results(results)
+    for column in ['conversion_factor', 'C_clear', 'C_red', 'C_green', 'C_blue']:
+        np.testing.assert_allclose(coefficients[column], default_coefficients[column], rtol=1e-12, err_msg=column)
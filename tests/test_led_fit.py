@@ -0,0 +1,52 @@
+import numpy as np
+
+from tcs34725.integration import trapezoid_weights
+from tcs34725.led_fit import fit_lots, led_residuals
+from tcs34725.responsivity import load_responsivity_grid, wavelength_grid
+
+
+def _problem():
+    wavelengths, responsivity = load_responsivity_grid(wavelength_grid(380, 780))
+    rng = np.random.default_rng(1)
+    counts = rng.uniform(50, 500, (2, 2, 3, 4))  # (lot x set x LED x channel)
+    counts[0, 1, 2] = np.nan
+    centers = np.array([465.0, 525.0, 625.0])
+    halfwidths = np.array([25.0, 35.0, 20.0])
+    return wavelengths, np.array(responsivity), counts, centers, halfwidths
+
+
+def test_jacobian_matches_finite_differences():
+    wavelengths, responsivity, counts, centers, halfwidths = _problem()
+    weights = trapezoid_weights(wavelengths)
+    params = np.array([[300.0, 250.0, 468.0, 520.0, 630.0, 27.0, 33.0, 21.0],
+                       [280.0, 310.0, 462.0, 528.0, 622.0, 24.0, 37.0, 19.0]])
+
+    _, jacobian = led_residuals(params, wavelengths, weights, responsivity, counts, centers, halfwidths)
+    numeric = np.empty_like(jacobian)
+    for k in range(params.shape[1]):
+        step = 1e-6 * max(abs(params[0, k]), 1)
+        up, down = params.copy(), params.copy()
+        up[:, k] += step
+        down[:, k] -= step
+        residuals_up, _ = led_residuals(up, wavelengths, weights, responsivity, counts, centers, halfwidths)
+        residuals_down, _ = led_residuals(down, wavelengths, weights, responsivity, counts, centers, halfwidths)
+        numeric[:, :, k] = (residuals_up - residuals_down) / (2 * step)
+    np.testing.assert_allclose(jacobian, numeric, rtol=1e-5, atol=1e-7)
+
+
+# Counts simulated from known LEDs are fitted back to them
+def test_fit_recovers_simulated_leds():
+    wavelengths, responsivity, _, centers, halfwidths = _problem()
+    weights = trapezoid_weights(wavelengths)
+    true_params = np.array([[300.0, 250.0, 467.0, 522.0, 628.0, 26.0, 34.0, 21.0]])
+    residuals, _ = led_residuals(true_params, wavelengths, weights, responsivity, np.ones((1, 2, 3, 4)),
+                                 true_params[:, 2:5], true_params[:, 5:])
+    # Against counts of 1 with the default 5 % uncertainty the residuals are (predicted - 1) / 0.05
+    counts = residuals[:, :24].reshape(1, 2, 3, 4) * 0.05 + 1
+
+    fit = fit_lots(wavelengths, responsivity, counts, centers, halfwidths,
+                   uncertainties={'counts': 0.05, 'led_center': 1e3, 'led_halfwidth': 1e3})
+    assert fit.converged.all()
+    np.testing.assert_allclose(fit.scales, true_params[:, :2], rtol=1e-4)
+    np.testing.assert_allclose(fit.centers, true_params[:, 2:5], atol=1e-2)
+    np.testing.assert_allclose(fit.halfwidths, true_params[:, 5:], atol=1e-2)
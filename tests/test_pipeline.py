@@ -0,0 +1,24 @@
+import json
+
+from tcs34725.pipeline import run_pipeline
+
+
+def test_second_run_does_no_work(cie_files, tmp_path):
+    state_file = str(tmp_path / 'state.json')
+    results, executed = run_pipeline(files=cie_files, state_file=state_file)
+    assert executed
+    with open(state_file) as f:
+        state = json.load(f)
+
+    results_again, executed_again = run_pipeline(files=cie_files, state_file=state_file)
+    assert executed_again == []
+    assert results_again == results
+    with open(state_file) as f:
+        assert json.load(f) == state
+
+
+def test_changed_parameter_reruns_only_dependent_stages(cie_files, tmp_path):
+    state_file = str(tmp_path / 'state.json')
+    run_pipeline(files=cie_files, state_file=state_file)
+    _, executed = run_pipeline(files=cie_files, params={'irradiance_per_lux': 0.008}, state_file=state_file)
+    assert executed == ['lux_factors']